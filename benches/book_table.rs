@@ -0,0 +1,159 @@
+// Measures how long reading a page of a loaded book takes while many
+// other books load in the background, to check that lookups don't
+// queue behind indexing threads adding books (or publishing their
+// pages) to the book table.  Prints latencies with nothing else going
+// on, then while BACKGROUND_BOOKS load; the two should be about the
+// same.
+
+extern crate bookindex;
+extern crate libc;
+
+#[allow(dead_code)]
+mod common;
+
+use std::ffi::CString;
+use std::sync::atomic::{AtomicBool, Ordering};
+use std::sync::Arc;
+use std::thread;
+use std::time::{Duration, Instant};
+
+const BACKGROUND_BOOKS: usize = 50;
+// Threads reading pages at once, each timing its own lookups.
+const READERS: usize = 2;
+// How long to time lookups for with nothing loading.
+const IDLE_TIME: Duration = Duration::from_millis(500);
+
+const FOREGROUND: u8 = 0;
+const BACKGROUND: u8 = 1;
+const ENCODING: &str = " A1B'K2L@CIF/MSP\"E3H9O6R^DJG>NTQ,*5<-U8V.%[$+X!&;:4\\0Z7(_?W]#Y)=\0";
+const WIDTH: u32 = 40;
+
+// Blocks until `count` loads have been reported on `fd`, returning how
+// many of them failed.
+fn wait_for_loads(fd: i32, count: usize) -> usize {
+    let mut failed = 0;
+    for _ in 0..count {
+        let mut record = [0u8; 8];
+        let len = unsafe { libc::read(fd, record.as_mut_ptr() as *mut libc::c_void, record.len()) };
+        assert_eq!(len, record.len() as isize, "completion read failed");
+        let status = i32::from_ne_bytes([record[4], record[5], record[6], record[7]]);
+        if status != 0 {
+            failed += 1;
+        }
+    }
+    failed
+}
+
+// Reads pages of `book` until `done`, returning how long each took.
+fn read_pages(book: u32, page_count: u32, done: &AtomicBool) -> Vec<Duration> {
+    let height = common::DISPLAY_LINES as u32;
+    let mut cells = vec![0u8; (WIDTH * height) as usize];
+    let mut latencies = Vec::new();
+    let mut page = 0;
+    while !done.load(Ordering::SeqCst) {
+        let start = Instant::now();
+        let count = bookindex::get_page_count(book);
+        let status = bookindex::get_page_cells(
+            book,
+            page,
+            ENCODING.as_ptr() as *const libc::c_char,
+            WIDTH,
+            height,
+            cells.as_mut_ptr(),
+        );
+        latencies.push(start.elapsed());
+        assert!(count > 0 && status >= 0, "reading page {} failed", page);
+        // Skip about, as a reader might.
+        page = (page + 7) % page_count;
+    }
+    latencies
+}
+
+// Times lookups by READERS threads until `until` returns.
+fn time_reads<F: FnOnce()>(book: u32, page_count: u32, until: F) -> Vec<Duration> {
+    let done = Arc::new(AtomicBool::new(false));
+    let readers: Vec<_> = (0..READERS)
+        .map(|_| {
+            let done = done.clone();
+            thread::spawn(move || read_pages(book, page_count, &done))
+        })
+        .collect();
+    until();
+    done.store(true, Ordering::SeqCst);
+    let mut latencies: Vec<Duration> = readers.into_iter().flat_map(|r| r.join().unwrap()).collect();
+    latencies.sort();
+    latencies
+}
+
+fn micros(duration: Duration) -> f64 {
+    duration.as_secs() as f64 * 1e6 + duration.subsec_nanos() as f64 / 1e3
+}
+
+fn report(what: &str, latencies: &[Duration]) {
+    if latencies.is_empty() {
+        println!("{}: no lookups", what);
+        return;
+    }
+    let at = |fraction: f64| micros(latencies[((latencies.len() - 1) as f64 * fraction) as usize]);
+    println!(
+        "{}: {} lookups, median {:.1} us, 99th percentile {:.1} us, max {:.1} us",
+        what,
+        latencies.len(),
+        at(0.5),
+        at(0.99),
+        at(1.0)
+    );
+}
+
+fn main() {
+    let bookpaths = common::bookpaths(|name| {
+        let name = name.to_lowercase();
+        name.ends_with(".brf") || name.ends_with(".pef")
+    });
+    if bookpaths.is_empty() {
+        println!("no books");
+        return;
+    }
+    let mut fds = [0; 2];
+    assert_eq!(unsafe { libc::pipe(fds.as_mut_ptr()) }, 0);
+    assert_eq!(bookindex::set_completion_fd(fds[1]), 0);
+    // As the UI does by default, making each load slower to finish.
+    bookindex::set_search_indexing(1);
+
+    let path = |bookpath: &String| CString::new(bookpath.as_str()).unwrap();
+    let book = bookindex::trigger_load(path(&bookpaths[0]).as_ptr(), common::DISPLAY_LINES, 0, FOREGROUND);
+    assert!(book > 0);
+    let book = book as u32;
+    assert_eq!(wait_for_loads(fds[0], 1), 0, "{} failed to load", bookpaths[0]);
+    // Read from its map, as the UI does the book being read.
+    assert_eq!(bookindex::set_current_book(book), 0);
+    let page_count = bookindex::get_page_count(book);
+    assert!(page_count > 0);
+    println!(
+        "reading {} ({} pages) with {} threads",
+        bookpaths[0], page_count, READERS
+    );
+
+    let idle = time_reads(book, page_count as u32, || thread::sleep(IDLE_TIME));
+    report("idle", &idle);
+
+    // Each path and number of lines is a book of its own, so cycle
+    // through the books with ever more lines until there are enough.
+    let start = Instant::now();
+    let loading = time_reads(book, page_count as u32, || {
+        for n in 0..BACKGROUND_BOOKS {
+            let lines = common::DISPLAY_LINES + 1 + (n / bookpaths.len()) as u8;
+            let bookpath = path(&bookpaths[n % bookpaths.len()]);
+            assert!(bookindex::trigger_load(bookpath.as_ptr(), lines, 1 + n as u32, BACKGROUND) > 0);
+        }
+        let failed = wait_for_loads(fds[0], BACKGROUND_BOOKS);
+        if failed > 0 {
+            println!("{} background loads failed", failed);
+        }
+    });
+    let elapsed = start.elapsed();
+    report(
+        &format!("while loading {} books ({:.1} s)", BACKGROUND_BOOKS, micros(elapsed) / 1e6),
+        &loading,
+    );
+}
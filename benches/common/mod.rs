@@ -0,0 +1,102 @@
+// Shared by the indexing benches, each of which compares an indexer
+// against the one it replaced over a set of books, checking that both
+// find the same pages.
+
+use std::env;
+use std::fs;
+use std::process;
+use std::time::{Duration, Instant};
+
+pub const DISPLAY_LINES: u8 = 9;
+
+// Index each book for at least this long, to smooth out timings.
+const MIN_TIME: Duration = Duration::from_millis(500);
+
+// An indexer, returning a book's page count.
+pub type Indexer = fn(&String, u8) -> Option<usize>;
+
+// Returns the page count and the throughput in MB/s.
+fn time(index: Indexer, bookpath: &String, size: u64) -> Option<(usize, f64)> {
+    let start = Instant::now();
+    let mut runs = 0;
+    let mut pages;
+    loop {
+        pages = index(bookpath, DISPLAY_LINES)?;
+        runs += 1;
+        if start.elapsed() >= MIN_TIME {
+            break;
+        }
+    }
+    let elapsed = start.elapsed();
+    let secs = elapsed.as_secs() as f64 + elapsed.subsec_nanos() as f64 / 1e9;
+    Some((pages, (size * runs) as f64 / 1e6 / secs))
+}
+
+// The books named on the command line, or else those under books/ that
+// `wanted` picks out by file name.
+pub fn bookpaths(wanted: fn(&str) -> bool) -> Vec<String> {
+    // `cargo bench` passes --bench.
+    let mut bookpaths: Vec<String> = env::args().skip(1).filter(|a| !a.starts_with("--")).collect();
+    if bookpaths.is_empty() {
+        if let Ok(entries) = fs::read_dir("books") {
+            bookpaths = entries
+                .filter_map(|e| e.ok())
+                .filter(|e| wanted(&e.file_name().to_string_lossy()))
+                .map(|e| e.path().to_string_lossy().into_owned())
+                .collect();
+        }
+        bookpaths.sort();
+    }
+    bookpaths
+}
+
+// Times `new` against `old` over `bookpaths`, printing the throughput
+// of each; exits with failure if they ever disagree.
+pub fn compare(old: Indexer, new: Indexer, bookpaths: &[String]) {
+    let (mut total_size, mut old_secs, mut new_secs) = (0, 0.0, 0.0);
+    let mut mismatches = 0;
+    for bookpath in bookpaths {
+        let size = match fs::metadata(bookpath) {
+            Ok(metadata) => metadata.len(),
+            Err(_) => continue,
+        };
+        let new = time(new, bookpath, size);
+        let old = time(old, bookpath, size);
+        match (old, new) {
+            (Some((old_pages, old_rate)), Some((new_pages, new_rate))) => {
+                println!(
+                    "{}: {} pages, old {:.0} MB/s, new {:.0} MB/s{}",
+                    bookpath,
+                    new_pages,
+                    old_rate,
+                    new_rate,
+                    if old_pages != new_pages { ", MISMATCH" } else { "" }
+                );
+                if old_pages != new_pages {
+                    mismatches += 1;
+                }
+                total_size += size;
+                old_secs += size as f64 / 1e6 / old_rate;
+                new_secs += size as f64 / 1e6 / new_rate;
+            }
+            (None, Some((new_pages, new_rate))) => {
+                println!("{}: {} pages, old failed, new {:.0} MB/s", bookpath, new_pages, new_rate);
+            }
+            _ => println!("{}: failed to index", bookpath),
+        }
+    }
+    if total_size > 0 {
+        let total_mb = total_size as f64 / 1e6;
+        println!(
+            "total: {:.1} MB, old {:.0} MB/s, new {:.0} MB/s, speedup {:.1}x, {} mismatches",
+            total_mb,
+            total_mb / old_secs,
+            total_mb / new_secs,
+            old_secs / new_secs,
+            mismatches
+        );
+    }
+    if mismatches > 0 {
+        process::exit(1);
+    }
+}
@@ -0,0 +1,49 @@
+// Compares the throughput of BRF indexing against the line-at-a-time
+// indexer it replaced, checking that both find the same pages.
+
+extern crate bookindex;
+
+mod common;
+
+use std::fs::File;
+use std::io::{BufRead, BufReader};
+
+// The original indexer, which reads a line at a time into a String and
+// so fails on anything that isn't UTF-8.  Returns the page count.
+fn index_by_line(bookpath: &String, display_lines: u8) -> Option<usize> {
+    let mut br = BufReader::new(File::open(bookpath).ok()?);
+    let mut line = String::new();
+    let mut lines_in_cur_page = 0;
+    let mut cur_page_first = 0;
+    let mut cur_page_length = 0;
+    let mut starts = Vec::new();
+    loop {
+        line.clear();
+        let line_length = br.read_line(&mut line).ok()?;
+        if line_length == 0 {
+            break;
+        }
+        let form_feed = line.starts_with("\x0C");
+        if (form_feed && lines_in_cur_page > 0) || lines_in_cur_page == display_lines {
+            starts.push(cur_page_first);
+            cur_page_first += cur_page_length;
+            cur_page_length = 0;
+            lines_in_cur_page = 0;
+            if form_feed {
+                cur_page_first += 1;
+                cur_page_length -= 1;
+            }
+        }
+        cur_page_length += line_length as i64;
+        lines_in_cur_page += 1;
+    }
+    if lines_in_cur_page > 0 {
+        starts.push(cur_page_first);
+    }
+    Some(starts.len())
+}
+
+fn main() {
+    let bookpaths = common::bookpaths(|name| name.to_lowercase().ends_with(".brf"));
+    common::compare(index_by_line, bookindex::index_only, &bookpaths);
+}
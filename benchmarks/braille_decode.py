@@ -0,0 +1,79 @@
+"""
+Compare converting the lines of some books to pin numbers a character at
+a time against converting them a line at a time, checking that both agree:
+alpha_to_pin_num against from_ascii for BRF, and unicode_to_pin_num
+against from_unicode and from_unicode_lines (a page at a time) for the
+rows of PEF.
+
+Run from the top of the tree:
+
+    python3 -m benchmarks.braille_decode [BOOK ...]
+
+With no arguments, all books under books/ are used.
+"""
+import glob
+import os
+import re
+import sys
+import time
+
+from ui import braille
+
+HEIGHT = 9
+
+PEF_ROW = re.compile(r'<row\b[^>]*>(.*?)</row>', re.DOTALL)
+
+
+def book_lines(filename):
+    # as the Python page decoder gets them, near enough
+    with open(filename, 'rb') as f:
+        text = str(f.read(), 'utf8', errors='replace')
+    if os.path.splitext(filename)[-1].lower() == '.brf':
+        return text.splitlines()
+    return PEF_ROW.findall(text)
+
+
+def bench(what, convert, items, cells):
+    start = time.perf_counter()
+    converted = [convert(item) for item in items]
+    elapsed = time.perf_counter() - start
+    print(f'{what}: {elapsed * 1e3:.1f} ms, {elapsed * 1e9 / max(1, cells):.1f} ns/cell')
+    return converted, elapsed
+
+
+def compare(name, old, new, lines, pages=None):
+    """Time `old` and `new` converting `lines`, returning whether they agree."""
+    cells = sum(len(line) for line in lines)
+    print(f'{name}: {len(lines)} lines, {cells} cells')
+    old_lines, old_time = bench(old.__name__, lambda line: tuple(map(old, line)), lines, cells)
+    new_lines, new_time = bench(new.__name__, new, lines, cells)
+    print(f'{new.__name__} is {old_time / max(1e-9, new_time):.1f}x faster')
+    ok = old_lines == new_lines
+    if pages is not None:
+        new_pages, page_time = bench(pages.__name__, pages, [
+            lines[i:i + HEIGHT] for i in range(0, len(lines), HEIGHT)], cells)
+        print(f'{pages.__name__} is {old_time / max(1e-9, page_time):.1f}x faster')
+        ok = ok and [line for page in new_pages for line in page] == old_lines
+    if not ok:
+        print('MISMATCH')
+    return ok
+
+
+def main(filenames):
+    filenames = filenames or sorted(glob.glob('books/*'))
+    brf = []
+    pef = []
+    for filename in filenames:
+        ext = os.path.splitext(filename)[-1].lower()
+        if ext == '.brf':
+            brf.extend(book_lines(filename))
+        elif ext == '.pef':
+            pef.extend(book_lines(filename))
+    ok = compare('BRF', braille.alpha_to_pin_num, braille.from_ascii, brf)
+    return compare('PEF', braille.unicode_to_pin_num, braille.from_unicode, pef,
+                   braille.from_unicode_lines) and ok
+
+
+if __name__ == '__main__':
+    if not main(sys.argv[1:]):
+        sys.exit(1)
@@ -0,0 +1,69 @@
+"""
+Compare decoding every page of some books natively (get_page_cells)
+against decoding them in Python, checking that both agree.
+
+Run from the top of the tree with the extension on the library path:
+
+    LD_LIBRARY_PATH=. python3 -m benchmarks.page_decode [BOOK ...]
+
+With no arguments, all books under books/ are used.
+"""
+import asyncio
+import glob
+import sys
+import time
+
+from ui.book.book_file import BookFile, LoadState
+from ui.book.handlers import _read_pages2, _decode_page_natively, _read_page
+
+
+WIDTH = 40
+HEIGHT = 9
+
+
+def normalise(lines):
+    """Pad and clip a page as the display would."""
+    return tuple((tuple(line) + (0,) * WIDTH)[:WIDTH] for line in lines[:HEIGHT])
+
+
+async def bench_book(filename):
+    book = await _read_pages2(BookFile(filename, WIDTH, HEIGHT))
+    if book.load_state != LoadState.DONE:
+        return None
+    pages = range(book.num_pages)
+
+    start = time.perf_counter()
+    native = [_decode_page_natively(book, page) for page in pages]
+    native_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    python = [await _read_page(book, page) for page in pages]
+    python_time = time.perf_counter() - start
+
+    mismatches = sum(normalise(n) != normalise(p) for n, p in zip(native, python))
+    return book.num_pages, native_time, python_time, mismatches
+
+
+async def main(filenames):
+    totals = [0, 0.0, 0.0, 0]
+    for filename in filenames:
+        result = await bench_book(filename)
+        if result is None:
+            print(f'{filename}: failed to load')
+            continue
+        pages, native_time, python_time, mismatches = result
+        print(f'{filename}: {pages} pages, native {pages / native_time:.0f} pages/s, '
+              f'python {pages / python_time:.0f} pages/s, {mismatches} mismatches')
+        totals = [t + r for t, r in zip(totals, result)]
+    pages, native_time, python_time, mismatches = totals
+    if pages:
+        print(f'total: {pages} pages, native {pages / native_time:.0f} pages/s, '
+              f'python {pages / python_time:.0f} pages/s, '
+              f'speedup {python_time / native_time:.1f}x, {mismatches} mismatches')
+    return mismatches == 0
+
+
+if __name__ == '__main__':
+    filenames = sys.argv[1:] or sorted(glob.glob('books/*'))
+    if not asyncio.run(main(filenames)):
+        sys.exit(1)
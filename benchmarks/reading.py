@@ -0,0 +1,160 @@
+"""
+Time loading books (_read_pages2) and fetching every page of them
+(get_page_data), the work behind booting and turning pages, and compare
+the results against a baseline to catch regressions.
+
+Run from the top of the tree with the extension on the library path:
+
+    LD_LIBRARY_PATH=. python3 -m benchmarks.reading [--json FILE] [BOOK ...]
+
+With no books given, all of those under books/ and tests/test-books are
+used.  Results are compared with benchmarks/baseline.json, failing if
+any book's page count differs or, on the kind of machine the baseline
+was recorded on (an x86 development box), if either total time is more
+than --tolerance slower; pass --save-baseline to replace it with these
+results.  Timings depend on the machine, so on any other they're only
+reported.
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import platform
+import sys
+import time
+
+from ui.book.book_file import BookFile, LoadState
+from ui.book.handlers import _read_pages2, get_page_data, set_page_cache_limit
+from ui.book import indexer
+
+
+WIDTH = 40
+HEIGHT = 9
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+async def bench_book(filename, repeat):
+    """
+    Returns the page count of `filename`, the quickest of `repeat` loads
+    in ms and the quickest of `repeat` passes over its pages in µs per
+    page, or None if it fails to load.
+    """
+    book = BookFile(filename, WIDTH, HEIGHT)
+    load_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        loaded = await _read_pages2(book)
+        load_times.append(time.perf_counter() - start)
+        if loaded.load_state != LoadState.DONE:
+            return None
+        if len(load_times) < repeat:
+            indexer.unload_book(loaded.handle)
+
+    page_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for page in range(loaded.num_pages):
+            await get_page_data(loaded, None, page_number=page)
+        page_times.append(time.perf_counter() - start)
+    indexer.unload_book(loaded.handle)
+    return loaded.num_pages, min(load_times) * 1e3, min(page_times) * 1e6 / loaded.num_pages
+
+
+async def run(filenames, repeat):
+    books = {}
+    for filename in filenames:
+        result = await bench_book(filename, repeat)
+        if result is None:
+            print(f'{filename}: failed to load')
+            books[filename] = None
+            continue
+        pages, load_ms, page_us = result
+        print(f'{filename}: {pages} pages, load {load_ms:.2f} ms, {page_us:.1f} µs/page')
+        books[filename] = {'pages': pages, 'load_ms': load_ms, 'page_us': page_us}
+    loaded = [result for result in books.values() if result is not None]
+    pages = sum(result['pages'] for result in loaded)
+    total = {
+        'pages': pages,
+        'load_ms': sum(result['load_ms'] for result in loaded),
+        'page_us': sum(result['page_us'] * result['pages'] for result in loaded) / max(1, pages),
+    }
+    print(f'total: {pages} pages, load {total["load_ms"]:.1f} ms, '
+          f'{total["page_us"]:.1f} µs/page')
+    return {
+        'machine': platform.machine(),
+        'python': platform.python_version(),
+        'repeat': repeat,
+        'books': books,
+        'total': total,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints how `results` compare with `baseline` and returns whether
+    they're within `tolerance` of it.  Timings are only checked if
+    they're from the same kind of machine as the baseline.
+    """
+    ok = True
+    timed = baseline['machine'] == results['machine']
+    if not timed:
+        print(f'warning: baseline is from {baseline["machine"]}, '
+              f'not {results["machine"]}, so timings are not checked')
+    for filename, result in results['books'].items():
+        expected = baseline['books'].get(filename)
+        if filename not in baseline['books']:
+            continue
+        pages = result and result['pages']
+        expected_pages = expected and expected['pages']
+        if pages != expected_pages:
+            print(f'{filename}: {pages} pages, baseline {expected_pages}')
+            ok = False
+    for key, what in (('load_ms', 'load time'), ('page_us', 'time per page')):
+        ratio = results['total'][key] / max(1e-9, baseline['total'][key])
+        verdict = 'ok'
+        if ratio > 1 + tolerance:
+            verdict = 'REGRESSION' if timed else 'slower'
+            ok = ok and not timed
+        print(f'{what}: {ratio:.2f}x baseline, {verdict}')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('books', nargs='*', metavar='BOOK')
+    parser.add_argument('--json', metavar='FILE', help='write results to FILE')
+    parser.add_argument('--baseline', default=BASELINE, metavar='FILE',
+                        help='compare with FILE (default: %(default)s)')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='write results to the baseline instead of comparing')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='fraction slower than the baseline allowed (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='times to repeat each measurement, keeping the quickest')
+    args = parser.parse_args()
+    # time decoding pages, not finding them already decoded
+    set_page_cache_limit(0)
+
+    filenames = args.books or sorted(
+        filename for filename in glob.glob('books/*') + glob.glob('tests/test-books/*')
+        if os.path.splitext(filename)[-1].lower() in ('.brf', '.pef'))
+    results = asyncio.run(run(filenames, args.repeat))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        return True
+    if not os.path.exists(args.baseline):
+        print(f'no baseline at {args.baseline}')
+        return True
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    return compare(results, baseline, args.tolerance)
+
+
+if __name__ == '__main__':
+    if not main():
+        sys.exit(1)
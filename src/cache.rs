@@ -0,0 +1,289 @@
+// A persistent on-disk cache of book indices, so that a restart doesn't
+// have to re-scan every book before page counts are known.
+//
+// There's one cache file per (book, display lines) pair, named after a
+// hash of both, so that a lookup only ever reads the one file it needs.
+// Entries are keyed on the book's path, size, mtime and the number of
+// display lines; if any of those differ the entry is stale and the book
+// gets re-indexed (and the entry rewritten).  Entries are also
+// checksummed, so a truncated or otherwise corrupt file is detected
+// and rebuilt rather than believed.
+//
+// Layout (all integers little-endian):
+//
+//  magic         8 bytes, "CNTIDX\0\0"
+//  version       u32, FORMAT_VERSION
+//  lines         u8
+//  start_width   u8, 4 or 8, bytes per page start
+//  row_width     u8, 4 or 8, bytes per row bound
+//  (padding)     1 byte, zero
+//  size          u64, book file size in bytes
+//  mtime_sec     i64
+//  mtime_nsec    u32
+//  path_len      u32
+//  start_count   u32
+//  row_count     u32, the number of row bounds (two per row)
+//  path          path_len bytes of UTF-8
+//  page_starts   start_count * start_width bytes
+//  row_bounds    row_count * row_width bytes
+//  checksum      u64, FNV-1a of everything above
+//
+// Bump FORMAT_VERSION whenever the layout changes; older entries will
+// then be treated as corrupt and rebuilt.
+
+use std::fs;
+use std::fs::File;
+use std::io::{Read, Write};
+use std::os::unix::fs::MetadataExt;
+use std::path::PathBuf;
+use std::sync::atomic::{AtomicUsize, Ordering};
+use std::sync::Mutex;
+
+use starts::{Index, PageStarts};
+
+const MAGIC: &[u8; 8] = b"CNTIDX\0\0";
+const FORMAT_VERSION: u32 = 4;
+const HEADER_LEN: usize = 8 + 4 + 4 + 8 + 8 + 4 + 4 + 4 + 4;
+const CHECKSUM_LEN: usize = 8;
+
+static HITS: AtomicUsize = AtomicUsize::new(0);
+static MISSES: AtomicUsize = AtomicUsize::new(0);
+static INVALID: AtomicUsize = AtomicUsize::new(0);
+// Distinguishes temporary files written concurrently by different
+// workers.
+static TMP_SEQ: AtomicUsize = AtomicUsize::new(0);
+
+lazy_static! {
+    static ref CACHE_DIR: Mutex<Option<PathBuf>> = Mutex::new(None);
+}
+
+// Just for FFI to return all counters at once.
+#[repr(C)]
+pub struct CacheStats {
+    hits: u32,
+    misses: u32,
+    invalid: u32,
+}
+
+// Identifies the version of a book that an index was built from.
+#[derive(Eq, PartialEq, Debug, Copy, Clone)]
+pub struct BookKey {
+    size: u64,
+    mtime_sec: i64,
+    mtime_nsec: u32,
+    lines: u8,
+}
+
+impl BookKey {
+    pub fn for_book(bookpath: &str, lines: u8) -> Option<BookKey> {
+        let meta = fs::metadata(bookpath).ok()?;
+        Some(BookKey {
+            size: meta.len(),
+            mtime_sec: meta.mtime(),
+            mtime_nsec: meta.mtime_nsec() as u32,
+            lines: lines,
+        })
+    }
+}
+
+pub fn set_dir(dir: &str) -> Result<(), i32> {
+    if dir.is_empty() {
+        *CACHE_DIR.lock().unwrap() = None;
+        return Ok(());
+    }
+    let path = PathBuf::from(dir);
+    if let Err(e) = fs::create_dir_all(&path) {
+        return Err(-e.raw_os_error().unwrap_or(::libc::EIO));
+    }
+    *CACHE_DIR.lock().unwrap() = Some(path);
+    Ok(())
+}
+
+pub fn stats() -> CacheStats {
+    CacheStats {
+        hits: HITS.load(Ordering::Relaxed) as u32,
+        misses: MISSES.load(Ordering::Relaxed) as u32,
+        invalid: INVALID.load(Ordering::Relaxed) as u32,
+    }
+}
+
+// Returns the cached index for `bookpath` if there is one and it's
+// still valid for `key`.  Always returns None if no cache directory has
+// been set.
+pub fn load(bookpath: &str, key: &BookKey) -> Option<Index> {
+    let entry = entry_path(bookpath, key.lines)?;
+    let mut buf = Vec::new();
+    let read = File::open(&entry).and_then(|mut f| f.read_to_end(&mut buf));
+    if read.is_err() {
+        MISSES.fetch_add(1, Ordering::Relaxed);
+        return None;
+    }
+    match decode(&buf, bookpath, key) {
+        Some(index) => {
+            HITS.fetch_add(1, Ordering::Relaxed);
+            Some(index)
+        }
+        None => {
+            MISSES.fetch_add(1, Ordering::Relaxed);
+            INVALID.fetch_add(1, Ordering::Relaxed);
+            None
+        }
+    }
+}
+
+// Writes `index` to the cache, replacing any existing entry.  Failure
+// is not fatal (the book just gets indexed again next time) so is only
+// reported.
+pub fn store(bookpath: &str, key: &BookKey, index: &Index) {
+    let entry = match entry_path(bookpath, key.lines) {
+        Some(entry) => entry,
+        None => return,
+    };
+    let buf = encode(bookpath, key, index);
+    // Write then rename, so that readers never see a partial entry
+    // (not that they'd believe one, given the checksum).
+    let tmp = entry.with_extension(format!(
+        "tmp.{}.{}",
+        unsafe { ::libc::getpid() },
+        TMP_SEQ.fetch_add(1, Ordering::Relaxed)
+    ));
+    let written = File::create(&tmp)
+        .and_then(|mut f| f.write_all(&buf))
+        .and_then(|_| fs::rename(&tmp, &entry));
+    if let Err(e) = written {
+        println!("failed to cache index for {}: {}", bookpath, e);
+        let _ = fs::remove_file(&tmp);
+    }
+}
+
+fn entry_path(bookpath: &str, lines: u8) -> Option<PathBuf> {
+    let dir = CACHE_DIR.lock().unwrap();
+    let dir = dir.as_ref()?;
+    let mut hash = fnv1a(FNV_OFFSET, bookpath.as_bytes());
+    hash = fnv1a(hash, &[lines]);
+    Some(dir.join(format!("{:016x}.idx", hash)))
+}
+
+fn encode(bookpath: &str, key: &BookKey, index: &Index) -> Vec<u8> {
+    let path = bookpath.as_bytes();
+    let starts = &index.page_starts;
+    let rows = &index.row_bounds;
+    let mut buf = Vec::with_capacity(
+        HEADER_LEN + path.len() + starts.len() * starts.width() + rows.len() * rows.width()
+            + CHECKSUM_LEN,
+    );
+    buf.extend_from_slice(MAGIC);
+    put_u32(&mut buf, FORMAT_VERSION);
+    buf.extend_from_slice(&[key.lines, starts.width() as u8, rows.width() as u8, 0]);
+    put_u64(&mut buf, key.size);
+    put_u64(&mut buf, key.mtime_sec as u64);
+    put_u32(&mut buf, key.mtime_nsec);
+    put_u32(&mut buf, path.len() as u32);
+    put_u32(&mut buf, starts.len() as u32);
+    put_u32(&mut buf, rows.len() as u32);
+    buf.extend_from_slice(path);
+    put_offsets(&mut buf, starts);
+    put_offsets(&mut buf, rows);
+    let checksum = fnv1a(FNV_OFFSET, &buf);
+    put_u64(&mut buf, checksum);
+    buf
+}
+
+fn decode(buf: &[u8], bookpath: &str, key: &BookKey) -> Option<Index> {
+    if buf.len() < HEADER_LEN + CHECKSUM_LEN {
+        return None;
+    }
+    let (body, checksum) = buf.split_at(buf.len() - CHECKSUM_LEN);
+    if get_u64(checksum, 0) != fnv1a(FNV_OFFSET, body) {
+        return None;
+    }
+    if &body[0..8] != MAGIC || get_u32(body, 8) != FORMAT_VERSION {
+        return None;
+    }
+    let stored = BookKey {
+        lines: body[12],
+        size: get_u64(body, 16),
+        mtime_sec: get_u64(body, 24) as i64,
+        mtime_nsec: get_u32(body, 32),
+    };
+    let start_width = body[13] as usize;
+    let row_width = body[14] as usize;
+    let path_len = get_u32(body, 36) as usize;
+    let start_count = get_u32(body, 40) as usize;
+    let row_count = get_u32(body, 44) as usize;
+    if (start_width != 4 && start_width != 8) || (row_width != 4 && row_width != 8) {
+        return None;
+    }
+    // There's always at least the end of the last page.
+    if start_count == 0
+        || body.len() != HEADER_LEN + path_len + start_count * start_width + row_count * row_width
+    {
+        return None;
+    }
+    // Guard against hash collisions as well as changed books.
+    if stored != *key || &body[HEADER_LEN..HEADER_LEN + path_len] != bookpath.as_bytes() {
+        return None;
+    }
+    let starts = &body[HEADER_LEN + path_len..];
+    let rows = &starts[start_count * start_width..];
+    Some(Index {
+        page_starts: get_offsets(starts, start_count, start_width),
+        row_bounds: get_offsets(rows, row_count, row_width),
+    })
+}
+
+fn put_offsets(buf: &mut Vec<u8>, offsets: &PageStarts) {
+    match *offsets {
+        PageStarts::Narrow(ref offsets) => {
+            for &offset in offsets {
+                put_u32(buf, offset);
+            }
+        }
+        PageStarts::Wide(ref offsets) => {
+            for &offset in offsets {
+                put_u64(buf, offset);
+            }
+        }
+    }
+}
+
+fn get_offsets(buf: &[u8], count: usize, width: usize) -> PageStarts {
+    if width == 4 {
+        PageStarts::Narrow((0..count).map(|i| get_u32(buf, i * 4)).collect())
+    } else {
+        PageStarts::Wide((0..count).map(|i| get_u64(buf, i * 8)).collect())
+    }
+}
+
+const FNV_OFFSET: u64 = 0xcbf29ce484222325;
+const FNV_PRIME: u64 = 0x100000001b3;
+
+// Deliberately not std's DefaultHasher, whose output isn't guaranteed
+// to be stable between Rust releases.
+fn fnv1a(mut hash: u64, bytes: &[u8]) -> u64 {
+    for &b in bytes {
+        hash ^= b as u64;
+        hash = hash.wrapping_mul(FNV_PRIME);
+    }
+    hash
+}
+
+fn put_u32(buf: &mut Vec<u8>, v: u32) {
+    for i in 0..4 {
+        buf.push((v >> (8 * i)) as u8);
+    }
+}
+
+fn put_u64(buf: &mut Vec<u8>, v: u64) {
+    for i in 0..8 {
+        buf.push((v >> (8 * i)) as u8);
+    }
+}
+
+fn get_u32(buf: &[u8], pos: usize) -> u32 {
+    (0..4).fold(0, |v, i| v | (buf[pos + i] as u32) << (8 * i))
+}
+
+fn get_u64(buf: &[u8], pos: usize) -> u64 {
+    (0..8).fold(0, |v, i| v | (buf[pos + i] as u64) << (8 * i))
+}
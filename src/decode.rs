@@ -0,0 +1,199 @@
+// Decoding of raw page content into display cells, each a 6-dot Braille
+// pin number (dot 1 is bit 0 through dot 6 at bit 5).
+//
+// This mirrors what the Python reader does with a page's bytes, so the
+// two must be kept in step:
+//
+//  * BRF is split into lines as by Python's str.splitlines() and each
+//    character looked up in the current encoding, with lower case
+//    folded to upper case and unknown characters becoming blank cells
+//  * for PEF the content of each <row> (or <row/>), as found by the
+//    indexer, becomes a line, with each Unicode Braille character
+//    converted directly; any markup within a row is skipped, other
+//    than the content of CDATA sections
+//
+// Lines are then clipped or padded to the display width, and the page
+// clipped or padded with blank lines to the display height.  Decoding
+// feeds cells to anything that takes Lines, though, not just a Grid, so
+// that searching (see search.rs) decodes exactly as display does.
+
+use std::ops::Range;
+
+// The number of characters in an encoding: one per 6-dot cell.
+pub const ENCODING_LEN: usize = 64;
+
+const UNICODE_BRAILLE_BASE: u32 = 0x2800;
+
+// Maps a byte to its cell; only ASCII can ever map to a non-blank cell.
+pub struct EncodingTable([u8; 256]);
+
+impl EncodingTable {
+    // `mapping` is the encoding's characters in cell order.  Returns
+    // None unless it's exactly ENCODING_LEN ASCII characters.
+    pub fn new(mapping: &[u8]) -> Option<EncodingTable> {
+        if mapping.len() != ENCODING_LEN || !mapping.is_ascii() {
+            return None;
+        }
+        let mut table = [0u8; 256];
+        let mut seen = [false; 128];
+        for (cell, &c) in mapping.iter().enumerate() {
+            // Some encodings repeat a character; the first cell wins,
+            // as it does for Python's str.index().
+            if !seen[c as usize] {
+                seen[c as usize] = true;
+                table[c as usize] = cell as u8;
+            }
+        }
+        // Fold lower case (and `{|}~) onto upper case (and @[\]^), as
+        // some translation software produces them instead.
+        for c in 0x60..0x80 {
+            table[c] = table[c - 0x20];
+        }
+        Some(EncodingTable(table))
+    }
+
+    fn cell(&self, c: char) -> u8 {
+        if c.is_ascii() {
+            self.0[c as usize]
+        } else {
+            0
+        }
+    }
+
+    // The cell a single byte decodes to, which is blank for any byte
+    // outside ASCII.
+    pub fn byte_cell(&self, b: u8) -> u8 {
+        self.0[b as usize]
+    }
+}
+
+// Where decoded cells go, a line at a time.
+pub trait Lines {
+    fn push(&mut self, cell: u8);
+    fn end_line(&mut self);
+    // Whether no more lines are wanted.
+    fn full(&self) -> bool;
+}
+
+// Writes lines into a width * height grid of cells.
+pub struct Grid<'a> {
+    cells: &'a mut [u8],
+    width: usize,
+    line: usize,
+    col: usize,
+}
+
+impl<'a> Grid<'a> {
+    pub fn new(cells: &'a mut [u8], width: usize) -> Grid<'a> {
+        for cell in cells.iter_mut() {
+            *cell = 0;
+        }
+        Grid {
+            cells: cells,
+            width: width,
+            line: 0,
+            col: 0,
+        }
+    }
+}
+
+impl<'a> Lines for Grid<'a> {
+    fn full(&self) -> bool {
+        self.line * self.width >= self.cells.len()
+    }
+
+    fn push(&mut self, cell: u8) {
+        if self.col < self.width && !self.full() {
+            self.cells[self.line * self.width + self.col] = cell;
+        }
+        self.col += 1;
+    }
+
+    fn end_line(&mut self) {
+        self.line += 1;
+        self.col = 0;
+    }
+}
+
+// The line boundaries recognised by Python's str.splitlines(), apart
+// from "\r\n" which is handled specially.
+fn is_line_boundary(c: char) -> bool {
+    match c {
+        '\n' | '\r' | '\x0b' | '\x0c' | '\x1c' | '\x1d' | '\x1e' | '\u{85}' | '\u{2028}'
+        | '\u{2029}' => true,
+        _ => false,
+    }
+}
+
+pub fn brf_cells<L: Lines>(page: &[u8], table: &EncodingTable, out: &mut L) {
+    let mut page = String::from_utf8_lossy(page);
+    // The form feed ending a page, if any, is included in it.
+    if page.ends_with('\x0c') {
+        page.to_mut().pop();
+    }
+    let mut chars = page.chars().peekable();
+    while let Some(c) = chars.next() {
+        if out.full() {
+            break;
+        }
+        if is_line_boundary(c) {
+            if c == '\r' && chars.peek() == Some(&'\n') {
+                chars.next();
+            }
+            out.end_line();
+        } else {
+            out.push(table.cell(c));
+        }
+    }
+}
+
+fn unicode_to_cell(c: char) -> u8 {
+    let c = c as u32;
+    if c < UNICODE_BRAILLE_BASE {
+        0
+    } else {
+        // 8-dot patterns saturate, as they do in the Python.
+        (c - UNICODE_BRAILLE_BASE).min(0x3f) as u8
+    }
+}
+
+// `rows` are where the content of each row lies within `page`.
+pub fn pef_cells<L: Lines>(page: &[u8], rows: &[Range<usize>], out: &mut L) {
+    for row in rows {
+        if out.full() {
+            break;
+        }
+        let row = String::from_utf8_lossy(page.get(row.clone()).unwrap_or(&[]));
+        let mut rest: &str = &row;
+        while let Some(lt) = rest.find('<') {
+            push_unicode(out, &rest[..lt]);
+            rest = &rest[lt..];
+            let (content, terminator) = if rest.starts_with(CDATA_OPEN) {
+                rest = &rest[CDATA_OPEN.len()..];
+                (true, CDATA_CLOSE)
+            } else if rest.starts_with(COMMENT_OPEN) {
+                (false, COMMENT_CLOSE)
+            } else {
+                (false, ">")
+            };
+            let end = rest.find(terminator).unwrap_or(rest.len());
+            if content {
+                push_unicode(out, &rest[..end]);
+            }
+            rest = &rest[(end + terminator.len()).min(rest.len())..];
+        }
+        push_unicode(out, rest);
+        out.end_line();
+    }
+}
+
+const CDATA_OPEN: &str = "<![CDATA[";
+const CDATA_CLOSE: &str = "]]>";
+const COMMENT_OPEN: &str = "<!--";
+const COMMENT_CLOSE: &str = "-->";
+
+fn push_unicode<L: Lines>(out: &mut L, text: &str) {
+    for c in text.chars() {
+        out.push(unicode_to_cell(c));
+    }
+}
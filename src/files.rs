@@ -0,0 +1,164 @@
+// Open files of the books whose pages were most recently read from disk
+// (rather than from a map), so that turning a page of a book that isn't
+// mapped needn't open it again.
+//
+// Pages are read with pread(), so one file serves any number of reads
+// at once without a seek, and reads go on outside the lock.  A file
+// evicted or forgotten mid-read stays open until the read is done, as
+// each read holds a reference to it.
+//
+// Books are only ever replaced wholesale, so a file is kept until its
+// book is reloaded or unloaded, or a read from it fails (as when its
+// media is removed), and is opened afresh the next time.
+
+use std::fs::File;
+use std::io;
+use std::os::unix::fs::FileExt;
+use std::sync::{Arc, Mutex};
+
+use Handle;
+
+// How many books to keep open at once.
+const MAX_OPEN: usize = 4;
+
+lazy_static! {
+    static ref FILES: OpenFiles = OpenFiles::new(MAX_OPEN);
+}
+
+// Fills `buf` from `offset` of `bookpath`, the file of `book`.
+pub fn read_exact_at(book: Handle, bookpath: &str, buf: &mut [u8], offset: u64) -> io::Result<()> {
+    FILES.read_exact_at(book, bookpath, buf, offset)
+}
+
+// Closes the file of `book`, if open, as it may have been replaced.
+pub fn forget(book: Handle) {
+    FILES.forget(book)
+}
+
+struct OpenFiles {
+    // By book, least recently read first.
+    open: Mutex<Vec<(Handle, Arc<File>)>>,
+    max_open: usize,
+}
+
+impl OpenFiles {
+    fn new(max_open: usize) -> OpenFiles {
+        OpenFiles {
+            open: Mutex::new(Vec::new()),
+            max_open: max_open,
+        }
+    }
+
+    fn read_exact_at(&self, book: Handle, bookpath: &str, buf: &mut [u8], offset: u64) -> io::Result<()> {
+        let file = self.open(book, bookpath)?;
+        let result = file.read_exact_at(buf, offset);
+        if result.is_err() {
+            let mut open = self.open.lock().unwrap();
+            // Unless it's already been replaced.
+            if let Some(i) = open.iter().position(|&(_, ref f)| Arc::ptr_eq(f, &file)) {
+                open.remove(i);
+            }
+        }
+        result
+    }
+
+    fn open(&self, book: Handle, bookpath: &str) -> io::Result<Arc<File>> {
+        {
+            let mut open = self.open.lock().unwrap();
+            if let Some(i) = open.iter().position(|&(handle, _)| handle == book) {
+                let entry = open.remove(i);
+                let file = entry.1.clone();
+                open.push(entry);
+                return Ok(file);
+            }
+        }
+        // Opened outside the lock, as that can be slow on removable media.
+        let file = Arc::new(File::open(bookpath)?);
+        let evicted = {
+            let mut open = self.open.lock().unwrap();
+            // Another read may have opened it meanwhile.
+            open.retain(|&(handle, _)| handle != book);
+            open.push((book, file.clone()));
+            let excess = open.len().saturating_sub(self.max_open);
+            open.drain(..excess).collect::<Vec<_>>()
+        };
+        // Closed outside the lock.
+        drop(evicted);
+        Ok(file)
+    }
+
+    fn forget(&self, book: Handle) {
+        let forgotten = {
+            let mut open = self.open.lock().unwrap();
+            match open.iter().position(|&(handle, _)| handle == book) {
+                Some(i) => Some(open.remove(i)),
+                None => None,
+            }
+        };
+        drop(forgotten);
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use std::env;
+    use std::fs;
+    use std::io::Write;
+    use std::process;
+
+    impl OpenFiles {
+        fn is_open(&self, book: Handle) -> bool {
+            self.open.lock().unwrap().iter().any(|&(handle, _)| handle == book)
+        }
+    }
+
+    fn book(name: &str, contents: &[u8]) -> String {
+        let path = env::temp_dir().join(format!("bookindex-files-{}-{}", name, process::id()));
+        File::create(&path).unwrap().write_all(contents).unwrap();
+        path.to_str().unwrap().to_string()
+    }
+
+    #[test]
+    fn reads_and_evicts_least_recent() {
+        let files = OpenFiles::new(2);
+        let paths: Vec<String> = (0..3).map(|n| book(&format!("evict{}", n), b"0123456789")).collect();
+        for (handle, path) in paths.iter().enumerate() {
+            let mut buf = [0; 3];
+            files.read_exact_at(handle as Handle, path, &mut buf, 4).unwrap();
+            assert_eq!(&buf, b"456");
+        }
+        assert!(!files.is_open(0));
+        assert!(files.is_open(1) && files.is_open(2));
+        for path in paths {
+            fs::remove_file(path).unwrap();
+        }
+    }
+
+    #[test]
+    fn forgotten_book_reopened() {
+        let files = OpenFiles::new(2);
+        let path = book("forget", b"before");
+        let mut buf = [0; 6];
+        files.read_exact_at(1, &path, &mut buf, 0).unwrap();
+        fs::remove_file(&path).unwrap();
+        let path = book("forget", b"after!");
+        files.read_exact_at(1, &path, &mut buf, 0).unwrap();
+        assert_eq!(&buf, b"before");
+        files.forget(1);
+        assert!(!files.is_open(1));
+        files.read_exact_at(1, &path, &mut buf, 0).unwrap();
+        assert_eq!(&buf, b"after!");
+        fs::remove_file(&path).unwrap();
+    }
+
+    #[test]
+    fn failed_read_closes() {
+        let files = OpenFiles::new(2);
+        let path = book("short", b"short");
+        let mut buf = [0; 10];
+        assert!(files.read_exact_at(1, &path, &mut buf, 0).is_err());
+        assert!(!files.is_open(1));
+        fs::remove_file(&path).unwrap();
+    }
+}
@@ -2,38 +2,115 @@
 //
 // Book paths are always UTF-8 and must not contain embedded NULs.
 //
-// The following book limits apply, and the behaviour when they're
-// violated is undefined:
-//
-//  * files >=4GiB
-//  * books with >=64 kibipages
-//  * books with any individual page spanning >=64KiB
-//  * it's assumed that this code won't have to handle libraries with
-//    more than 1000 books; resource concerns:
-//    * code uses a pipe per book and filehandle tables aren't endless;
-//      though several thousand should be fine on a kernel not really
-//      doing much else
-//    * memory footprint of indices has not been measured or optimised;
-//      the servo::heapsize crate should allow this, but 16 bytes per
-//      page is not unlikely
-//
-// init() must be called first; if not, behaviour of other functions is
-// undefined.
-//
-// init(lines_per_page : u8) -> i32:
-//
-//  Must be called before any other, giving the module an opportunity to
-//  do whatever setup it wants.  Synchronous.  Returns -EINVAL if
-//  `lines_per_page` is zero.  Returns -EBUSY if init() has already been
-//  called.
-//
-// trigger_load(book : char *, fd : i32) -> None:
-//
-//  Begin the process of loading `book` (a path) asynchronously, and
-//  return; when the book has loaded, reply "ok" on `fd`.  If the book
-//  fails to load for any reason, reply "error" on `fd`.  Currently `fd`
-//  is never used again, but future revisions might use it to supply
-//  pre-processed page content.
+// Byte offsets are 64-bit, so there's no practical limit on file or
+// page size.  Books with more than 2^31 - 1 pages (the most that
+// get_page_count() can report) fail to load rather than being
+// truncated.
+//
+// An index costs 4 bytes per page (8 for books of 4GiB or more), and
+// for PEF a further 8 bytes (or 16) per row, plus a small per-book
+// overhead (see get_index_memory()), and stays in memory
+// until unload_book() is called for it; callers with large libraries
+// should unload indices they no longer need.
+//
+// Indices can optionally be persisted between runs; see cache.rs.
+//
+// Books can optionally also be indexed for search (see search.rs and
+// set_search_indexing()), at a further cost in memory of roughly a
+// quarter of a long book's size (proportionally more for short ones);
+// search indices are never persisted.
+//
+// The book being read (see set_current_book()) is also kept
+// memory-mapped once loaded (see mmap.rs), so that its pages can be read
+// without any syscalls, by get_page_cells() or directly by the caller
+// through get_page_view().  Other books are read from their files, a
+// few of which are kept open (see files.rs); maps are costly in address
+// space on a 32-bit Pi, and a map of a book whose media is removed
+// faults when read.
+//
+// Books are paginated for a display of a given number of lines, so
+// each book is identified by its path and that number; the same book
+// may be loaded for several numbers of lines, each with an index of its
+// own.  trigger_load() returns a handle for the pair, `book : u32`
+// below, by which every other call refers to it, so that paths needn't
+// be passed (or looked up) again.  A path and number of lines always
+// get the same handle, which stays valid whether or not the book is
+// loaded; handles are never 0.
+//
+// Loaded books are looked up under a shared lock, so that any number of
+// calls about them can proceed at once; the exclusive lock is only taken
+// briefly, to add, publish pages to or remove a book, and never while
+// a book is being read or indexed.  Reading a page of one book doesn't
+// wait for others to load.
+//
+// set_completion_fd(fd : i32) -> i32:
+//
+//  Set the file descriptor, typically the write end of a pipe, on which
+//  trigger_load() reports finished loads.  Synchronous.  Each load is
+//  reported by a single write of a (token: u32, status: i32) record in
+//  native byte order, so that on a pipe records never interleave; one
+//  reader can wait on every load at once.  `status` is 0 if the book
+//  loaded, -ECANCELED if the load was cancelled with cancel_load(), or
+//  otherwise a negated errno (currently always -EIO) if it failed for
+//  any reason, a panic while loading included.  Returns 0, or -EBADF if
+//  `fd` is negative.
+//
+// trigger_load(path : char *, lines : u8, token : u32,
+//              priority : u8) -> i32:
+//
+//  Queue the book at `path` for loading asynchronously, paginated into
+//  `lines` lines per page, and return its handle; when the load has
+//  finished, report it on the completion fd with `token`, which is
+//  whatever the caller chooses to tell its loads apart.  `priority` is
+//  0 for foreground (a book the user is waiting for) or 1 for
+//  background (prefetching); queued foreground loads are always started
+//  before queued background ones.  Returns the handle, or -EINVAL if
+//  `lines` is zero or `priority` is invalid, or -EBADF if
+//  set_completion_fd() hasn't been called; in those cases nothing is
+//  queued and nothing will be reported.
+//
+// cancel_load(book) -> i32:
+//
+//  Ask every queued or running load of `book` to stop, for when it's no
+//  longer wanted.  Asynchronous: a queued load stops as soon as it's
+//  started, and a running one the next time it reads from the book or
+//  before indexing it for search, either way being reported with
+//  -ECANCELED as usual.  A load that's past that point finishes
+//  regardless.  Loads triggered after this aren't affected.  Returns
+//  0, or -ENOENT if no load of `book` is queued or running.
+//
+// set_pool_size(threads : u32) -> i32:
+//
+//  Set the number of indexing threads.  Synchronous.  Only possible
+//  before the first trigger_load(); returns -EBUSY after that, -EINVAL
+//  if `threads` is zero, or 0 on success.  Without a call to this, one
+//  thread per online CPU (up to 4) is used.
+//
+// get_pool_size() -> i32:
+//
+//  Returns the number of indexing threads.  Synchronous.
+//
+// get_queue_depth(priority : u8) -> i32:
+//
+//  Returns the number of loads queued at `priority` (as for
+//  trigger_load()) that have not yet started.  Synchronous.  Returns
+//  -EINVAL if `priority` is invalid.
+//
+// set_cache_dir(dir : char *) -> i32:
+//
+//  Enable the on-disk index cache, keeping it in directory `dir` (which
+//  is created if necessary).  Synchronous.  Once set, trigger_load()
+//  will use a cached index for a book if one exists and is still valid,
+//  and will cache any index it has to build.  Returns 0 on success, or
+//  a negated errno if `dir` can't be created.  Without a call to this,
+//  or after one with an empty `dir`, nothing is cached.
+//
+// get_cache_stats() -> (hits: u32, misses: u32, invalid: u32):
+//
+//  Returns counts of index cache lookups since startup that found a
+//  valid entry (`hits`) and that didn't (`misses`).  `invalid` is the
+//  subset of misses that found an entry but discarded it as stale or
+//  corrupt.  Synchronous.
 //
 // get_page_count(book) -> i32:
 //
@@ -42,7 +119,8 @@
 //  `book` is not yet known (book load never triggered, or triggered but
 //  unfinished, or triggered but failed), returns -ENOENT.
 //
-// get_page(book, pageno) -> (status: i32, firstbyte: u32, pagelength: u16):
+// get_page(book, pageno : u32) -> (status: i32, firstbyte: u64,
+//                                  pagelength: u64):
 //
 //  Returns the index entry for `pageno` of `book`.  Synchronous.
 //  `status` is 0 upon success.  `status` is -ENOENT and other fields
@@ -54,123 +132,835 @@
 //    * pad the page out with blank lines if it has fewer lines than the
 //      display does
 //    * clip overlong lines to the display width
+//    * for BRF, discard any form feed ending the page; pages are stored
+//      only by where they begin, so a page ended by a form feed runs up
+//      to and includes it
+//    * for PEF, pick out the content of each row with get_page_rows();
+//      a page runs from its first <row> to the next page's, so includes
+//      whatever markup lies between rows
+//
+//  While `book` is still being indexed, the pages indexed so far (see
+//  get_load_progress()) can already be fetched, and -EFAULT is
+//  returned for the rest.
+//
+// get_pages(book, first : u32, count : u32, extents : *PageExtent)
+//           -> i32:
+//
+//  Batch form of get_page(), for reading ahead.  Synchronous.  Fills
+//  `extents`, an array of at least `count` (firstbyte: u64, pagelength:
+//  u64) structs, with the index entries of pages `first` onwards,
+//  stopping at `count` pages or the end of the book, whichever comes
+//  first.  Returns get_page_count(book), from which the caller can
+//  tell how many entries were filled; or -ENOENT as for
+//  get_page_count(), in which case nothing is filled.  While `book` is
+//  still being indexed, the pages indexed so far are available and
+//  their number is returned instead.
+//
+// get_page_cells(book, pageno : u32, encoding : char *, width : u32,
+//                height : u32, cells : *u8) -> i32:
+//
+//  Reads and decodes page `pageno` of `book` into `cells`, a buffer of
+//  `width` * `height` bytes, one 6-dot pin number per cell in row
+//  order.  Synchronous.  Lines are clipped or padded with blank cells
+//  to `width`, and the page to `height` lines.  `encoding` is the 64
+//  Braille ASCII characters of the current encoding in pin number
+//  order, used for BRF.  A `pageno` past the end of the book (or of the
+//  pages indexed so far) is clamped to the last page.  Returns the page
+//  number decoded, or -EINVAL if `encoding` is malformed, -ENOENT as
+//  for get_page_count(), -EFBIG if the page is too big to hold in
+//  memory, or a negated errno if the book can't be read.
+//
+// get_page_rows(book, pageno : u32, count : u32, rows : *PageExtent)
+//               -> i32:
+//
+//  Fills `rows`, an array of at least `count` (firstbyte: u64, length:
+//  u64) structs, with where the content of each row of page `pageno`
+//  of PEF `book` lies, between the row's start and end tags (empty for
+//  `<row/>`), stopping at `count` rows.  Synchronous.  Returns the
+//  number of rows on the page, which is at most the number of lines
+//  `book` was loaded for and is 0 for BRF; or -ENOENT and -EFAULT as
+//  for get_page().  The content of a row
+//  may still contain markup, such as a CDATA section, though it never
+//  does in practice.
+//
+// get_load_progress(book) -> (page_count: i32, complete: u8):
+//
+//  Returns how far indexing of `book` has got, so that the first pages
+//  of a large book can be shown before it's fully indexed.  Synchronous.
+//  `page_count` is the number of pages that can be fetched so far, a
+//  lower bound on the final page count, and `complete` is 1 once that's
+//  the final page count (just as get_page_count() would return), or 0
+//  while indexing goes on.  Pages are published a batch at a time, the
+//  first page on its own.  `page_count` is -ENOENT, and `complete` 0,
+//  if no pages are known: load never triggered, or not yet started, or
+//  failed.
+//
+// get_load_stats(book) -> (status: i32, cached: u8, queued_us: u64,
+//                          wall_us: u64, bytes_read: u64, pages: u32,
+//                          parse_errors: u32):
+//
+//  Returns how the last finished load of `book` went, to tell what
+//  makes loading slow.  Synchronous.  `status` is as reported on the
+//  completion fd, or -ENOENT (and the rest 0) if no load of `book` has
+//  finished.  `cached` is 1 if the index came from the cache, in which
+//  case nothing is read from the book itself.  `queued_us` is how long
+//  the load waited for an indexing thread and `wall_us` how long it
+//  then took, in microseconds, including mapping the book and indexing
+//  it for search.  `bytes_read` is how much of the book was read,
+//  `pages` how many pages it has (0 if the load failed), and
+//  `parse_errors` how many malformed rows were skipped in a PEF (see
+//  pef.rs), plus one if it ended mid-tag; always 0 for BRF.
+//
+// set_current_book(book) -> i32:
+//
+//  Set the book being read, which is then kept mapped, and unmap any
+//  other.  Synchronous.  If `book` is still loading it's mapped once
+//  loaded (and again each time it's reloaded).  0 means no book, so
+//  that nothing is mapped.  Returns 0.
+//
+// get_page_view(book, pageno : u32) -> (status: i32, data: *u8,
+//                                       length: u64):
+//
+//  Returns where page `pageno` of `book` lies in the book's memory map,
+//  for the caller to read in place.  Synchronous.  `status` is 0 upon
+//  success, when `data` points to the page's `length` bytes, which are
+//  exactly those described by get_page() and need the same treatment.
+//  They stay valid until the next call to get_page_view() (for any
+//  book), so the caller mustn't hold on to them beyond that.  `status`
+//  is -ENOENT or -EFAULT as for get_page(), -ENODATA if `book` isn't
+//  mapped (as when it isn't the current book, or is still being
+//  indexed, or mapping failed), or -ESTALE if the book has changed
+//  since it was indexed; the caller should then read the page from the
+//  file instead.
+//
+// set_search_indexing(enabled : u8) -> i32:
+//
+//  Set whether books loaded from now on are also indexed for search().
+//  Synchronous.  Returns 0.  Off unless this is called.
+//
+// search(book, encoding : char *, query : *u8, query_len : u32,
+//        width : u32, pages : *u32, max_pages : u32) -> i32:
+//
+//  Find the pages of `book` on which `query`, `query_len` 6-dot pin
+//  numbers, appears within a line, decoding as get_page_cells() does
+//  with `encoding` for a display `width` cells wide, so that a line's
+//  cells beyond that width, which aren't shown, aren't searched.  Synchronous, but holds up neither other calls nor
+//  loads while it runs.  Fills `pages`, an array of at least
+//  `max_pages` u32s, with the first `max_pages` such page numbers in
+//  ascending order, and returns how many pages there are in all.  A book indexed
+//  for search only has the pages that might match decoded; any other
+//  has every page decoded, which gives the same result more slowly.
+//  Returns -EINVAL if `encoding` is malformed or `query` is empty or
+//  not pin numbers, -ENOENT if `book` isn't fully loaded, or -ENODATA
+//  if it isn't mapped (see set_current_book()).
+//
+// unload_book(book) -> i32:
+//
+//  Discard the index of `book`, freeing its memory, and unmap it; the
+//  book must be loaded again with trigger_load() before its pages can
+//  be fetched.  Synchronous.  Returns 0 on success, -ENOENT if `book`
+//  isn't loaded, or -EBUSY if it's still being indexed.
+//
+// get_index_memory(book) -> i64:
+//
+//  Returns the number of bytes of memory used by the index of `book`,
+//  or if `book` is 0 the total for all loaded books.  Synchronous.
+//  Returns -ENOENT under the same conditions as get_page_count().
 
 extern crate libc;
 #[macro_use]
 extern crate lazy_static;
-extern crate quick_xml;
+extern crate memchr;
+
+mod cache;
+mod decode;
+mod files;
+mod mmap;
+mod pef;
+mod pool;
+mod search;
+mod starts;
 
 use libc::{c_char, c_void, write};
-use quick_xml::events::Event;
-use quick_xml::Reader;
-use std::collections::{BTreeMap, HashMap};
+use memchr::memchr;
+use std::collections::HashMap;
 use std::ffi::CStr;
 use std::fs::File;
 use std::io;
-use std::io::{BufRead, BufReader};
+use std::io::Read;
+use std::mem;
 use std::num::NonZeroU8;
+use std::ops::Range;
+use std::panic;
 use std::path::Path;
-use std::sync::atomic::{AtomicU8, Ordering};
-use std::sync::Mutex;
-use std::thread;
+use std::ptr;
+use std::slice;
+use std::sync::atomic::{AtomicBool, AtomicI32, AtomicU32, Ordering};
+use std::sync::{Arc, Mutex, RwLock};
+use std::time::{Duration, Instant};
+
+use decode::{EncodingTable, Lines};
+use pool::Priority;
+use search::SearchIndex;
+use starts::Index;
+
+type PageNumber = u32;
 
-// Internally, anyway.  Limits books to 2^16 pages.
-type PageNumber = u16;
+// What trigger_load() returns for a book, by which it's known from then
+// on.
+type Handle = u32;
+
+// The most pages a book can have, since page counts are returned as
+// i32 over FFI.
+const MAX_PAGES: usize = i32::max_value() as usize;
 
 type UnixError = i32;
 
-// This implicitly limits useable book files to sub-4GiB.
-// Individual pages can't be longer than 64KiB.
+#[repr(C)]
 #[derive(Hash, Eq, PartialEq, Debug, Copy, Clone)]
-struct PageExtent {
-    first: u32,
-    length: u16,
+pub struct PageExtent {
+    first: u64,
+    length: u64,
+}
+
+// Reports a finished load on the completion fd.
+#[repr(C)]
+struct Completion {
+    token: u32,
+    status: i32,
+}
+
+// Just for FFI to return the progress of a load.
+#[repr(C)]
+pub struct LoadProgress {
+    page_count: i32,
+    complete: u8,
+}
+
+// Just for FFI to return how a load went.
+#[repr(C)]
+#[derive(Debug, Copy, Clone)]
+pub struct LoadStats {
+    status: i32,
+    cached: u8,
+    queued_us: u64,
+    wall_us: u64,
+    bytes_read: u64,
+    pages: u32,
+    parse_errors: u32,
+}
+
+// Just for FFI to return where a page is mapped, with allowance for
+// failure.
+#[repr(C)]
+pub struct PageView {
+    status: i32,
+    data: *const u8,
+    length: u64,
 }
 
 // Just for FFI to return PageExtent with allowance for failure.
 #[repr(C)]
 pub struct PageExtentResult {
     status: i32,
-    first: u32,
-    length: u16,
+    first: u64,
+    length: u64,
 }
 
-// An entry for a single book.
-#[derive(Hash, Eq, PartialEq, Debug)]
+// An entry for a single book.  Until `complete`, it holds just the
+// pages indexed so far, and isn't mapped or indexed for search.  Only
+// the current book is mapped.
+#[derive(Debug)]
 struct BookIndex {
-    // FIXME: Unlike indexed_line_reader (which this drew inspiration
-    // from) we index every single page, so a simple Vec is probably
-    // both smaller and more efficient for page_index.
-    page_index: BTreeMap<PageNumber, PageExtent>,
-    page_count: PageNumber,
-    fd: i32,
+    key: IndexKey,
+    index: Index,
+    map: Option<Arc<mmap::Map>>,
+    search: Option<SearchIndex>,
+    complete: bool,
 }
 
-static DISPLAY_LINES: AtomicU8 = AtomicU8::new(0);
+// How many newly indexed pages to publish to BOOKS at once while
+// indexing; each time means taking the lock.
+const PUBLISH_BATCH: usize = 64;
+
+impl BookIndex {
+    // The number of pages that can be fetched, which until `complete` is
+    // only those indexed so far.
+    fn page_count(&self) -> PageNumber {
+        // Books with too many pages fail to load, but may have been
+        // partly published first.
+        self.index.page_starts.len().saturating_sub(1).min(MAX_PAGES) as PageNumber
+    }
+
+    fn page(&self, page: PageNumber) -> PageExtent {
+        let page = page as usize;
+        let first = self.index.page_starts.get(page);
+        PageExtent {
+            first: first,
+            length: self.index.page_starts.get(page + 1) - first,
+        }
+    }
+
+    // Which rows (see row()) are on `page`, for a book paginated into
+    // `lines` lines per page; none for BRF.
+    fn rows(&self, page: PageNumber, lines: u8) -> Range<usize> {
+        let row_count = self.index.row_bounds.len() / 2;
+        let first = page as usize * lines as usize;
+        first.min(row_count)..(first + lines as usize).min(row_count)
+    }
+
+    // Where the content of row `row` lies.
+    fn row(&self, row: usize) -> PageExtent {
+        let first = self.index.row_bounds.get(2 * row);
+        PageExtent {
+            first: first,
+            length: self.index.row_bounds.get(2 * row + 1) - first,
+        }
+    }
+
+    // Where `extent` lies in the book's map, if it's mapped.
+    fn mapped(&self, extent: &PageExtent) -> Result<&[u8], UnixError> {
+        match self.map {
+            Some(ref map) => map_extent(map, extent),
+            None => Err(-libc::ENODATA),
+        }
+    }
+
+    // Indexes the book's text for search, from the map.
+    fn index_text(&self, format: BookFormat, lines: u8) -> Option<SearchIndex> {
+        let mut builder = search::Builder::new();
+        for page in 0..self.page_count() {
+            let extent = self.page(page);
+            let raw = self.mapped(&extent).ok()?;
+            match format {
+                // Symbols are independent of the encoding, so there's no
+                // need to decode.
+                BookFormat::Brf => {
+                    for &b in raw {
+                        match search::brf_symbol(b) {
+                            Some(symbol) => builder.symbol(symbol),
+                            None => builder.gap(),
+                        }
+                    }
+                }
+                BookFormat::Pef => {
+                    let rows: Vec<PageExtent> = self.rows(page, lines).map(|row| self.row(row)).collect();
+                    decode::pef_cells(raw, &relative_rows(&extent, &rows), &mut search::PefSymbols(&mut builder));
+                }
+            }
+            builder.end_page();
+        }
+        builder.finish()
+    }
+
+    fn lines(&self) -> u8 {
+        self.key.1
+    }
+
+    // Memory in use by this index, including its entry in BOOKS.
+    fn resident_bytes(&self) -> usize {
+        mem::size_of::<(Handle, BookIndex)>()
+            + self.key.0.capacity()
+            + self.index.allocated()
+            + self.search.as_ref().map_or(0, |search| search.allocated())
+    }
+}
+
+// Where `extent` lies in `map`.
+fn map_extent<'a>(map: &'a mmap::Map, extent: &PageExtent) -> Result<&'a [u8], UnixError> {
+    let bytes = map.bytes();
+    let end = extent.first.checked_add(extent.length);
+    match end {
+        Some(end) if end <= bytes.len() as u64 => Ok(&bytes[extent.first as usize..end as usize]),
+        _ => Err(-libc::ESTALE),
+    }
+}
+
+// A book's path and the number of lines per page it was paginated for.
+type IndexKey = (String, u8);
+
+static COMPLETION_FD: AtomicI32 = AtomicI32::new(-1);
+static SEARCH_INDEXING: AtomicBool = AtomicBool::new(false);
+// The book being read, or 0.
+static CURRENT_BOOK: AtomicU32 = AtomicU32::new(0);
+
 lazy_static! {
-    // FIXME: use RwLock, since initial book loading can probably be a
-    // bit parallel?
-    static ref BOOKS: Mutex<HashMap<String, BookIndex>> = Mutex::new(HashMap::new());
+    // Every book ever triggered, by handle; never shrinks, so that a
+    // book keeps its handle.
+    static ref HANDLES: Mutex<HashMap<IndexKey, Handle>> = Mutex::new(HashMap::new());
+    // Read-mostly: written only to add, update or remove a book.
+    static ref BOOKS: RwLock<HashMap<Handle, BookIndex>> = RwLock::new(HashMap::new());
+    // The map last returned into by get_page_view(), kept until the next
+    // call so that the caller can read it even if its book is unmapped
+    // meanwhile.
+    static ref VIEWED: Mutex<Option<Arc<mmap::Map>>> = Mutex::new(None);
+    // Books with loads queued or running.
+    static ref LOADS: Mutex<HashMap<Handle, Load>> = Mutex::new(HashMap::new());
+    // How the last finished load of each book went.
+    static ref STATS: Mutex<HashMap<Handle, LoadStats>> = Mutex::new(HashMap::new());
 }
 
-#[no_mangle]
-pub extern "C" fn init(num_display_lines: u8) -> UnixError {
-    if num_display_lines <= 0 {
-        return -libc::EINVAL;
+// The loads of a book that are queued or running.
+struct Load {
+    // Shared by them all, unless some were triggered after others had
+    // been cancelled.
+    cancelled: Arc<AtomicBool>,
+    pending: usize,
+}
+
+// Notes a new load of `handle`, returning the flag by which it can be
+// cancelled.
+fn start_load(handle: Handle) -> Arc<AtomicBool> {
+    let mut loads = LOADS.lock().unwrap();
+    let load = loads.entry(handle).or_insert(Load {
+        cancelled: Arc::new(AtomicBool::new(false)),
+        pending: 0,
+    });
+    if load.cancelled.load(Ordering::SeqCst) {
+        load.cancelled = Arc::new(AtomicBool::new(false));
     }
-    // Since we've made it impossible to set to zero, an existing zero
-    // must mean we're first.  It'd be nicer to use Once, but only in
-    // nightly can you use is_completed() to detect that you're second
-    // and thus complain.
-    let old = DISPLAY_LINES.compare_and_swap(0, num_display_lines, Ordering::SeqCst);
-    if old != 0 {
-        return -libc::EBUSY;
+    load.pending += 1;
+    load.cancelled.clone()
+}
+
+fn finish_load(handle: Handle) {
+    let mut loads = LOADS.lock().unwrap();
+    let done = match loads.get_mut(&handle) {
+        Some(load) => {
+            load.pending -= 1;
+            load.pending == 0
+        }
+        None => false,
+    };
+    if done {
+        loads.remove(&handle);
     }
+}
+
+// Reads a book for indexing, counting what's read and failing once
+// `cancelled` is set, so that indexing stops between reads.
+struct BookReader<'a, R> {
+    reader: R,
+    cancelled: Option<&'a AtomicBool>,
+    bytes_read: u64,
+}
+
+impl<'a, R: Read> Read for BookReader<'a, R> {
+    fn read(&mut self, buf: &mut [u8]) -> io::Result<usize> {
+        if self.cancelled.map_or(false, |cancelled| cancelled.load(Ordering::SeqCst)) {
+            return Err(io::Error::new(io::ErrorKind::Other, "load cancelled"));
+        }
+        let len = self.reader.read(buf)?;
+        self.bytes_read += len as u64;
+        Ok(len)
+    }
+}
+
+fn micros(duration: Duration) -> u64 {
+    duration.as_secs() * 1_000_000 + duration.subsec_micros() as u64
+}
+
+#[no_mangle]
+pub extern "C" fn set_completion_fd(fd: i32) -> UnixError {
+    if fd < 0 {
+        return -libc::EBADF;
+    }
+    COMPLETION_FD.store(fd, Ordering::SeqCst);
     0
 }
 
 #[no_mangle]
-pub extern "C" fn trigger_load(bookpath: *const c_char, bookfd: i32) {
-    let bookpath = stringify(bookpath);
-
-    thread::spawn(move || {
-        let mut status = "ok";
-        let display_lines = DISPLAY_LINES.load(Ordering::SeqCst);
-        let display_lines = NonZeroU8::new(display_lines).expect("init() hasn't been called yet");
-        let index = index_book(&bookpath, display_lines);
-        if index.is_some() {
-            //println!("did index book");
-            let index = index.unwrap();
-            let page_count = index.len() as PageNumber;
-            BOOKS.lock().unwrap().insert(
-                bookpath,
-                BookIndex {
-                    page_index: index,
-                    page_count: page_count,
-                    fd: bookfd,
-                },
-            );
-        } else {
-            status = "error";
-        }
-        // Write to pipe.
-        let len = status.len();
-        let status = status.as_ptr() as *const c_void;
-        let result = unsafe { write(bookfd, status, len) };
+pub extern "C" fn trigger_load(
+    bookpath: *const c_char,
+    lines: u8,
+    token: u32,
+    priority: u8,
+) -> i32 {
+    let key = (stringify(bookpath), lines);
+    let display_lines = match NonZeroU8::new(lines) {
+        Some(display_lines) => display_lines,
+        None => return -libc::EINVAL,
+    };
+    let priority = match Priority::from_ffi(priority) {
+        Some(priority) => priority,
+        None => return -libc::EINVAL,
+    };
+    if COMPLETION_FD.load(Ordering::SeqCst) < 0 {
+        return -libc::EBADF;
+    }
+    let handle = {
+        let mut handles = HANDLES.lock().unwrap();
+        let next = handles.len() as Handle + 1;
+        *handles.entry(key.clone()).or_insert(next)
+    };
+    let cancelled = start_load(handle);
+    let queued = Instant::now();
+
+    pool::submit(priority, move || {
+        let started = Instant::now();
+        let mut stats = LoadStats {
+            status: 0,
+            cached: 0,
+            queued_us: micros(started - queued),
+            wall_us: 0,
+            bytes_read: 0,
+            pages: 0,
+            parse_errors: 0,
+        };
+        // A panic mid-load (the default hook has printed it) is reported
+        // like any other failure, or whoever's waiting would wait forever.
+        let status = panic::catch_unwind(panic::AssertUnwindSafe(|| {
+            load_book(handle, key, display_lines, &cancelled, &mut stats)
+        }))
+        .unwrap_or_else(|_| {
+            discard_partial(handle);
+            -libc::EIO
+        });
+        stats.status = status;
+        stats.wall_us = micros(started.elapsed());
+        STATS.lock().unwrap().insert(handle, stats);
+        finish_load(handle);
+        let completion = Completion {
+            token: token,
+            status: status,
+        };
+        let len = mem::size_of::<Completion>();
+        let result = unsafe {
+            write(
+                COMPLETION_FD.load(Ordering::SeqCst),
+                &completion as *const Completion as *const c_void,
+                len,
+            )
+        };
         // Something's already seriously wrong if a write to our own
         // pipe fails, so panic.  Better that than let the error go
         // completely unnoticed.
-        if result < 0 {
+        if result != len as isize {
             panic!("pipe write failed");
         }
     });
+    handle as i32
 }
 
+// Loads the book for `key` into BOOKS as `handle`, returning the status
+// to report on the completion fd.
+fn load_book(
+    handle: Handle,
+    key: IndexKey,
+    display_lines: NonZeroU8,
+    cancelled: &AtomicBool,
+    stats: &mut LoadStats,
+) -> i32 {
+    let index = if cancelled.load(Ordering::SeqCst) {
+        None
+    } else {
+        load_or_index_book(handle, &key, display_lines, cancelled, stats)
+    };
+    // Indexing for search reads the whole book again, so is worth
+    // not doing if no longer wanted.
+    let index = index.filter(|_| !cancelled.load(Ordering::SeqCst));
+    let search_indexing = SEARCH_INDEXING.load(Ordering::SeqCst);
+    // Indexing for search reads from a map too, just while it lasts.
+    let map = index
+        .as_ref()
+        .filter(|_| search_indexing || is_current(handle))
+        .and_then(|_| map_book(handle, &key));
+    let book = index.map(|mut index| {
+        index.shrink_to_fit();
+        let mut book = BookIndex {
+            key: key,
+            index: index,
+            map: map,
+            search: None,
+            complete: true,
+        };
+        if search_indexing {
+            let search = book_format(&book.key.0).and_then(|format| book.index_text(format, book.lines()));
+            book.search = search;
+        }
+        if !is_current(handle) {
+            book.map = None;
+        }
+        book
+    });
+    let mut status = 0;
+    let replaced = if let Some(book) = book {
+        //println!("did index book");
+        stats.pages = book.page_count();
+        BOOKS.write().unwrap().insert(handle, book)
+    } else {
+        status = if cancelled.load(Ordering::SeqCst) {
+            -libc::ECANCELED
+        } else {
+            -libc::EIO
+        };
+        discard_partial(handle)
+    };
+    // The old book (and its map, unless still in use) is freed here,
+    // outside the lock, and its file closed, as it may have changed.
+    drop(replaced);
+    files::forget(handle);
+    // In case it became the current book while loading.
+    if status == 0 {
+        map_if_current(handle);
+    }
+    status
+}
 
-fn index_book(
-    bookpath: &String,
+// Removes the pages of `handle` published so far by a load that failed,
+// so as not to leave them lying around, returning them.
+fn discard_partial(handle: Handle) -> Option<BookIndex> {
+    // After a panic the lock may be poisoned, and there's nothing left to
+    // tidy up that's worth panicking again over.
+    let mut books = match BOOKS.write() {
+        Ok(books) => books,
+        Err(_) => return None,
+    };
+    if books.get(&handle).map_or(false, |book| !book.complete) {
+        books.remove(&handle)
+    } else {
+        None
+    }
+}
+
+#[no_mangle]
+pub extern "C" fn cancel_load(book: Handle) -> UnixError {
+    match LOADS.lock().unwrap().get(&book) {
+        Some(load) => {
+            load.cancelled.store(true, Ordering::SeqCst);
+            0
+        }
+        None => -libc::ENOENT,
+    }
+}
+
+#[no_mangle]
+pub extern "C" fn get_load_stats(book: Handle) -> LoadStats {
+    match STATS.lock().unwrap().get(&book) {
+        Some(stats) => *stats,
+        None => LoadStats {
+            status: -libc::ENOENT,
+            cached: 0,
+            queued_us: 0,
+            wall_us: 0,
+            bytes_read: 0,
+            pages: 0,
+            parse_errors: 0,
+        },
+    }
+}
+
+#[no_mangle]
+pub extern "C" fn set_search_indexing(enabled: u8) -> UnixError {
+    SEARCH_INDEXING.store(enabled != 0, Ordering::SeqCst);
+    0
+}
+
+#[no_mangle]
+pub extern "C" fn set_pool_size(threads: u32) -> UnixError {
+    match pool::set_size(threads as usize) {
+        Ok(()) => 0,
+        Err(e) => e,
+    }
+}
+
+#[no_mangle]
+pub extern "C" fn get_pool_size() -> i32 {
+    pool::size() as i32
+}
+
+#[no_mangle]
+pub extern "C" fn get_queue_depth(priority: u8) -> i32 {
+    match Priority::from_ffi(priority) {
+        Some(priority) => pool::queue_depth(priority) as i32,
+        None => -libc::EINVAL,
+    }
+}
+
+#[no_mangle]
+pub extern "C" fn set_cache_dir(dir: *const c_char) -> UnixError {
+    let dir = stringify(dir);
+    match cache::set_dir(&dir) {
+        Ok(()) => 0,
+        Err(e) => e,
+    }
+}
+
+#[no_mangle]
+pub extern "C" fn get_cache_stats() -> cache::CacheStats {
+    cache::stats()
+}
+
+fn is_current(handle: Handle) -> bool {
+    CURRENT_BOOK.load(Ordering::SeqCst) == handle
+}
+
+#[no_mangle]
+pub extern "C" fn set_current_book(book: Handle) -> UnixError {
+    CURRENT_BOOK.store(book, Ordering::SeqCst);
+    let unmapped: Vec<Arc<mmap::Map>> = {
+        let mut books = BOOKS.write().unwrap();
+        books
+            .iter_mut()
+            .filter(|&(&handle, _)| handle != book)
+            .filter_map(|(_, other)| other.map.take())
+            .collect()
+    };
+    // Unmapped outside the lock.
+    drop(unmapped);
+    map_if_current(book);
+    0
+}
+
+// Maps `handle` if it's the current book, fully loaded and not yet
+// mapped.
+fn map_if_current(handle: Handle) {
+    let key = match BOOKS.read().unwrap().get(&handle) {
+        Some(book) if is_current(handle) && book.complete && book.map.is_none() => book.key.clone(),
+        _ => return,
+    };
+    let map = match map_book(handle, &key) {
+        Some(map) => map,
+        None => return,
+    };
+    let mut books = BOOKS.write().unwrap();
+    if let Some(book) = books.get_mut(&handle) {
+        // Unless something else got there first.
+        if is_current(handle) && book.complete && book.map.is_none() {
+            book.map = Some(map);
+        }
+    }
+}
+
+// Maps the book for `key`, reusing the map of `handle` if that's still
+// of the same book.  Failure isn't fatal, since pages can still be read
+// from the file, so is only reported.
+fn map_book(handle: Handle, key: &IndexKey) -> Option<Arc<mmap::Map>> {
+    let existing = BOOKS.read().unwrap().get(&handle).and_then(|book| book.map.clone());
+    if let Some(map) = existing {
+        if map.is_current(&key.0) {
+            return Some(map);
+        }
+    }
+    match mmap::Map::open(&key.0) {
+        Ok(map) => Some(Arc::new(map)),
+        Err(e) => {
+            println!("failed to map {}: {}", key.0, e);
+            None
+        }
+    }
+}
+
+// Index `bookpath` without publishing or caching anything, returning
+// its page count; for benches only.
+#[doc(hidden)]
+pub fn index_only(bookpath: &String, display_lines: u8) -> Option<usize> {
+    let display_lines = NonZeroU8::new(display_lines)?;
+    index_book(bookpath, display_lines, &mut Progress::none(), None).map(|index| index.page_starts.len() - 1)
+}
+
+fn load_or_index_book(
+    handle: Handle,
+    key: &IndexKey,
     display_lines: NonZeroU8,
-) -> Option<BTreeMap<PageNumber, PageExtent>> {
+    cancelled: &AtomicBool,
+    stats: &mut LoadStats,
+) -> Option<Index> {
+    let bookpath = &key.0;
+    // If the book can't even be stat()ed, indexing will fail anyway.
+    let cache_key = cache::BookKey::for_book(bookpath, display_lines.get())?;
+    if let Some(index) = cache::load(bookpath, &cache_key) {
+        stats.cached = 1;
+        return Some(index);
+    }
+    let mut progress = Progress::start(handle, key);
+    let index = index_book(bookpath, display_lines, &mut progress, Some(cancelled));
+    stats.bytes_read = progress.bytes_read;
+    stats.parse_errors = progress.parse_errors;
+    let index = index?;
+    cache::store(bookpath, &cache_key, &index);
+    Some(index)
+}
+
+// Publishes pages to BOOKS as they're indexed, so that the start of a
+// big book can be read while the rest is still being indexed.  Also
+// counts what indexing took, for get_load_stats().
+pub struct Progress {
+    // None if nothing is to be published.
+    handle: Option<Handle>,
+    published: usize,
+    rows_published: usize,
+    bytes_read: u64,
+    parse_errors: u32,
+}
+
+impl Progress {
+    fn start(handle: Handle, key: &IndexKey) -> Progress {
+        // A book that's already loaded (by an earlier load, say) stays
+        // readable as it was until we're done.
+        BOOKS
+            .write()
+            .unwrap()
+            .entry(handle)
+            .or_insert(BookIndex {
+                key: key.clone(),
+                index: Index::new(),
+                map: None,
+                search: None,
+                complete: false,
+            });
+        Progress {
+            handle: Some(handle),
+            published: 0,
+            rows_published: 0,
+            bytes_read: 0,
+            parse_errors: 0,
+        }
+    }
+
+    fn none() -> Progress {
+        Progress {
+            handle: None,
+            published: 0,
+            rows_published: 0,
+            bytes_read: 0,
+            parse_errors: 0,
+        }
+    }
+
+    // Called each time a page is added to `index`, with where that page
+    // ends; its rows must already have been added.
+    fn update(&mut self, index: &Index, end: u64) {
+        let starts = &index.page_starts;
+        let handle = match self.handle {
+            Some(handle) => handle,
+            None => return,
+        };
+        if starts.len() != 1 && starts.len() - self.published < PUBLISH_BATCH {
+            return;
+        }
+        let mut books = BOOKS.write().unwrap();
+        if let Some(book) = books.get_mut(&handle) {
+            if !book.complete {
+                // Replace the end of the last page published.
+                book.index.page_starts.pop();
+                book.index.page_starts.extend_from(starts, self.published);
+                book.index.page_starts.push(end);
+                book.index.row_bounds.extend_from(&index.row_bounds, self.rows_published);
+            }
+        }
+        self.published = starts.len();
+        self.rows_published = index.row_bounds.len();
+    }
+}
+
+#[derive(Debug, Copy, Clone, PartialEq, Eq)]
+enum BookFormat {
+    Brf,
+    Pef,
+}
+
+fn book_format(bookpath: &String) -> Option<BookFormat> {
     // FIXME could/should we do path conversion in shared code?
     let path = Path::new(bookpath);
     // Ensure valid Unicode path.
@@ -185,42 +975,67 @@ fn index_book(
     // Unwrap is safe because we checked Unicode-ness already.
     let ext = ext.unwrap().to_str().unwrap().to_ascii_lowercase();
 
+    match ext.as_str() {
+        "brf" => Some(BookFormat::Brf),
+        "pef" => Some(BookFormat::Pef),
+        _ => None,
+    }
+}
+
+fn index_book(
+    bookpath: &String,
+    display_lines: NonZeroU8,
+    progress: &mut Progress,
+    cancelled: Option<&AtomicBool>,
+) -> Option<Index> {
+    let format = book_format(bookpath)?;
+
     let f = File::open(bookpath);
     if f.is_err() {
         return None;
     }
-    let reader = io::BufReader::new(f.unwrap());
+    let mut f = BookReader {
+        reader: f.unwrap(),
+        cancelled: cancelled,
+        bytes_read: 0,
+    };
 
-    match ext.as_str() {
-        "brf" => index_brf(reader, display_lines),
-        "pef" => index_pef(reader, display_lines),
-        _ => None,
+    let index = match format {
+        BookFormat::Brf => index_brf(&mut f, display_lines, progress),
+        BookFormat::Pef => index_pef(&mut f, display_lines, progress),
+    };
+    progress.bytes_read = f.bytes_read;
+    let index = index?;
+    // Fail rather than have page numbers wrap.
+    if index.page_starts.len() - 1 > MAX_PAGES {
+        println!("{} has too many pages.", bookpath);
+        return None;
     }
+    Some(index)
 }
 
 #[no_mangle]
-pub extern "C" fn get_page_count(bookpath: *const c_char) -> i32 {
-    let bookpath = stringify(bookpath);
-    match BOOKS.lock().unwrap().get(&bookpath) {
-        Some(bookindex) => {
+pub extern "C" fn get_page_count(book: Handle) -> i32 {
+    match BOOKS.read().unwrap().get(&book) {
+        Some(bookindex) if bookindex.complete => {
             // Only use this for debug, it's pretty noisy.
-            //println!("{}: {:?}", bookpath, bookindex);
-            bookindex.page_count as i32
+            //println!("{:?}: {:?}", book, bookindex);
+            bookindex.page_count() as i32
         }
-        None => {
-            println!("{} is unknown.", bookpath);
+        _ => {
+            println!("book {} is unknown.", book);
             -libc::ENOENT
         }
     }
 }
 
 #[no_mangle]
-pub extern "C" fn get_page(bookpath: *const c_char, page: PageNumber) -> PageExtentResult {
-    let bookpath = stringify(bookpath);
-    let books = BOOKS.lock().unwrap();
-    let book = books.get(&bookpath);
+pub extern "C" fn get_page(book: Handle, page: PageNumber) -> PageExtentResult {
+    let handle = book;
+    let books = BOOKS.read().unwrap();
+    let book = books.get(&handle);
     if book.is_none() {
-        println!("{} is unknown.", bookpath);
+        println!("book {} is unknown.", handle);
         return PageExtentResult {
             status: -libc::ENOENT,
             first: 0,
@@ -229,175 +1044,498 @@ pub extern "C" fn get_page(bookpath: *const c_char, page: PageNumber) -> PageExt
     }
     let book = book.unwrap();
     // Only use this for debug, it's pretty noisy.
-    //println!("{}: {:?}", bookpath, book);
-    if page >= book.page_index.len() as PageNumber {
+    //println!("{:?}: {:?}", handle, book);
+    if page >= book.page_count() {
         return PageExtentResult {
             status: -libc::EFAULT,
             first: 0,
             length: 0,
         };
     }
-    let extent = book.page_index.get(&page).unwrap();
+    let extent = book.page(page);
     PageExtentResult {
         status: 0,
         first: extent.first,
-        length: extent.length as u16,
+        length: extent.length,
     }
 }
 
-const FORM_FEED: &str = "\x0C";
+#[no_mangle]
+pub extern "C" fn get_pages(
+    book: Handle,
+    first: PageNumber,
+    count: u32,
+    extents: *mut PageExtent,
+) -> i32 {
+    let handle = book;
+    let books = BOOKS.read().unwrap();
+    let book = match books.get(&handle) {
+        Some(book) => book,
+        None => {
+            println!("book {} is unknown.", handle);
+            return -libc::ENOENT;
+        }
+    };
+    let page_count = book.page_count();
+    if count == 0 || first >= page_count {
+        return page_count as i32;
+    }
+    let extents = unsafe {
+        assert!(!extents.is_null());
+        slice::from_raw_parts_mut(extents, count as usize)
+    };
+    for (extent, page) in extents.iter_mut().zip(first..page_count) {
+        *extent = book.page(page);
+    }
+    page_count as i32
+}
 
-fn index_brf(
-    mut br: BufReader<File>,
+#[no_mangle]
+pub extern "C" fn get_page_cells(
+    book: Handle,
+    page: PageNumber,
+    encoding: *const c_char,
+    width: u32,
+    height: u32,
+    cells: *mut u8,
+) -> i32 {
+    let handle = book;
+    let table = unsafe {
+        assert!(!encoding.is_null());
+        EncodingTable::new(CStr::from_ptr(encoding).to_bytes())
+    };
+    let table = match table {
+        Some(table) => table,
+        None => return -libc::EINVAL,
+    };
+    // Copy out what we need rather than hold the lock during I/O.
+    let (bookpath, page, extent, rows, map) = {
+        let books = BOOKS.read().unwrap();
+        let book = match books.get(&handle) {
+            Some(book) => book,
+            None => {
+                println!("book {} is unknown.", handle);
+                return -libc::ENOENT;
+            }
+        };
+        let bookpath = book.key.0.clone();
+        match book.page_count() {
+            0 => (bookpath, 0, PageExtent { first: 0, length: 0 }, Vec::new(), None),
+            page_count => {
+                let page = page.min(page_count - 1);
+                let rows: Vec<PageExtent> = book.rows(page, book.lines()).map(|row| book.row(row)).collect();
+                (bookpath, page, book.page(page), rows, book.map.clone())
+            }
+        }
+    };
+    let format = match book_format(&bookpath) {
+        Some(format) => format,
+        None => return -libc::EINVAL,
+    };
+    let read;
+    let raw = match map.as_ref().and_then(|map| map.bytes().get(extent.first as usize..)) {
+        Some(bytes) if bytes.len() as u64 >= extent.length => &bytes[..extent.length as usize],
+        // Not mapped (yet), so read the page in.
+        _ => {
+            // Only possible with a 32-bit usize, but don't let it wrap.
+            if extent.length > usize::max_value() as u64 {
+                return -libc::EFBIG;
+            }
+            let mut buf = vec![0; extent.length as usize];
+            if let Err(e) = files::read_exact_at(handle, &bookpath, &mut buf, extent.first) {
+                return -e.raw_os_error().unwrap_or(libc::EIO);
+            }
+            read = buf;
+            &read[..]
+        }
+    };
+    let width = width as usize;
+    let cells = unsafe {
+        assert!(!cells.is_null());
+        slice::from_raw_parts_mut(cells, width * height as usize)
+    };
+    decode_page(format, raw, &extent, &rows, &table, &mut decode::Grid::new(cells, width));
+    page as i32
+}
+
+// Decodes `raw`, the bytes of the page at `extent`, whose rows (for PEF)
+// are at `rows`.
+fn decode_page<L: Lines>(
+    format: BookFormat,
+    raw: &[u8],
+    extent: &PageExtent,
+    rows: &[PageExtent],
+    table: &EncodingTable,
+    out: &mut L,
+) {
+    match format {
+        BookFormat::Brf => decode::brf_cells(raw, table, out),
+        BookFormat::Pef => decode::pef_cells(raw, &relative_rows(extent, rows), out),
+    }
+}
+
+// Where `rows` lie within the page at `extent`.
+fn relative_rows(extent: &PageExtent, rows: &[PageExtent]) -> Vec<Range<usize>> {
+    rows.iter()
+        .map(|row| {
+            let first = (row.first - extent.first) as usize;
+            first..first + row.length as usize
+        })
+        .collect()
+}
+
+#[no_mangle]
+pub extern "C" fn search(
+    book: Handle,
+    encoding: *const c_char,
+    query: *const u8,
+    query_len: u32,
+    width: u32,
+    pages: *mut PageNumber,
+    max_pages: u32,
+) -> i32 {
+    let handle = book;
+    let table = unsafe {
+        assert!(!encoding.is_null());
+        EncodingTable::new(CStr::from_ptr(encoding).to_bytes())
+    };
+    let table = match table {
+        Some(table) => table,
+        None => return -libc::EINVAL,
+    };
+    let query = unsafe {
+        assert!(!query.is_null() || query_len == 0);
+        slice::from_raw_parts(query, query_len as usize)
+    };
+    if query.is_empty() || query.iter().any(|&cell| cell as usize >= decode::ENCODING_LEN) {
+        return -libc::EINVAL;
+    }
+    // Copy out what we need rather than hold the lock while decoding,
+    // which would keep loads from publishing pages or finishing.
+    let (format, lines, map, to_scan) = {
+        let books = BOOKS.read().unwrap();
+        let book = match books.get(&handle) {
+            Some(book) if book.complete => book,
+            _ => {
+                println!("book {} is unknown.", handle);
+                return -libc::ENOENT;
+            }
+        };
+        let format = match book_format(&book.key.0) {
+            Some(format) => format,
+            None => return -libc::EINVAL,
+        };
+        let map = match book.map {
+            Some(ref map) => map.clone(),
+            None => return -libc::ENODATA,
+        };
+        let lines = book.lines();
+        let candidates = book.search.as_ref().and_then(|search| {
+            let alternatives: Vec<Option<Vec<u8>>> = query
+                .iter()
+                .map(|&cell| search_symbols(format, &table, cell))
+                .collect();
+            search.candidates(&alternatives)
+        });
+        let candidates = match candidates {
+            Some(candidates) => candidates,
+            None => (0..book.page_count()).collect(),
+        };
+        let to_scan: Vec<(PageNumber, PageExtent, Vec<PageExtent>)> = candidates
+            .into_iter()
+            .map(|page| {
+                let rows = book.rows(page, lines).map(|row| book.row(row)).collect();
+                (page, book.page(page), rows)
+            })
+            .collect();
+        (format, lines, map, to_scan)
+    };
+    let mut found = Vec::new();
+    for (page, extent, rows) in to_scan {
+        let raw = match map_extent(&map, &extent) {
+            Ok(raw) => raw,
+            Err(e) => return e,
+        };
+        let mut matcher = search::Matcher::new(query, width as usize, lines as usize);
+        decode_page(format, raw, &extent, &rows, &table, &mut matcher);
+        if matcher.found() {
+            found.push(page);
+        }
+    }
+    if max_pages > 0 {
+        let pages = unsafe {
+            assert!(!pages.is_null());
+            slice::from_raw_parts_mut(pages, max_pages as usize)
+        };
+        for (slot, &page) in pages.iter_mut().zip(found.iter()) {
+            *slot = page;
+        }
+    }
+    found.len().min(MAX_PAGES) as i32
+}
+
+// The symbols (see search.rs) that could decode to `cell` in a book of
+// `format`, or None if it's not only ever decoded from symbols.
+fn search_symbols(format: BookFormat, table: &EncodingTable, cell: u8) -> Option<Vec<u8>> {
+    if cell == 0 {
+        // Anything outside ASCII decodes to a blank cell.
+        return None;
+    }
+    match format {
+        BookFormat::Brf => {
+            let mut symbols = Vec::new();
+            for b in 0..0x80 {
+                if table.byte_cell(b) == cell {
+                    symbols.push(search::brf_symbol(b)?);
+                }
+            }
+            symbols.sort_unstable();
+            symbols.dedup();
+            Some(symbols)
+        }
+        BookFormat::Pef => search::pef_symbol(cell).map(|symbol| vec![symbol]),
+    }
+}
+
+#[no_mangle]
+pub extern "C" fn get_page_rows(
+    book: Handle,
+    page: PageNumber,
+    count: u32,
+    rows: *mut PageExtent,
+) -> i32 {
+    let handle = book;
+    let books = BOOKS.read().unwrap();
+    let book = match books.get(&handle) {
+        Some(book) => book,
+        None => {
+            println!("book {} is unknown.", handle);
+            return -libc::ENOENT;
+        }
+    };
+    if page >= book.page_count() {
+        return -libc::EFAULT;
+    }
+    let page_rows = book.rows(page, book.lines());
+    let row_count = page_rows.len();
+    if count > 0 {
+        let rows = unsafe {
+            assert!(!rows.is_null());
+            slice::from_raw_parts_mut(rows, count as usize)
+        };
+        for (extent, row) in rows.iter_mut().zip(page_rows) {
+            *extent = book.row(row);
+        }
+    }
+    row_count as i32
+}
+
+#[no_mangle]
+pub extern "C" fn get_page_view(book: Handle, page: PageNumber) -> PageView {
+    let handle = book;
+    let books = BOOKS.read().unwrap();
+    let result = match books.get(&handle) {
+        None => {
+            println!("book {} is unknown.", handle);
+            Err(-libc::ENOENT)
+        }
+        Some(book) if page >= book.page_count() => Err(-libc::EFAULT),
+        Some(book) => book.mapped(&book.page(page)).map(|bytes| {
+            let previous = mem::replace(&mut *VIEWED.lock().unwrap(), book.map.clone());
+            // Unmapped (if it's not still in use) outside the lock.
+            drop(previous);
+            bytes
+        }),
+    };
+    match result {
+        Ok(bytes) => PageView {
+            status: 0,
+            data: bytes.as_ptr(),
+            length: bytes.len() as u64,
+        },
+        Err(status) => PageView {
+            status: status,
+            data: ptr::null(),
+            length: 0,
+        },
+    }
+}
+
+#[no_mangle]
+pub extern "C" fn get_load_progress(book: Handle) -> LoadProgress {
+    match BOOKS.read().unwrap().get(&book) {
+        Some(book) if book.complete || book.page_count() > 0 => LoadProgress {
+            page_count: book.page_count() as i32,
+            complete: book.complete as u8,
+        },
+        _ => LoadProgress {
+            page_count: -libc::ENOENT,
+            complete: 0,
+        },
+    }
+}
+
+#[no_mangle]
+pub extern "C" fn unload_book(book: Handle) -> UnixError {
+    let removed = {
+        let mut books = BOOKS.write().unwrap();
+        match books.get(&book).map(|book| book.complete) {
+            Some(true) => books.remove(&book),
+            Some(false) => return -libc::EBUSY,
+            None => return -libc::ENOENT,
+        }
+    };
+    // Freed outside the lock.
+    drop(removed);
+    files::forget(book);
+    0
+}
+
+#[no_mangle]
+pub extern "C" fn get_index_memory(book: Handle) -> i64 {
+    let books = BOOKS.read().unwrap();
+    if book == 0 {
+        return books.values().map(|book| book.resident_bytes() as i64).sum();
+    }
+    match books.get(&book) {
+        Some(book) => book.resident_bytes() as i64,
+        None => -libc::ENOENT as i64,
+    }
+}
+
+const FORM_FEED: u8 = b'\x0C';
+
+// How much of a book to read at a time.
+const READ_LEN: usize = 64 * 1024;
+
+// BRF is treated as bytes, lines ending at each '\n', so that any file
+// can be indexed whatever its encoding (older translators often leave
+// stray high-bit bytes); decoding deals with whatever's in a line.
+fn index_brf<R: Read>(
+    mut reader: R,
     display_lines: NonZeroU8,
-) -> Option<BTreeMap<PageNumber, PageExtent>> {
+    progress: &mut Progress,
+) -> Option<Index> {
     let mut lines_in_cur_page = 0; // 0 means current page has no content yet
-    let mut line = String::new();
+    let mut cur_page_first = 0;
+    let mut index = Index::new();
 
-    let mut cur_page = PageExtent {
-        first: 0,
-        length: 0,
-    };
-    let mut map = BTreeMap::new();
+    let mut buf = vec![0; READ_LEN];
+    // Where in the file buf begins.
+    let mut offset: u64 = 0;
+    let mut at_line_start = true;
 
     loop {
-        line.clear();
-        let size = br.read_line(&mut line);
-        if !size.is_ok() {
+        let len = match reader.read(&mut buf) {
+            Ok(0) => break,
+            Ok(len) => len,
+            Err(ref e) if e.kind() == io::ErrorKind::Interrupted => continue,
             // Read error; return None so that we make no entry for this
             // book.
-            return None;
-        }
-        let mut size = size.unwrap();
-        if size == 0 {
-            // We hit EOF.
-            if lines_in_cur_page > 0 {
-                let total_pages = map.len() as PageNumber;
-                map.insert(total_pages, cur_page.clone());
+            Err(_) => return None,
+        };
+        let mut pos = 0;
+        while pos < len {
+            if at_line_start {
+                // A page ends either at a form feed (which can only be
+                // seen at the beginning of the line after it) or when
+                // the next line won't fit.
+                let form_feed = buf[pos] == FORM_FEED;
+                if (form_feed && lines_in_cur_page > 0) || lines_in_cur_page == display_lines.get() {
+                    index.page_starts.push(cur_page_first);
+                    cur_page_first = offset + pos as u64;
+                    lines_in_cur_page = 0;
+                    // Assumptions about FFs, based on a search of all BRFs
+                    // in our available library:
+                    //  * FFs only ever follow line endings; i.e.:
+                    //    * may end a file, but can't begin one
+                    //    * never embedded within a line
+                    //    * there's only ever zero or one after a line
+                    //      ending
+                    if form_feed {
+                        // Don't include FF in the next page.  It's not
+                        // excluded from this one, since it's only
+                        // recorded where pages begin.
+                        cur_page_first += 1;
+                    }
+                    progress.update(&index, cur_page_first);
+                }
+                lines_in_cur_page += 1;
+                at_line_start = false;
             }
-            return Some(map);
-        }
-        //println!("line {} is {} chars", lines_in_cur_page, size);
-
-        // BufRead doesn't have lookahead and has a fixed idea of lines, making
-        // this slightly difficult to reason about: one of the two ways to end
-        // a page, encountering a form feed, can't be detected until you see
-        // the beginning of the next line.  So we've already grabbed a line and
-        // have to decide whether the previous line was the last in its page or
-        // not.
-        if (line.starts_with(FORM_FEED) && lines_in_cur_page > 0)
-            || lines_in_cur_page == display_lines.get()
-        {
-            // Either we've seen the page terminator or we've seen a new
-            // line that will fill the page.  Tie off the existing page
-            // *without* newly read line.
-            let cur_page_num = map.len() as PageNumber;
-            map.insert(cur_page_num, cur_page.clone());
-            cur_page.first += cur_page.length as u32;
-            cur_page.length = 0;
-            lines_in_cur_page = 0;
-            // Assumptions about FFs, based on a search of all BRFs in our
-            // available library:
-            //  * FFs only ever follow line endings; i.e.:
-            //    * may end a file, but can't begin one
-            //    * never embedded within a line
-            //    * there's only ever zero or one after a line ending
-            if line.starts_with(FORM_FEED) {
-                // Don't include FF in the next page.
-                cur_page.first += 1;
-                size -= 1;
+            match memchr(b'\n', &buf[pos..len]) {
+                Some(newline) => {
+                    pos += newline + 1;
+                    at_line_start = true;
+                }
+                None => pos = len,
             }
         }
-        cur_page.length += size as u16;
-        lines_in_cur_page += 1;
+        offset += len as u64;
+    }
+
+    if lines_in_cur_page > 0 {
+        index.page_starts.push(cur_page_first);
+        cur_page_first = offset;
     }
+    index.page_starts.push(cur_page_first);
+    Some(index)
 }
 
 // We follow the original algorithm from the Python for pagination:
 //  * hoover all rows up into a pageless list
 //  * paginate by book height
 //  * pad the final page
-// That unfortunately means that a PageExtent can span XML pages.
-// What we return is the extent from the '<' of the first <row> to the
-// '>' of the last, and then lumber the caller with discarding:
-//  * the initial <row>
-//  * anything between </row> and <row> (even <page> or </page>)
-//  * the final </row>
-// Maybe this horror will go away if we move to rust-cpython.
-//
-// Even more horrid: quick_xml doesn't give us any handle on the entire
-// original tag so we have to assume XML doesn't use whitespace inside
-// tags, and then do shonky maths on assumed tag lengths.
-//
-fn index_pef(
-    br: BufReader<File>,
+// That unfortunately means that a page can span XML pages, so each
+// runs from the start of its first <row> to that of the next page's
+// (or the end of the book), and may include the likes of </page> and
+// <page> between rows.  Hence the row spans, so that the caller can
+// pick out each row without parsing any markup.
+fn index_pef<R: Read>(
+    mut reader: R,
     display_lines: NonZeroU8,
-) -> Option<BTreeMap<PageNumber, PageExtent>> {
-    let mut reader = Reader::from_reader(br);
-
+    progress: &mut Progress,
+) -> Option<Index> {
     let mut lines_in_cur_page = 0;
-    let mut buf = Vec::new();
-    let mut done = false;
+    let mut cur_page_first = 0;
+    let mut index = Index::new();
 
-    let mut cur_page = PageExtent {
-        first: 0,
-        length: 0,
-    };
-    let mut map = BTreeMap::new();
-
-    while !done {
-        match reader.read_event(&mut buf) {
-            Ok(Event::Start(ref e)) => {
-                match e.name() {
-                    b"row" => {
-                        if lines_in_cur_page == 0 {
-                            cur_page.first = (reader.buffer_position() - "<row>".len()) as u32;
-                        }
-                    }
-                    _ => (),
-                }
-            }
-            Ok(Event::End(ref e)) => {
-                match e.name() {
-                    b"row" => {
-                        lines_in_cur_page += 1;
-                        if lines_in_cur_page == display_lines.get() {
-                            cur_page.length =
-                                (reader.buffer_position() as u32 - cur_page.first) as u16;
-                            lines_in_cur_page = 0;
-                        }
-                    }
-                    _ => (),
-                }
+    let mut scanner = pef::Scanner::new();
+    let mut buf = vec![0; READ_LEN];
+
+    loop {
+        let len = match reader.read(&mut buf) {
+            Ok(0) => break,
+            Ok(len) => len,
+            Err(ref e) if e.kind() == io::ErrorKind::Interrupted => continue,
+            Err(_) => return None,
+        };
+        scanner.scan(&buf[..len], |row| {
+            if lines_in_cur_page == 0 {
+                cur_page_first = row.first;
             }
-            Ok(Event::Empty(e)) => match e.name() {
-                b"row" => {
-                    lines_in_cur_page += 1;
-                    if lines_in_cur_page == display_lines.get() {
-                        cur_page.length = (reader.buffer_position() as u32 - cur_page.first) as u16;
-                        lines_in_cur_page = 0;
-                    }
-                }
-                _ => (),
-            },
-            Ok(Event::Eof) => {
-                cur_page.length = (reader.buffer_position() as u32 - cur_page.first) as u16;
-                done = true;
+            index.row_bounds.push(row.content_first);
+            index.row_bounds.push(row.content_end);
+            lines_in_cur_page += 1;
+            if lines_in_cur_page == display_lines.get() {
+                index.page_starts.push(cur_page_first);
+                lines_in_cur_page = 0;
+                progress.update(&index, row.end);
             }
-            Err(_) => return None,
-            _ => (),
-        }
-        if cur_page.length != 0 {
-            let total_pages = map.len() as PageNumber;
-            map.insert(total_pages, cur_page.clone());
-            cur_page.first += cur_page.length as u32;
-            cur_page.length = 0;
-        }
+        });
+    }
+    progress.parse_errors = scanner.errors();
+    // Give up on a book that ends mid-tag, as it's likely truncated.
+    if !scanner.at_text() {
+        progress.parse_errors += 1;
+        return None;
+    }
 
-        // Apparently this minimises memory usage.
-        buf.clear();
+    if lines_in_cur_page > 0 {
+        index.page_starts.push(cur_page_first);
     }
-    Some(map)
+    index.page_starts.push(scanner.offset());
+    Some(index)
 }
 
 fn stringify(bookpath: *const c_char) -> String {
@@ -0,0 +1,113 @@
+// Read-only memory maps of whole books, so that once a book is indexed
+// its pages can be read (and decoded) with no syscalls at all, as long
+// as they're in the page cache.
+//
+// A map shows the book as it is on disk, not as it was when mapped, so
+// if the book is truncated (or its media removed) while mapped, reading
+// past its new end raises SIGBUS.  Books are expected not to change
+// under us, as they're only ever replaced wholesale, but media can be
+// removed at any time, so only the book being read is kept mapped.
+
+use std::fmt;
+use std::fs::{self, File};
+use std::io;
+use std::os::unix::fs::MetadataExt;
+use std::os::unix::io::AsRawFd;
+use std::ptr;
+use std::slice;
+
+use libc::{c_void, mmap, munmap, MAP_FAILED, MAP_SHARED, PROT_READ};
+
+// What a book was when mapped, to tell whether a map is still of the
+// same book.
+#[derive(Eq, PartialEq, Debug, Copy, Clone)]
+struct Identity {
+    dev: u64,
+    ino: u64,
+    size: u64,
+    mtime_sec: i64,
+    mtime_nsec: i64,
+}
+
+impl Identity {
+    fn of(meta: &fs::Metadata) -> Identity {
+        Identity {
+            dev: meta.dev(),
+            ino: meta.ino(),
+            size: meta.len(),
+            mtime_sec: meta.mtime(),
+            mtime_nsec: meta.mtime_nsec(),
+        }
+    }
+}
+
+pub struct Map {
+    // Null for an empty book, which can't be mapped (and needn't be).
+    ptr: *mut c_void,
+    len: usize,
+    identity: Identity,
+}
+
+// The map is read-only, so can be read from any thread.
+unsafe impl Send for Map {}
+unsafe impl Sync for Map {}
+
+impl Map {
+    pub fn open(bookpath: &str) -> io::Result<Map> {
+        let f = File::open(bookpath)?;
+        let meta = f.metadata()?;
+        let identity = Identity::of(&meta);
+        if meta.len() > usize::max_value() as u64 {
+            return Err(io::Error::from_raw_os_error(::libc::EFBIG));
+        }
+        let len = meta.len() as usize;
+        if len == 0 {
+            return Ok(Map {
+                ptr: ptr::null_mut(),
+                len: 0,
+                identity: identity,
+            });
+        }
+        let ptr = unsafe { mmap(ptr::null_mut(), len, PROT_READ, MAP_SHARED, f.as_raw_fd(), 0) };
+        if ptr == MAP_FAILED {
+            return Err(io::Error::last_os_error());
+        }
+        // The map outlives the file being closed.
+        Ok(Map {
+            ptr: ptr,
+            len: len,
+            identity: identity,
+        })
+    }
+
+    // Whether this is still a map of what's at `bookpath`.
+    pub fn is_current(&self, bookpath: &str) -> bool {
+        match fs::metadata(bookpath) {
+            Ok(meta) => Identity::of(&meta) == self.identity,
+            Err(_) => false,
+        }
+    }
+
+    pub fn bytes(&self) -> &[u8] {
+        if self.ptr.is_null() {
+            return &[];
+        }
+        unsafe { slice::from_raw_parts(self.ptr as *const u8, self.len) }
+    }
+}
+
+impl fmt::Debug for Map {
+    fn fmt(&self, f: &mut fmt::Formatter) -> fmt::Result {
+        write!(f, "Map {{ len: {} }}", self.len)
+    }
+}
+
+impl Drop for Map {
+    fn drop(&mut self) {
+        if !self.ptr.is_null() {
+            unsafe {
+                munmap(self.ptr, self.len);
+            }
+        }
+    }
+}
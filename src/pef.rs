@@ -0,0 +1,343 @@
+// A streaming scanner that finds the <row> elements of a PEF, with the
+// exact byte offsets of each row's tags and content.
+//
+// It's fed a book a buffer at a time and keeps just enough state to
+// carry a tag (or comment, etc.) over from one buffer to the next, so
+// it allocates nothing however the markup falls.  It's no validating
+// parser, but copes with what real PEFs contain:
+//
+//  * attributes and whitespace within tags, e.g. `<row rowgap="1">`,
+//    `</row >`, `<row/>`, including '>' and '/' within quoted values
+//  * namespace prefixes, e.g. `<pef:row>`; any prefix is accepted,
+//    since PEFs only ever use the one namespace
+//  * comments, CDATA sections, processing instructions and the XML and
+//    DOCTYPE declarations, within which nothing is taken for a row
+//
+// The content of a row is whatever lies between its start and end
+// tags, so may itself contain markup (CDATA, say); see decode.rs.  A
+// row that's never closed, or an end tag with no row open, is counted
+// as an error (see errors()) and otherwise ignored.
+
+use memchr::memchr;
+
+// Where a row lies: its start tag begins at `first` and its end tag
+// ends at `end`, with `content_first` to `content_end` between them.
+// For `<row/>`, all but `first` are where the tag ends.
+#[derive(Debug, Copy, Clone, PartialEq, Eq)]
+pub struct Row {
+    pub first: u64,
+    pub content_first: u64,
+    pub content_end: u64,
+    pub end: u64,
+}
+
+#[derive(Debug, Copy, Clone, PartialEq, Eq)]
+enum State {
+    // Character data, outside any markup.
+    Text,
+    // Just after '<'.
+    Open,
+    // In the name of a start tag (or an end tag).
+    Name { end_tag: bool },
+    // In a start tag after its name; `slash` if the last thing outside
+    // quotes was '/', making it an empty element if '>' follows.
+    Attributes { quote: Option<u8>, slash: bool },
+    // In an end tag after its name.
+    EndTagRest,
+    // Just after "<!", then "<!-".
+    Bang,
+    BangDash,
+    // After "<!", having matched `matched` bytes of "[CDATA[".
+    CDataOpen { matched: usize },
+    // Within a comment, CDATA section or processing instruction,
+    // waiting for its terminator.
+    Comment,
+    CData,
+    Pi,
+    // Within a DOCTYPE or similar, `depth` square brackets deep.
+    Declaration { depth: u32 },
+}
+
+const CDATA_OPEN: &[u8] = b"[CDATA[";
+const ROW: &[u8] = b"row";
+
+pub struct Scanner {
+    state: State,
+    // Where the next buffer begins in the book.
+    offset: u64,
+    // Where the tag being scanned begins.
+    tag_first: u64,
+    // How much of the local part of the tag's name has matched "row",
+    // or None once it can't.
+    name_matched: Option<usize>,
+    // How many of the terminator's repeated byte ('-' of "-->", etc.)
+    // immediately precede.
+    run: usize,
+    // Where the open row's start tag and content begin.
+    open_row: Option<(u64, u64)>,
+    // Malformed rows ignored so far.
+    errors: u32,
+}
+
+impl Scanner {
+    pub fn new() -> Scanner {
+        Scanner {
+            state: State::Text,
+            offset: 0,
+            tag_first: 0,
+            name_matched: Some(0),
+            run: 0,
+            open_row: None,
+            errors: 0,
+        }
+    }
+
+    // How many bytes have been scanned.
+    pub fn offset(&self) -> u64 {
+        self.offset
+    }
+
+    // How many malformed rows have been ignored.
+    pub fn errors(&self) -> u32 {
+        self.errors
+    }
+
+    // Whether scanning stopped outside any markup, as it should at the
+    // end of a well-formed book.
+    pub fn at_text(&self) -> bool {
+        self.state == State::Text
+    }
+
+    // Scans the next `buf` of the book, calling `on_row` for each row
+    // as its end is reached.
+    pub fn scan<F: FnMut(Row)>(&mut self, buf: &[u8], mut on_row: F) {
+        let mut pos = 0;
+        while pos < buf.len() {
+            if self.state == State::Text {
+                match memchr(b'<', &buf[pos..]) {
+                    Some(lt) => {
+                        pos += lt;
+                        self.tag_first = self.offset + pos as u64;
+                        self.state = State::Open;
+                        pos += 1;
+                        continue;
+                    }
+                    None => break,
+                }
+            }
+            let b = buf[pos];
+            // Where the byte after this one is.
+            let next = self.offset + pos as u64 + 1;
+            self.state = match self.state {
+                State::Text => unreachable!(),
+                State::Open => match b {
+                    b'/' => {
+                        self.name_matched = Some(0);
+                        State::Name { end_tag: true }
+                    }
+                    b'!' => State::Bang,
+                    b'?' => {
+                        self.run = 0;
+                        State::Pi
+                    }
+                    _ => {
+                        self.name_matched = Some(0);
+                        self.start_tag_name(b, next, &mut on_row)
+                    }
+                },
+                State::Name { end_tag: false } => self.start_tag_name(b, next, &mut on_row),
+                State::Name { end_tag: true } => match b {
+                    b'>' => self.end_tag(next, &mut on_row),
+                    _ if is_space(b) => State::EndTagRest,
+                    _ => {
+                        self.match_name(b);
+                        State::Name { end_tag: true }
+                    }
+                },
+                State::Attributes {
+                    quote: Some(quote),
+                    slash,
+                } => {
+                    if b == quote {
+                        State::Attributes {
+                            quote: None,
+                            slash: false,
+                        }
+                    } else {
+                        State::Attributes {
+                            quote: Some(quote),
+                            slash: slash,
+                        }
+                    }
+                }
+                State::Attributes { quote: None, slash } => match b {
+                    b'>' => self.start_tag(slash, next, &mut on_row),
+                    b'"' | b'\'' => State::Attributes {
+                        quote: Some(b),
+                        slash: false,
+                    },
+                    b'/' => State::Attributes {
+                        quote: None,
+                        slash: true,
+                    },
+                    _ if is_space(b) => State::Attributes {
+                        quote: None,
+                        slash: slash,
+                    },
+                    _ => State::Attributes {
+                        quote: None,
+                        slash: false,
+                    },
+                },
+                State::EndTagRest => match b {
+                    b'>' => self.end_tag(next, &mut on_row),
+                    _ => State::EndTagRest,
+                },
+                State::Bang => match b {
+                    b'-' => State::BangDash,
+                    b'[' => State::CDataOpen { matched: 1 },
+                    _ => self.declaration(b, 0),
+                },
+                State::BangDash => match b {
+                    b'-' => {
+                        self.run = 0;
+                        State::Comment
+                    }
+                    _ => self.declaration(b, 0),
+                },
+                State::CDataOpen { matched } => {
+                    if b != CDATA_OPEN[matched] {
+                        self.declaration(b, 1)
+                    } else if matched + 1 == CDATA_OPEN.len() {
+                        self.run = 0;
+                        State::CData
+                    } else {
+                        State::CDataOpen {
+                            matched: matched + 1,
+                        }
+                    }
+                }
+                State::Comment => {
+                    if self.terminates(b, b'-', 2) {
+                        State::Text
+                    } else {
+                        State::Comment
+                    }
+                }
+                State::CData => {
+                    if self.terminates(b, b']', 2) {
+                        State::Text
+                    } else {
+                        State::CData
+                    }
+                }
+                State::Pi => {
+                    if self.terminates(b, b'?', 1) {
+                        State::Text
+                    } else {
+                        State::Pi
+                    }
+                }
+                State::Declaration { depth } => self.declaration(b, depth),
+            };
+            pos += 1;
+        }
+        self.offset += buf.len() as u64;
+    }
+
+    fn start_tag_name<F: FnMut(Row)>(&mut self, b: u8, next: u64, on_row: &mut F) -> State {
+        match b {
+            b'>' => self.start_tag(false, next, on_row),
+            b'/' => State::Attributes {
+                quote: None,
+                slash: true,
+            },
+            _ if is_space(b) => State::Attributes {
+                quote: None,
+                slash: false,
+            },
+            _ => {
+                self.match_name(b);
+                State::Name { end_tag: false }
+            }
+        }
+    }
+
+    fn match_name(&mut self, b: u8) {
+        self.name_matched = match self.name_matched {
+            // A namespace prefix ends; start again on the local part.
+            _ if b == b':' => Some(0),
+            Some(matched) if matched < ROW.len() && b == ROW[matched] => Some(matched + 1),
+            _ => None,
+        };
+    }
+
+    fn is_row(&self) -> bool {
+        self.name_matched == Some(ROW.len())
+    }
+
+    // A start tag ends just before `next`.
+    fn start_tag<F: FnMut(Row)>(&mut self, empty: bool, next: u64, on_row: &mut F) -> State {
+        if self.is_row() {
+            if self.open_row.is_some() {
+                self.errors += 1;
+            }
+            if empty {
+                self.open_row = None;
+                on_row(Row {
+                    first: self.tag_first,
+                    content_first: next,
+                    content_end: next,
+                    end: next,
+                });
+            } else {
+                self.open_row = Some((self.tag_first, next));
+            }
+        }
+        State::Text
+    }
+
+    // An end tag ends just before `next`.
+    fn end_tag<F: FnMut(Row)>(&mut self, next: u64, on_row: &mut F) -> State {
+        if self.is_row() {
+            match self.open_row.take() {
+                Some((first, content_first)) => on_row(Row {
+                    first: first,
+                    content_first: content_first,
+                    content_end: self.tag_first,
+                    end: next,
+                }),
+                None => self.errors += 1,
+            }
+        }
+        State::Text
+    }
+
+    fn declaration(&mut self, b: u8, depth: u32) -> State {
+        match b {
+            b'>' if depth == 0 => State::Text,
+            b'[' => State::Declaration { depth: depth + 1 },
+            b']' => State::Declaration {
+                depth: depth.saturating_sub(1),
+            },
+            _ => State::Declaration { depth: depth },
+        }
+    }
+
+    // Whether `b` is the '>' ending a terminator of at least `count`
+    // `repeated` bytes then '>', e.g. "-->".
+    fn terminates(&mut self, b: u8, repeated: u8, count: usize) -> bool {
+        if b == b'>' && self.run >= count {
+            return true;
+        }
+        self.run = if b == repeated { self.run + 1 } else { 0 };
+        false
+    }
+}
+
+fn is_space(b: u8) -> bool {
+    match b {
+        b' ' | b'\t' | b'\r' | b'\n' => true,
+        _ => false,
+    }
+}
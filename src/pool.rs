@@ -0,0 +1,161 @@
+// A fixed-size pool of indexing threads with two priority lanes.
+//
+// A thread per book is fine on a desktop but on a single-core Pi it
+// means dozens of threads fighting over the SD card while the user
+// waits for the one book they actually opened.  Instead jobs queue in
+// one of two lanes and a small number of workers take them in order,
+// always emptying the foreground lane before touching the background
+// one.  A job that's already running is never pre-empted, so a
+// foreground request waits for at most one background job per worker.
+
+use std::collections::VecDeque;
+use std::panic;
+use std::sync::{Condvar, Mutex};
+use std::thread;
+
+// Upper bound on the default size; more workers than this will just be
+// queueing on the same storage.
+const MAX_DEFAULT_WORKERS: usize = 4;
+
+#[derive(Debug, Copy, Clone, PartialEq, Eq)]
+pub enum Priority {
+    Foreground,
+    Background,
+}
+
+impl Priority {
+    pub fn from_ffi(priority: u8) -> Option<Priority> {
+        match priority {
+            0 => Some(Priority::Foreground),
+            1 => Some(Priority::Background),
+            _ => None,
+        }
+    }
+}
+
+// Calling a boxed FnOnce directly needs a newer Rust than we build with,
+// hence the usual workaround of a trait taking the box by value.
+trait FnBox {
+    fn call_box(self: Box<Self>);
+}
+
+impl<F: FnOnce()> FnBox for F {
+    fn call_box(self: Box<Self>) {
+        (*self)()
+    }
+}
+
+type Job = Box<dyn FnBox + Send + 'static>;
+
+struct Queues {
+    foreground: VecDeque<Job>,
+    background: VecDeque<Job>,
+    // Zero until set or defaulted.
+    size: usize,
+    started: bool,
+}
+
+struct Pool {
+    queues: Mutex<Queues>,
+    available: Condvar,
+}
+
+lazy_static! {
+    static ref POOL: Pool = Pool {
+        queues: Mutex::new(Queues {
+            foreground: VecDeque::new(),
+            background: VecDeque::new(),
+            size: 0,
+            started: false,
+        }),
+        available: Condvar::new(),
+    };
+}
+
+// Fix the number of workers.  Only possible before the first job is
+// submitted, since workers are started then and never stop.
+pub fn set_size(size: usize) -> Result<(), i32> {
+    if size == 0 {
+        return Err(-::libc::EINVAL);
+    }
+    let mut queues = POOL.queues.lock().unwrap();
+    if queues.started {
+        return Err(-::libc::EBUSY);
+    }
+    queues.size = size;
+    Ok(())
+}
+
+pub fn size() -> usize {
+    let mut queues = POOL.queues.lock().unwrap();
+    if queues.size == 0 {
+        queues.size = default_size();
+    }
+    queues.size
+}
+
+// Number of jobs waiting in `priority`'s lane, not counting any that
+// are already running.
+pub fn queue_depth(priority: Priority) -> usize {
+    let queues = POOL.queues.lock().unwrap();
+    match priority {
+        Priority::Foreground => queues.foreground.len(),
+        Priority::Background => queues.background.len(),
+    }
+}
+
+pub fn submit<F>(priority: Priority, job: F)
+where
+    F: FnOnce() + Send + 'static,
+{
+    let mut queues = POOL.queues.lock().unwrap();
+    if !queues.started {
+        if queues.size == 0 {
+            queues.size = default_size();
+        }
+        for i in 0..queues.size {
+            thread::Builder::new()
+                .name(format!("indexer-{}", i))
+                .spawn(work)
+                .expect("failed to start indexing thread");
+        }
+        queues.started = true;
+    }
+    match priority {
+        Priority::Foreground => queues.foreground.push_back(Box::new(job)),
+        Priority::Background => queues.background.push_back(Box::new(job)),
+    }
+    POOL.available.notify_one();
+}
+
+fn work() {
+    loop {
+        let job = {
+            let mut queues = POOL.queues.lock().unwrap();
+            loop {
+                if let Some(job) = queues.foreground.pop_front() {
+                    break job;
+                }
+                if let Some(job) = queues.background.pop_front() {
+                    break job;
+                }
+                queues = POOL.available.wait(queues).unwrap();
+            }
+        };
+        // A panicking job mustn't take its worker down with it, or the
+        // pool would shrink until nothing gets indexed at all.  The
+        // panic message has already been printed by the default hook.
+        // Jobs that must report their outcome whatever happens catch
+        // their own panics first.
+        let _ = panic::catch_unwind(panic::AssertUnwindSafe(move || job.call_box()));
+    }
+}
+
+fn default_size() -> usize {
+    let cpus = unsafe { ::libc::sysconf(::libc::_SC_NPROCESSORS_ONLN) };
+    if cpus < 1 {
+        1
+    } else {
+        (cpus as usize).min(MAX_DEFAULT_WORKERS)
+    }
+}
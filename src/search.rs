@@ -0,0 +1,298 @@
+// An optional trigram index of a book's text, so that searching it
+// need only decode the pages that might match rather than every page.
+//
+// Text is indexed as symbols: for BRF, bytes of printable Braille ASCII
+// other than space, with lower case folded to upper case as decoding
+// does; for PEF, non-blank cells.  Every run of three symbols within a
+// line is a trigram, and anything else (a space, a blank cell, a byte
+// outside ASCII, the end of a line) breaks a run.  A page on which a
+// query appears must hold every trigram of the query, so only pages
+// holding all of them need be decoded and checked; the index narrows a
+// search but never decides it.  Symbols don't depend on the encoding,
+// so neither does the index.
+//
+// The index is kept compact by storing, for each distinct trigram, the
+// pages it's on as varint-encoded differences between page numbers.
+
+use std::fmt;
+use std::mem;
+use std::u32;
+
+use decode::Lines;
+
+pub struct SearchIndex {
+    // Distinct trigrams, sorted.
+    trigrams: Vec<u32>,
+    // Where each trigram's pages begin in `postings`, then where the
+    // last trigram's end.
+    offsets: Vec<u32>,
+    postings: Vec<u8>,
+}
+
+impl fmt::Debug for SearchIndex {
+    fn fmt(&self, f: &mut fmt::Formatter) -> fmt::Result {
+        write!(f, "SearchIndex {{ trigrams: {} }}", self.trigrams.len())
+    }
+}
+
+// Collects trigrams page by page as a book's symbols are fed in.
+pub struct Builder {
+    // (trigram, page) pairs, as trigram << 32 | page.
+    pairs: Vec<u64>,
+    page: u32,
+    // The last two symbols, if the current run is that long.
+    run: [u32; 2],
+    run_len: usize,
+}
+
+impl Builder {
+    pub fn new() -> Builder {
+        Builder {
+            pairs: Vec::new(),
+            page: 0,
+            run: [0; 2],
+            run_len: 0,
+        }
+    }
+
+    pub fn symbol(&mut self, symbol: u8) {
+        let symbol = symbol as u32;
+        if self.run_len == 2 {
+            let trigram = self.run[0] << 16 | self.run[1] << 8 | symbol;
+            self.pairs.push((trigram as u64) << 32 | self.page as u64);
+            self.run = [self.run[1], symbol];
+        } else {
+            self.run[self.run_len] = symbol;
+            self.run_len += 1;
+        }
+    }
+
+    // Breaks the current run of symbols.
+    pub fn gap(&mut self) {
+        self.run_len = 0;
+    }
+
+    pub fn end_page(&mut self) {
+        self.gap();
+        self.page += 1;
+    }
+
+    // Returns None if the index would be too big to address.
+    pub fn finish(mut self) -> Option<SearchIndex> {
+        self.pairs.sort_unstable();
+        self.pairs.dedup();
+        let mut index = SearchIndex {
+            trigrams: Vec::new(),
+            offsets: Vec::new(),
+            postings: Vec::new(),
+        };
+        let mut last_page = 0;
+        for pair in self.pairs {
+            let (trigram, page) = ((pair >> 32) as u32, pair as u32);
+            if index.trigrams.last() != Some(&trigram) {
+                index.trigrams.push(trigram);
+                index.offsets.push(index.postings.len() as u32);
+                last_page = 0;
+            }
+            put_varint(&mut index.postings, page - last_page);
+            last_page = page;
+            if index.postings.len() > u32::MAX as usize {
+                return None;
+            }
+        }
+        index.offsets.push(index.postings.len() as u32);
+        index.trigrams.shrink_to_fit();
+        index.offsets.shrink_to_fit();
+        index.postings.shrink_to_fit();
+        Some(index)
+    }
+}
+
+// Feeds the cells of PEF rows to a Builder, as decoded by pef_cells().
+pub struct PefSymbols<'a>(pub &'a mut Builder);
+
+impl<'a> Lines for PefSymbols<'a> {
+    fn push(&mut self, cell: u8) {
+        match pef_symbol(cell) {
+            Some(symbol) => self.0.symbol(symbol),
+            None => self.0.gap(),
+        }
+    }
+
+    fn end_line(&mut self) {
+        self.0.gap();
+    }
+
+    fn full(&self) -> bool {
+        false
+    }
+}
+
+// Looks for a query, as cells, within any one of the lines of a page
+// decoded into it; lines are clipped to the display's width, as a Grid
+// clips them, so that only what's shown is found, and there are only as
+// many as a page has.
+pub struct Matcher<'a> {
+    query: &'a [u8],
+    line: Vec<u8>,
+    width: usize,
+    lines_left: usize,
+    found: bool,
+}
+
+impl<'a> Matcher<'a> {
+    pub fn new(query: &'a [u8], width: usize, lines: usize) -> Matcher<'a> {
+        Matcher {
+            query: query,
+            line: Vec::new(),
+            width: width,
+            lines_left: lines,
+            found: false,
+        }
+    }
+
+    // Whether the query was found, once the whole page has been decoded.
+    pub fn found(mut self) -> bool {
+        self.end_line();
+        self.found
+    }
+}
+
+impl<'a> Lines for Matcher<'a> {
+    fn push(&mut self, cell: u8) {
+        if self.line.len() < self.width {
+            self.line.push(cell);
+        }
+    }
+
+    fn end_line(&mut self) {
+        if !self.found && self.lines_left > 0 {
+            self.found = self.line.windows(self.query.len()).any(|cells| cells == self.query);
+            self.lines_left -= 1;
+        }
+        self.line.clear();
+    }
+
+    fn full(&self) -> bool {
+        self.found || self.lines_left == 0
+    }
+}
+
+// How many combinations of symbols a query trigram may stand for before
+// it's not worth looking them all up.
+const MAX_ALTERNATIVES: usize = 8;
+
+impl SearchIndex {
+    // The pages that might hold a query, ascending; `alternatives` are
+    // the symbols that each of its cells might be in the book, or None
+    // if it might be anything, or isn't indexed.  Returns None if the
+    // query narrows nothing down, so any page might hold it.
+    pub fn candidates(&self, alternatives: &[Option<Vec<u8>>]) -> Option<Vec<u32>> {
+        let mut candidates: Option<Vec<u32>> = None;
+        for window in alternatives.windows(3) {
+            let (a, b, c) = match (&window[0], &window[1], &window[2]) {
+                (&Some(ref a), &Some(ref b), &Some(ref c)) => (a, b, c),
+                _ => continue,
+            };
+            if a.len() * b.len() * c.len() > MAX_ALTERNATIVES {
+                continue;
+            }
+            let mut pages = Vec::new();
+            for &a in a {
+                for &b in b {
+                    for &c in c {
+                        let trigram = (a as u32) << 16 | (b as u32) << 8 | c as u32;
+                        self.pages(trigram, &mut pages);
+                    }
+                }
+            }
+            pages.sort_unstable();
+            pages.dedup();
+            candidates = Some(match candidates {
+                Some(candidates) => intersect(&candidates, &pages),
+                None => pages,
+            });
+            if candidates.as_ref().map_or(false, |c| c.is_empty()) {
+                break;
+            }
+        }
+        candidates
+    }
+
+    // Appends the pages holding `trigram`.
+    fn pages(&self, trigram: u32, pages: &mut Vec<u32>) {
+        let i = match self.trigrams.binary_search(&trigram) {
+            Ok(i) => i,
+            Err(_) => return,
+        };
+        let mut postings = &self.postings[self.offsets[i] as usize..self.offsets[i + 1] as usize];
+        let mut page = 0;
+        while !postings.is_empty() {
+            page += get_varint(&mut postings);
+            pages.push(page);
+        }
+    }
+
+    pub fn allocated(&self) -> usize {
+        self.trigrams.capacity() * mem::size_of::<u32>()
+            + self.offsets.capacity() * mem::size_of::<u32>()
+            + self.postings.capacity()
+    }
+}
+
+// The symbol a BRF byte is indexed as, if any.
+pub fn brf_symbol(b: u8) -> Option<u8> {
+    match b {
+        0x21..=0x5f => Some(b),
+        0x60..=0x7f => Some(b - 0x20),
+        _ => None,
+    }
+}
+
+// The symbol a PEF cell is indexed as, if any.
+pub fn pef_symbol(cell: u8) -> Option<u8> {
+    if cell == 0 {
+        None
+    } else {
+        Some(cell)
+    }
+}
+
+fn intersect(a: &[u32], b: &[u32]) -> Vec<u32> {
+    let mut both = Vec::new();
+    let (mut i, mut j) = (0, 0);
+    while i < a.len() && j < b.len() {
+        if a[i] < b[j] {
+            i += 1;
+        } else if a[i] > b[j] {
+            j += 1;
+        } else {
+            both.push(a[i]);
+            i += 1;
+            j += 1;
+        }
+    }
+    both
+}
+
+fn put_varint(buf: &mut Vec<u8>, mut v: u32) {
+    while v >= 0x80 {
+        buf.push(v as u8 | 0x80);
+        v >>= 7;
+    }
+    buf.push(v as u8);
+}
+
+fn get_varint(buf: &mut &[u8]) -> u32 {
+    let mut v = 0;
+    let mut shift = 0;
+    while let Some((&b, rest)) = buf.split_first() {
+        *buf = rest;
+        v |= ((b & 0x7f) as u32) << shift;
+        if b & 0x80 == 0 {
+            break;
+        }
+        shift += 7;
+    }
+    v
+}
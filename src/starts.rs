@@ -0,0 +1,121 @@
+// Where each page of a book begins, in page order, followed by where
+// the last page ends; so there's always one more entry than there are
+// pages, and each page's length is the difference between its start
+// and the next.  Pages are dense and indexed in order, so nothing
+// cleverer is needed.
+//
+// Nearly every book is well under 4GiB, so offsets are kept as u32,
+// costing 4 bytes per page; only once an offset won't fit are they all
+// widened to u64.
+
+use std::mem;
+use std::u32;
+
+#[derive(Hash, Eq, PartialEq, Debug)]
+pub enum PageStarts {
+    Narrow(Vec<u32>),
+    Wide(Vec<u64>),
+}
+
+impl PageStarts {
+    pub fn new() -> PageStarts {
+        PageStarts::Narrow(Vec::new())
+    }
+
+    pub fn len(&self) -> usize {
+        match *self {
+            PageStarts::Narrow(ref starts) => starts.len(),
+            PageStarts::Wide(ref starts) => starts.len(),
+        }
+    }
+
+    pub fn get(&self, i: usize) -> u64 {
+        match *self {
+            PageStarts::Narrow(ref starts) => starts[i] as u64,
+            PageStarts::Wide(ref starts) => starts[i],
+        }
+    }
+
+    pub fn push(&mut self, start: u64) {
+        let widened = match *self {
+            PageStarts::Narrow(ref starts) if start > u32::MAX as u64 => {
+                Some(starts.iter().map(|&s| s as u64).collect())
+            }
+            _ => None,
+        };
+        if let Some(widened) = widened {
+            *self = PageStarts::Wide(widened);
+        }
+        match *self {
+            PageStarts::Narrow(ref mut starts) => starts.push(start as u32),
+            PageStarts::Wide(ref mut starts) => starts.push(start),
+        }
+    }
+
+    pub fn pop(&mut self) -> Option<u64> {
+        match *self {
+            PageStarts::Narrow(ref mut starts) => starts.pop().map(|s| s as u64),
+            PageStarts::Wide(ref mut starts) => starts.pop(),
+        }
+    }
+
+    // Appends the entries of `other` from `first` on.
+    pub fn extend_from(&mut self, other: &PageStarts, first: usize) {
+        for i in first..other.len() {
+            self.push(other.get(i));
+        }
+    }
+
+    pub fn shrink_to_fit(&mut self) {
+        match *self {
+            PageStarts::Narrow(ref mut starts) => starts.shrink_to_fit(),
+            PageStarts::Wide(ref mut starts) => starts.shrink_to_fit(),
+        }
+    }
+
+    // Bytes per entry.
+    pub fn width(&self) -> usize {
+        match *self {
+            PageStarts::Narrow(_) => mem::size_of::<u32>(),
+            PageStarts::Wide(_) => mem::size_of::<u64>(),
+        }
+    }
+
+    // Bytes allocated for entries.
+    pub fn allocated(&self) -> usize {
+        match *self {
+            PageStarts::Narrow(ref starts) => starts.capacity() * self.width(),
+            PageStarts::Wide(ref starts) => starts.capacity() * self.width(),
+        }
+    }
+}
+
+// All that indexing a book finds out about it.  For PEF that's also
+// where the content of each row lies, two entries per row (where it
+// begins and ends), so that a page can be decoded without parsing any
+// markup.  Every page but the last has exactly as many rows as there
+// are display lines, so the rows of page p follow from p alone.  BRF
+// has no rows.
+#[derive(Hash, Eq, PartialEq, Debug)]
+pub struct Index {
+    pub page_starts: PageStarts,
+    pub row_bounds: PageStarts,
+}
+
+impl Index {
+    pub fn new() -> Index {
+        Index {
+            page_starts: PageStarts::new(),
+            row_bounds: PageStarts::new(),
+        }
+    }
+
+    pub fn shrink_to_fit(&mut self) {
+        self.page_starts.shrink_to_fit();
+        self.row_bounds.shrink_to_fit();
+    }
+
+    pub fn allocated(&self) -> usize {
+        self.page_starts.allocated() + self.row_bounds.allocated()
+    }
+}
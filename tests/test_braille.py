@@ -21,3 +21,23 @@ class TestBraille(unittest.TestCase):
         width = 9
         truncated = braille.truncate_middle(inp, width)
         self.assertEqual(len(truncated), width)
+
+    def test_from_ascii_per_character(self):
+        alphas = ''.join(map(chr, range(0x300))) + '�⠁'
+        try:
+            for encoding in braille.BUILTIN_ENCODINGS:
+                braille.set_encoding(encoding)
+                self.assertEqual(braille.from_ascii(alphas),
+                                 tuple(map(braille.alpha_to_pin_num, alphas)))
+                self.assertEqual(braille.from_ascii(list(alphas)), braille.from_ascii(alphas))
+        finally:
+            braille.set_encoding(braille.DEFAULT_ENCODING)
+
+    def test_from_unicode_per_character(self):
+        unis = ''.join(map(chr, range(0x2900))) + '￿\U0001f600\U0010ffff'
+        self.assertEqual(braille.from_unicode(unis),
+                         tuple(map(braille.unicode_to_pin_num, unis)))
+        self.assertEqual(braille.from_unicode(list('⠁⡀a')), (1, 63, 0))
+        lines = ('⠁⠃', '', 'a⠉\U0001f600', '⣿')
+        self.assertEqual(braille.from_unicode_lines(lines),
+                         tuple(map(braille.from_unicode, lines)))
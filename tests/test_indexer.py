@@ -0,0 +1,576 @@
+import asyncio
+import errno
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from ui.book.book_file import BookFile, LoadState
+from ui.book.handlers import (BookFileError, _read_pages2, _decode, _decode_page_natively,
+                              _read_page, cancel_background_loads, discard_index, get_page_data,
+                              line_contains, load_book, load_totals, page_cache_stats,
+                              prefetch_pages, search_book, set_index_limit, set_page_cache_limit)
+from ui.book import handlers, indexer
+from ui import braille
+
+from .util import async_test
+
+# a handle no book has been given
+UNKNOWN = 2 ** 32 - 1
+
+
+class TestIndexCache(unittest.TestCase):
+    filename = 'tests/test-books/brf_test.BRF'
+
+    def setUp(self):
+        self.cachedir = tempfile.TemporaryDirectory()
+        self.assertEqual(indexer.set_cache_dir(self.cachedir.name), 0)
+
+    def tearDown(self):
+        # so that later loads don't write into a directory that's gone
+        self.assertEqual(indexer.set_cache_dir(''), 0)
+        self.cachedir.cleanup()
+
+    @async_test
+    async def test_reload_hits_cache(self):
+        before = indexer.get_cache_stats()
+        first = await _read_pages2(BookFile(self.filename, 40, 9))
+        second = await _read_pages2(BookFile(self.filename, 40, 9))
+        after = indexer.get_cache_stats()
+        self.assertEqual(second.load_state, LoadState.DONE)
+        self.assertEqual(second.num_pages, first.num_pages)
+        self.assertEqual(after.misses - before.misses, 1)
+        self.assertEqual(after.hits - before.hits, 1)
+        stats = indexer.get_load_stats(second.handle)
+        self.assertEqual((stats.cached, stats.bytes_read), (1, 0))
+
+    @async_test
+    async def test_corrupt_entry_rebuilt(self):
+        first = await _read_pages2(BookFile(self.filename, 40, 9))
+        for entry in os.listdir(self.cachedir.name):
+            with open(os.path.join(self.cachedir.name, entry), 'r+b') as f:
+                f.seek(-1, os.SEEK_END)
+                last = f.read(1)[0]
+                f.seek(-1, os.SEEK_END)
+                f.write(bytes([last ^ 0xff]))
+        before = indexer.get_cache_stats()
+        second = await _read_pages2(BookFile(self.filename, 40, 9))
+        after = indexer.get_cache_stats()
+        self.assertEqual(second.num_pages, first.num_pages)
+        self.assertEqual(after.invalid - before.invalid, 1)
+
+
+class TestPool(unittest.TestCase):
+    @async_test
+    async def test_size_fixed_once_started(self):
+        await _read_pages2(BookFile('tests/test-books/brf_break_test.brf', 40, 9),
+                           background=True)
+        self.assertGreater(indexer.get_pool_size(), 0)
+        self.assertEqual(indexer.set_pool_size(2), -errno.EBUSY)
+        self.assertEqual(indexer.get_queue_depths(), (0, 0))
+
+
+class TestIndexMemory(unittest.TestCase):
+    @async_test
+    async def test_memory_reported(self):
+        filename = 'tests/test-books/brf_test.BRF'
+        book = await _read_pages2(BookFile(filename, 40, 9))
+        used = indexer.get_index_memory(book.handle)
+        # four bytes per page plus a little overhead
+        self.assertGreaterEqual(used, 4 * book.num_pages)
+        self.assertLess(used, 4 * book.num_pages + 1024)
+        self.assertGreaterEqual(indexer.get_index_memory(), used)
+        self.assertEqual(indexer.get_index_memory(UNKNOWN), -errno.ENOENT)
+
+
+class TestGetPages(unittest.TestCase):
+    @async_test
+    async def test_window_matches_single_lookups(self):
+        filename = 'tests/test-books/brf_test.BRF'
+        book = await _read_pages2(BookFile(filename, 40, 9))
+        last = book.num_pages - 1
+        for page in (0, 3, last):
+            page_count, window = indexer.get_page_window(book.handle, page)
+            self.assertEqual(page_count, book.num_pages)
+            self.assertEqual(sorted(window),
+                             list(range(max(0, page - 5), min(last, page + 5) + 1)))
+            for n, extent in window.items():
+                single = indexer.get_page(book.handle, n)
+                self.assertEqual((extent.first, extent.length),
+                                 (single.first, single.length))
+
+    def test_unknown_book(self):
+        self.assertEqual(indexer.get_pages(UNKNOWN, 0, 3), (-errno.ENOENT, []))
+
+
+class TestCompletions(unittest.TestCase):
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), 'needs /proc/self/fd')
+    @async_test
+    async def test_concurrent_loads_share_one_pipe(self):
+        filenames = ['tests/test-books/brf_test.BRF',
+                     'tests/test-books/brf_break_test.brf',
+                     'tests/test-books/pef_test.pef']
+        await _read_pages2(BookFile(filenames[0], 40, 9))
+        fds = len(os.listdir('/proc/self/fd'))
+        books = await asyncio.gather(*(_read_pages2(BookFile(filename, 40, 9),
+                                                    background=True)
+                                       for filename in filenames * 3))
+        self.assertTrue(all(book.load_state == LoadState.DONE for book in books))
+        self.assertEqual(len(os.listdir('/proc/self/fd')), fds)
+
+    @async_test
+    async def test_failure_reported(self):
+        book = await _read_pages2(BookFile('tests/test-books/missing.brf', 40, 9))
+        self.assertEqual(book.load_state, LoadState.FAILED)
+
+
+class TestPageView(unittest.TestCase):
+    def tearDown(self):
+        indexer.set_current_book(None)
+
+    @async_test
+    async def test_view_matches_file(self):
+        filename = 'tests/test-books/pef_test.pef'
+        book = await _read_pages2(BookFile(filename, 40, 9))
+        indexer.set_current_book(book.handle)
+        with open(filename, 'rb') as f:
+            for page in (0, book.num_pages - 1):
+                extent = indexer.get_page(book.handle, page)
+                f.seek(extent.first)
+                self.assertEqual(bytes(indexer.get_page_view(book.handle, page)),
+                                 f.read(extent.length))
+        self.assertIsNone(indexer.get_page_view(book.handle, book.num_pages))
+        self.assertIsNone(indexer.get_page_view(UNKNOWN, 0))
+
+    @async_test
+    async def test_pages_read_without_reopening(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'mapped.brf')
+            with open(filename, 'w') as f:
+                f.write('abc\n' * 20)
+            book = await _read_pages2(BookFile(filename, 40, 9))
+            indexer.set_current_book(book.handle)
+            os.remove(filename)
+            self.assertEqual(_decode_page_natively(book, 1)[0][:3], braille.from_ascii('abc'))
+            self.assertEqual(bytes(indexer.get_page_view(book.handle, 2)), b'abc\nabc\n')
+            self.assertEqual(indexer.unload_book(book.handle), 0)
+
+    @async_test
+    async def test_only_current_book_mapped(self):
+        brf = await _read_pages2(BookFile('tests/test-books/brf_test.BRF', 40, 9))
+        pef = await _read_pages2(BookFile('tests/test-books/pef_test.pef', 40, 9))
+        self.assertIsNone(indexer.get_page_view(brf.handle, 0))
+        indexer.set_current_book(brf.handle)
+        self.assertIsNotNone(indexer.get_page_view(brf.handle, 0))
+        indexer.set_current_book(pef.handle)
+        self.assertIsNone(indexer.get_page_view(brf.handle, 0))
+        self.assertIsNotNone(indexer.get_page_view(pef.handle, 0))
+        # and again once reloaded
+        self.assertEqual(indexer.unload_book(pef.handle), 0)
+        pef = await _read_pages2(pef._replace(load_state=LoadState.INITIAL))
+        self.assertIsNotNone(indexer.get_page_view(pef.handle, 0))
+
+
+class TestSearch(unittest.TestCase):
+    def tearDown(self):
+        indexer.set_search_indexing(False)
+        indexer.set_current_book(None)
+
+    @async_test
+    async def test_indexed_matches_unindexed(self):
+        for filename in ('tests/test-books/brf_test.BRF',
+                         'tests/test-books/pef_test.pef'):
+            book = await _read_pages2(BookFile(filename, 40, 9))
+            pages = [await _read_page(book, page) for page in range(book.num_pages)]
+            # some of what's on the first and last pages, and something absent
+            queries = [tuple(line[:n]) for line in pages[0] + pages[-1] if line
+                       for n in (1, 3, 6)] + [(63,) * 40]
+            expected = {query: [n for n, page in enumerate(pages)
+                                if any(line_contains(line, query) for line in page)]
+                        for query in queries}
+            for indexed in (False, True):
+                indexer.set_search_indexing(indexed)
+                self.assertEqual(indexer.unload_book(book.handle), 0)
+                book = await _read_pages2(book._replace(load_state=LoadState.INITIAL))
+                indexer.set_current_book(book.handle)
+                for query in queries:
+                    if not any(query):
+                        continue
+                    count, found = indexer.search(book.handle, braille.mapping, query, 40)
+                    self.assertEqual(found, expected[query], (filename, indexed, query))
+                    self.assertEqual(count, len(found))
+
+    @async_test
+    async def test_hits_beyond_width_not_found(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'wide.brf')
+            with open(filename, 'w') as f:
+                f.write('X' * 38 + 'CAT DOG\n')
+            book = await _read_pages2(BookFile(filename, 40, 9))
+            indexer.set_current_book(book.handle)
+            for query, found in (('X', [0]), ('CA', [0]), ('CAT', []), ('DOG', [])):
+                query = tuple(braille.from_ascii(query))
+                self.assertEqual(search_book(book, query), found, query)
+            self.assertEqual(indexer.unload_book(book.handle), 0)
+
+    @async_test
+    async def test_failures(self):
+        filename = 'tests/test-books/brf_break_test.brf'
+        book = await _read_pages2(BookFile(filename, 40, 9))
+        self.assertEqual(search_book(book, (0, 0)), [])
+        with self.assertRaises(OSError) as cm:
+            indexer.search(book.handle, braille.mapping, (64,), 40)
+        self.assertEqual(cm.exception.errno, errno.EINVAL)
+        with self.assertRaises(OSError) as cm:
+            indexer.search(UNKNOWN, braille.mapping, (1,), 40)
+        self.assertEqual(cm.exception.errno, errno.ENOENT)
+        self.assertIsNone(search_book(BookFile(filename, 40, 9), (1,)))
+
+
+# Loads of a FIFO block reading it until it's written to, so can be
+# cancelled while running.
+@unittest.skipUnless(hasattr(os, 'mkfifo'), 'needs FIFOs')
+class TestCancel(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'fifo.brf')
+        os.mkfifo(self.filename)
+        # opening it read-write doesn't wait for a reader
+        self.fifo = os.open(self.filename, os.O_RDWR)
+
+    def tearDown(self):
+        os.close(self.fifo)
+        self.tmpdir.cleanup()
+
+    @async_test
+    async def test_cancelled_load_not_kept(self):
+        def cancel(book):
+            self.assertEqual(indexer.cancel_load(book.handle), 0)
+            os.write(self.fifo, b'page\n' * 20)
+
+        book = await _read_pages2(BookFile(self.filename, 40, 9), background=True,
+                                  loading=cancel)
+        self.assertEqual(book.load_state, LoadState.INITIAL)
+        self.assertEqual(indexer.get_load_progress(book.handle), (-errno.ENOENT, False))
+        self.assertEqual(indexer.cancel_load(book.handle), -errno.ENOENT)
+
+    @async_test
+    async def test_unreachable_background_load_cancelled(self):
+        library = FakeLibrary([BookFile(self.filename, 40, 9)])
+        state = SimpleNamespace(app=SimpleNamespace(library=library))
+        load = asyncio.ensure_future(
+            load_book(library.books[self.filename], state, background=True))
+        while library.books[self.filename].load_state != LoadState.LOADING:
+            await asyncio.sleep(0)
+        cancel_background_loads([library.books[self.filename]])
+        os.write(self.fifo, b'page\n')
+        await asyncio.sleep(0.01)
+        self.assertFalse(load.done())
+        cancel_background_loads([])
+        os.write(self.fifo, b'page\n')
+        await load
+        self.assertEqual(library.books[self.filename].load_state, LoadState.INITIAL)
+
+
+class TestLoadStats(unittest.TestCase):
+    @async_test
+    async def test_stats_recorded(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'malformed.pef')
+            with open(filename, 'w') as f:
+                f.write('<pef><row>⠁</row></row><row>⠃<row>⠉</row></pef>\n')
+            loads = load_totals['loads']
+            book = await _read_pages2(BookFile(filename, 40, 9))
+            stats = indexer.get_load_stats(book.handle)
+            self.assertEqual(stats.status, 0)
+            self.assertEqual(stats.bytes_read, os.path.getsize(filename))
+            self.assertEqual((stats.pages, stats.parse_errors), (1, 2))
+            self.assertEqual(await _read_page(book, 0), ((1,), (9,)) + ((),) * 7)
+            self.assertEqual(load_totals['loads'], loads + 1)
+
+            with open(filename, 'w') as f:
+                f.write('<pef><row>⠁</row><row')
+            book = await _read_pages2(book._replace(load_state=LoadState.INITIAL))
+            self.assertEqual(book.load_state, LoadState.FAILED)
+            stats = indexer.get_load_stats(book.handle)
+            self.assertEqual((stats.status, stats.pages, stats.parse_errors),
+                             (-errno.EIO, 0, 1))
+
+    def test_unknown_book(self):
+        self.assertIsNone(indexer.get_load_stats(UNKNOWN))
+
+
+class TestLoadProgress(unittest.TestCase):
+    @async_test
+    async def test_progress_reaches_page_count(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'long.brf')
+            with open(filename, 'w') as f:
+                for page in range(2000):
+                    f.write('\n'.join(['page {}'.format(page)] * 9) + '\n')
+            loading = []
+            load = asyncio.ensure_future(_read_pages2(BookFile(filename, 40, 9),
+                                                      loading=loading.append))
+            seen = []
+            while not load.done():
+                if loading:
+                    seen.append(indexer.get_load_progress(loading[0].handle))
+                await asyncio.sleep(0)
+            book = load.result()
+            self.assertEqual(book.num_pages, 2000)
+            for page_count, complete in seen:
+                self.assertLessEqual(page_count, book.num_pages)
+            self.assertEqual(loading[0].handle, book.handle)
+            self.assertEqual(indexer.get_load_progress(book.handle), (2000, True))
+
+    def test_unknown_book(self):
+        self.assertEqual(indexer.get_load_progress(UNKNOWN),
+                         (-errno.ENOENT, False))
+
+
+class TestDisplayLines(unittest.TestCase):
+    @async_test
+    async def test_indexed_per_lines(self):
+        filename = 'tests/test-books/brf_test.BRF'
+        nine = await _read_pages2(BookFile(filename, 40, 9))
+        four = await _read_pages2(BookFile(filename, 40, 4))
+        self.assertGreater(four.num_pages, nine.num_pages)
+        self.assertNotEqual(nine.handle, four.handle)
+        self.assertEqual(indexer.get_page_count(nine.handle), nine.num_pages)
+        self.assertEqual(indexer.get_page_count(four.handle), four.num_pages)
+
+    @async_test
+    async def test_handle_kept(self):
+        filename = 'tests/test-books/brf_test.BRF'
+        first = await _read_pages2(BookFile(filename, 40, 9))
+        self.assertEqual(indexer.unload_book(first.handle), 0)
+        second = await _read_pages2(BookFile(filename, 40, 9))
+        self.assertEqual(second.handle, first.handle)
+        self.assertNotEqual(first.handle, 0)
+        with self.assertRaises(ValueError):
+            indexer.trigger_load(filename + '\0', 9, 0)
+
+    @async_test
+    async def test_resized_book_reloads(self):
+        book = await _read_pages2(BookFile('tests/test-books/brf_test.BRF', 40, 9,
+                                           page_number=2))
+        resized = book.with_dimensions(40, 4)
+        self.assertEqual(resized.load_state, LoadState.INITIAL)
+        self.assertEqual((resized.height, resized.page_number), (4, 2))
+        self.assertEqual(resized.bookmarks, (0,))
+        self.assertIs(book.with_dimensions(40, 9), book)
+
+    @async_test
+    async def test_resized_book_index_freed(self):
+        book = await _read_pages2(BookFile('tests/test-books/brf_break_test.brf', 40, 9))
+        self.assertGreater(indexer.get_index_memory(book.handle), 0)
+        discard_index(book)
+        self.assertEqual(indexer.get_index_memory(book.handle), -errno.ENOENT)
+
+
+class TestLargeBooks(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_book(self, text):
+        filename = os.path.join(self.tmpdir.name, 'large.brf')
+        with open(filename, 'w') as f:
+            f.write(text)
+        return filename
+
+    @async_test
+    async def test_over_64k_pages(self):
+        filename = self.write_book('a\n' * 9 * 70000 + 'last\n')
+        book = await _read_pages2(BookFile(filename, 40, 9))
+        self.assertEqual(book.num_pages, 70001)
+        extent = indexer.get_page(book.handle, 70000)
+        self.assertEqual((extent.status, extent.first, extent.length),
+                         (0, 2 * 9 * 70000, 5))
+
+    @async_test
+    async def test_page_over_64k(self):
+        filename = self.write_book('a' * 70000 + '\n\fnext\n')
+        book = await _read_pages2(BookFile(filename, 40, 9))
+        self.assertEqual(book.num_pages, 2)
+        self.assertEqual(indexer.get_page(book.handle, 0).length, 70002)
+        page = await get_page_data(book, None)
+        self.assertEqual(page[0][:3], braille.from_ascii('aaa'))
+
+    @async_test
+    async def test_not_utf8(self):
+        filename = os.path.join(self.tmpdir.name, 'latin1.brf')
+        with open(filename, 'wb') as f:
+            f.write(b'caf\xe9\n' * 9 + b'\x0cnext\n')
+        book = await _read_pages2(BookFile(filename, 40, 9))
+        self.assertEqual(book.load_state, LoadState.DONE)
+        self.assertEqual(book.num_pages, 2)
+        page = await _read_page(book, 0)
+        self.assertEqual(page[0], braille.from_ascii('caf') + (0,))
+        self.assertEqual(_decode_page_natively(book, 0)[0], (page[0] + (0,) * 40)[:40])
+
+
+class TestPefMarkup(unittest.TestCase):
+    @async_test
+    async def test_rows_found_exactly(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'markup.pef')
+            with open(filename, 'w') as f:
+                f.write('<?xml version="1.0"?>\n'
+                        '<!DOCTYPE pef [<!ENTITY x "<row>">]>\n'
+                        '<pef:pef xmlns:pef="http://www.daisy.org/ns/2008/pef"><pef:body>\n'
+                        '<!-- <row>⠿</row> -->\n'
+                        '<pef:row rowgap="1" class=\'a>b\'>⠁</pef:row >\n'
+                        '<row\n>⠃<![CDATA[⠉<row>]]></row>\n'
+                        '<row />\n'
+                        '<row>⠙</row></pef:body></pef:pef>\n')
+            book = await _read_pages2(BookFile(filename, 40, 2))
+            self.assertEqual(book.num_pages, 2)
+            expected = (((1,), (3, 9, 0, 0, 0, 0, 0)),
+                        ((), (25,)))
+            for page, lines in enumerate(expected):
+                self.assertEqual(await _read_page(book, page), lines)
+                self.assertEqual(_decode_page_natively(book, page),
+                                 tuple((line + (0,) * 40)[:40] for line in lines))
+
+
+class FakeLibrary:
+    def __init__(self, books):
+        self.media_dir = ''
+        self.books = {book.filename: book for book in books}
+
+    def current_version(self, book):
+        return self.books[book.filename]
+
+    def add_or_replace(self, book):
+        self.books[book.filename] = book
+
+    def set_book_loading(self, book):
+        self.add_or_replace(book._replace(load_state=LoadState.LOADING))
+
+
+class TestIndexLimit(unittest.TestCase):
+    def tearDown(self):
+        set_index_limit(None)
+
+    @async_test
+    async def test_least_recently_used_unloaded(self):
+        filenames = ('tests/test-books/brf_test.BRF',
+                     'tests/test-books/brf_break_test.brf',
+                     'tests/test-books/pef_test.pef')
+        library = FakeLibrary(BookFile(filename, 40, 9) for filename in filenames)
+        state = SimpleNamespace(app=SimpleNamespace(
+            library=library, user=SimpleNamespace(book=BookFile('elsewhere.brf', 40, 9))))
+        set_index_limit(2)
+        handles = []
+        for filename in filenames:
+            await load_book(library.books[filename], state)
+            handles.append(library.books[filename].handle)
+        first, second, third = (library.books[filename] for filename in filenames)
+        self.assertEqual(first.load_state, LoadState.INITIAL)
+        self.assertEqual(indexer.get_page_count(handles[0]), -errno.ENOENT)
+        self.assertEqual(second.load_state, LoadState.DONE)
+        self.assertEqual(third.load_state, LoadState.DONE)
+        # reading makes a book most recently used
+        await get_page_data(second, state)
+        await load_book(first, state)
+        self.assertEqual(library.books[filenames[2]].load_state, LoadState.INITIAL)
+        self.assertEqual(library.books[filenames[1]].load_state, LoadState.DONE)
+
+
+class TestPageCells(unittest.TestCase):
+    @async_test
+    async def test_native_matches_python(self):
+        for filename in ('tests/test-books/brf_test.BRF',
+                         'tests/test-books/brf_break_test.brf',
+                         'tests/test-books/pef_test.pef'):
+            book = await _read_pages2(BookFile(filename, 40, 9))
+            for page in range(book.num_pages):
+                native = _decode_page_natively(book, page)
+                python = await _read_page(book, page)
+                self.assertEqual(len(native), 9)
+                for native_line, python_line in zip(native, python):
+                    self.assertEqual(native_line, (python_line + (0,) * 40)[:40])
+
+
+class TestPageCache(unittest.TestCase):
+    filename = 'tests/test-books/brf_test.BRF'
+
+    def tearDown(self):
+        set_page_cache_limit(1 << 20)
+
+    @async_test
+    async def test_pages_cached(self):
+        book = await _read_pages2(BookFile(self.filename, 40, 9))
+        before = page_cache_stats.copy()
+        first = await get_page_data(book, None, page_number=3)
+        second = await get_page_data(book, None, page_number=3)
+        self.assertIs(second, first)
+        self.assertEqual(page_cache_stats['misses'] - before['misses'], 1)
+        self.assertEqual(page_cache_stats['hits'] - before['hits'], 1)
+        # another encoding decodes the page again
+        braille.set_encoding('euro-braille')
+        try:
+            self.assertIsNot(await get_page_data(book, None, page_number=3), first)
+        finally:
+            braille.set_encoding(braille.DEFAULT_ENCODING)
+
+    @async_test
+    async def test_limit_evicts(self):
+        book = await _read_pages2(BookFile(self.filename, 40, 9))
+        set_page_cache_limit(0)
+        before = page_cache_stats.copy()
+        await get_page_data(book, None, page_number=3)
+        await get_page_data(book, None, page_number=3)
+        self.assertEqual(page_cache_stats['misses'] - before['misses'], 2)
+        set_page_cache_limit(1)
+        await get_page_data(book, None, page_number=3)
+        self.assertEqual(page_cache_stats['evicted'] - before['evicted'], 1)
+
+    @async_test
+    async def test_neighbours_prefetched(self):
+        book = await _read_pages2(BookFile(self.filename, 40, 9))
+        book = book._replace(page_number=10)
+        await prefetch_pages(book)
+        before = page_cache_stats.copy()
+        for page in (7, 9, 11, 13):
+            self.assertEqual(await get_page_data(book, None, page_number=page),
+                             await _decode(book, page))
+        self.assertEqual(page_cache_stats['hits'] - before['hits'], 4)
+        self.assertEqual(page_cache_stats['misses'] - before['misses'], 0)
+
+
+class TestWaitForLoad(unittest.TestCase):
+    def state(self, book):
+        library = FakeLibrary([book])
+        return SimpleNamespace(app=SimpleNamespace(
+            library=library, user=SimpleNamespace(book=book)))
+
+    def tearDown(self):
+        handlers.LOAD_TIMEOUT = 30
+
+    @async_test
+    async def test_page_shown_once_loaded(self):
+        book = BookFile('tests/test-books/brf_test.BRF', 40, 9)
+        state = self.state(book)
+        waiting = asyncio.create_task(get_page_data(book, state, page_number=0))
+        await load_book(book, state)
+        loaded = state.app.library.books[book.filename]
+        self.assertEqual(await waiting, await _decode(loaded, 0))
+
+    @async_test
+    async def test_failed_book(self):
+        book = BookFile('tests/test-books/missing.brf', 40, 9)
+        state = self.state(book)
+        waiting = asyncio.create_task(get_page_data(book, state))
+        await load_book(book, state)
+        with self.assertRaises(BookFileError):
+            await waiting
+
+    @async_test
+    async def test_timeout(self):
+        book = BookFile('tests/test-books/brf_test.BRF', 40, 9)
+        handlers.LOAD_TIMEOUT = 0.1
+        with self.assertRaises(asyncio.TimeoutError):
+            await get_page_data(book, self.state(book))
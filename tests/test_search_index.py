@@ -0,0 +1,83 @@
+import os
+import tempfile
+import unittest
+from ui.library.search_index import SearchIndex, book_words
+from ui import braille
+
+
+class TestBookWords(unittest.TestCase):
+    def test_brf_folded(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'words.brf')
+            with open(filename, 'wb') as f:
+                f.write(b'the cat\r\n,SAT on\xe9 the\x0cmat\n')
+            self.assertEqual(book_words(filename), {'THE', 'CAT', 'SAT', 'ON', 'MAT'})
+
+    def test_brf_indicators_and_punctuation_stripped(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'words.brf')
+            with open(filename, 'wb') as f:
+                f.write(b',,CAT CAT, 8DOG0 ;B SAT4 0\n')
+            self.assertEqual(book_words(filename), {'CAT', 'DOG', 'B', 'SAT', '0'})
+
+    def test_brf_words_across_chunks(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'words.brf')
+            with open(filename, 'wb') as f:
+                f.write(b'the cat sat on the mat\n' + b'X' * 100 + b' end\n')
+            self.assertEqual(book_words(filename, chunk_size=4),
+                             {'THE', 'CAT', 'SAT', 'ON', 'MAT', 'END'})
+
+    def test_pef_cells(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'words.pef')
+            with open(filename, 'w') as f:
+                f.write('<pef><row>⠁⠃⠀⠉</row><row>⣿⠙</row></pef>\n')
+            self.assertEqual(book_words(filename), {'⠁⠃', '⠉', '⠿⠙'})
+
+    def test_pef_indicators_and_punctuation_stripped(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'words.pef')
+            with open(filename, 'w') as f:
+                f.write('<row>⠠⠉⠁⠞⠂ ⠴</row>\n')
+            self.assertEqual(book_words(filename, chunk_size=3), {'⠉⠁⠞', '⠴'})
+
+
+class TestSearchIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmpdir.name, 'library-index.db')
+        self.brf = os.path.join(self.tmpdir.name, 'a.brf')
+        with open(self.brf, 'w') as f:
+            f.write('the cat sat\n')
+        self.pef = os.path.join(self.tmpdir.name, 'b.pef')
+        with open(self.pef, 'w') as f:
+            f.write('<row>⠉⠁⠞ ⠙⠕⠛</row>\n')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_lookup_persists(self):
+        index = SearchIndex(self.db)
+        index._update(self.brf, 'a.brf')
+        index._update(self.pef, 'b.pef')
+        index.close()
+        index = SearchIndex(self.db)
+        cat = braille.from_ascii('cat')
+        self.assertEqual(index.lookup(cat), {'a.brf', 'b.pef'})
+        self.assertEqual(index.lookup(braille.from_ascii('cat sat')), {'a.brf'})
+        self.assertEqual(index.lookup(braille.from_ascii('dog')), {'b.pef'})
+        self.assertEqual(index.lookup(braille.from_ascii('ca')), set())
+        self.assertEqual(index.lookup(braille.from_ascii(',CAT,')), {'a.brf', 'b.pef'})
+        index.close()
+
+    def test_changed_book_reindexed(self):
+        index = SearchIndex(self.db)
+        index._update(self.brf, 'a.brf')
+        with open(self.brf, 'w') as f:
+            f.write('a dog\n')
+        os.utime(self.brf, ns=(0, 0))
+        index._update(self.brf, 'a.brf')
+        self.assertEqual(index.lookup(braille.from_ascii('cat')), set())
+        self.assertEqual(index.lookup(braille.from_ascii('dog')), {'a.brf'})
+        index.close()
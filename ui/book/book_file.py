@@ -17,11 +17,11 @@ class LoadState(Enum):
 BookData = namedtuple('BookData', ['filename', 'width', 'height',
                                    'page_number', 'bookmarks',
                                    'indexed', 'pages', 'load_state',
-                                   'num_pages'])
+                                   'num_pages', 'handle'])
 BookData.__new__.__defaults__ = (None, None, None,
                                  0, tuple([0]),
                                  None, tuple(), LoadState.INITIAL,
-                                 0)
+                                 0, None)
 
 
 class BookFile(BookData):
@@ -43,7 +43,8 @@ class BookFile(BookData):
             return self.bookmarks
 
     def get_num_pages(self):
-        if self.load_state != LoadState.DONE:
+        # books still being indexed may be partly readable
+        if self.load_state != LoadState.DONE and not self.indexed:
             log.warning('get pages on not-yet-loaded book')
         if self.indexed:
             return self.num_pages
@@ -61,6 +62,26 @@ class BookFile(BookData):
             page = self.get_num_pages() - 1
         return self._replace(page_number=page)
 
+    def with_dimensions(self, width, height):
+        """
+        Returns this book for a display of `width` by `height`; pages
+        are laid out to fit, so a book loaded for another size has to
+        be loaded again.
+        """
+        if (width, height) == (self.width, self.height) or self.pages:
+            # pages held in memory can't be laid out again
+            return self
+        return self._replace(width=width, height=height).unloaded()
+
+    def unloaded(self):
+        """Returns this book as it was before loading, keeping the reader's place."""
+        bookmarks = self.bookmarks
+        if self.load_state == LoadState.DONE and self.num_pages > 1:
+            # drop the end-of-book bookmark added by loading
+            bookmarks = bookmarks[:-1]
+        return BookFile(self.filename, self.width, self.height,
+                        page_number=self.page_number, bookmarks=bookmarks)
+
     def to_file(self):
         # remove deleted, start-of-book and end-of-book bookmarks
         bms = self.bookmarks_pruned[1:-1]
@@ -3,6 +3,7 @@ from ..state import state
 buttons = {
     'single': {
         '2': state.app.user.enter_go_to_page,
+        '3': state.app.user.enter_search,
         '5': state.app.user.insert_bookmark,
         '6': state.app.go_to_bookmarks_menu,
         '8': state.app.go_to_system_menu,
@@ -14,6 +15,7 @@ buttons = {
     },
     'long': {
         '2': state.app.user.enter_go_to_page,
+        '3': state.app.user.enter_search,
         '5': state.app.user.insert_bookmark,
         '6': state.app.go_to_bookmarks_menu,
         '8': state.app.go_to_system_menu,
@@ -0,0 +1,87 @@
+# Waits for book loads to finish.  The indexer reports every load on one
+# long-lived pipe; a single reader callback drains it and resolves the
+# future of each load it hears about, so waiting costs nothing.
+import asyncio
+import logging
+import os
+import struct
+
+from . import indexer
+
+
+log = logging.getLogger(__name__)
+
+# (token: u32, status: i32), as written by the indexer
+RECORD = struct.Struct('=Ii')
+
+
+class LoadCompletions:
+    def __init__(self):
+        self.fd = None
+        self.loop = None
+        self.pending = {}
+        self.next_token = 0
+        self.unread = b''
+
+    def load(self, bookpath, lines, background=False):
+        """
+        Start loading `bookpath` and return its handle and a future of
+        the outcome: 0 if it loaded, or a negated errno.
+        """
+        if self.fd is None:
+            self._open()
+        self._listen()
+        token = self.next_token
+        handle = indexer.trigger_load(bookpath, lines, token, background=background)
+        self.next_token = (token + 1) % 2 ** 32
+        future = self.loop.create_future()
+        self.pending[token] = future
+        return handle, future
+
+    def _open(self):
+        try:
+            (r, w) = os.pipe2(os.O_CLOEXEC)
+        except AttributeError:
+            # macOS workaround as pipe2 not supported
+            import fcntl
+            (r, w) = os.pipe()
+            fcntl.fcntl(r, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            fcntl.fcntl(w, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        os.set_blocking(r, False)
+        status = indexer.set_completion_fd(w)
+        if status != 0:
+            os.close(r)
+            os.close(w)
+            raise OSError(-status, os.strerror(-status))
+        # the write end stays open for the indexer's use
+        self.fd = r
+
+    def _listen(self):
+        """Make sure the running loop is watching for completions."""
+        loop = asyncio.get_running_loop()
+        if loop is self.loop:
+            return
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.remove_reader(self.fd)
+        # loads awaited on another loop can't be resolved from this one
+        self.pending.clear()
+        loop.add_reader(self.fd, self._on_readable)
+        self.loop = loop
+
+    def _on_readable(self):
+        try:
+            self.unread += os.read(self.fd, RECORD.size * 64)
+        except BlockingIOError:
+            return
+        whole = len(self.unread) - len(self.unread) % RECORD.size
+        for token, status in RECORD.iter_unpack(self.unread[:whole]):
+            future = self.pending.pop(token, None)
+            if future is None:
+                log.debug(f'completion for unknown load {token}')
+            elif not future.done():
+                # not cancelled by whoever was waiting
+                future.set_result(status)
+        self.unread = self.unread[whole:]
+
+
+completions = LoadCompletions()
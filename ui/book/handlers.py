@@ -1,14 +1,21 @@
 import aiofiles
 import asyncio
+import concurrent.futures
+import errno
 import logging
 import re
 import os
+import sys
+import time
+from collections import Counter, OrderedDict
 
 from ..manual import manual_filename
+from ..library import search_index
 from .. import braille
 from .. import state_helpers
 from . import book_file
 from . import indexer
+from .completions import completions
 
 
 log = logging.getLogger(__name__)
@@ -18,50 +25,200 @@ FORM_FEED = re.compile('\f')
 
 NS = {'pef': 'http://www.daisy.org/ns/2008/pef'}
 
+# Books whose indices are loaded in the extension, least recently used
+# first, keyed by their handles there; see set_index_limit().
+_indexed = OrderedDict()
+_index_limit = None
 
-async def _read_pages2(book, background=False):
+# The handle of the book last set as current in the extension, which keeps
+# only that book mapped; see _note_reading().
+_reading = None
+
+# Books being loaded in the background, by handle; see
+# cancel_background_loads().
+_background = {}
+
+# What every load so far took, summed; see _note_load_stats().
+load_totals = Counter()
+
+# Decoded pages and roughly how many bytes each takes up, least recently
+# used first, keyed by (handle, page, encoding, width, height); see
+# set_page_cache_limit().
+_page_cache = OrderedDict()
+_page_cache_bytes = 0
+_page_cache_limit = 1 << 20
+
+# How lookups of the page cache went, and how many pages were prefetched
+# or evicted.
+page_cache_stats = Counter()
+
+# How long get_page_data() waits for a book to load, in seconds, and how
+# often it checks meanwhile, while the book is loading, whether the page
+# wanted has loaded yet.
+LOAD_TIMEOUT = 30
+PROGRESS_INTERVAL = 0.05
+
+# Futures resolved when books finish loading, one way or another, keyed by
+# their filenames and heights; see _loaded_future().
+_loaded = {}
+# Books get_page_data() gave up waiting for, by filename and height.
+_overdue = set()
+
+# Pages either side of the one being read to decode ahead of time: those
+# a page turn or a long press of forward or back (a skip of three pages)
+# goes to.
+PREFETCH_OFFSETS = (1, -1, 3, -3)
+
+# Decodes pages of books the extension hasn't mapped, which it reads from
+# their files, off the event loop; get_page_cells() releases the GIL.
+_page_reader = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+
+def set_index_limit(limit):
+    """
+    Keep at most `limit` book indices loaded, unloading the least recently
+    used beyond that; their books will be loaded again when needed.  None
+    means no limit.
+    """
+    global _index_limit
+    _index_limit = limit
+
+
+def set_page_cache_limit(limit):
+    """
+    Keep about `limit` bytes of decoded pages, evicting the least recently
+    used beyond that.  0 turns the cache off.
+    """
+    global _page_cache_limit
+    _page_cache_limit = limit
+    _evict_pages()
+
+
+def _page_key(book, page_number):
+    return (book.handle, page_number, braille.mapping, book.width, book.height)
+
+
+def _cache_page(key, lines):
+    global _page_cache_bytes
+    if key in _page_cache or _page_cache_limit == 0:
+        return
+    size = sys.getsizeof(lines) + sum(map(sys.getsizeof, lines))
+    _page_cache[key] = lines, size
+    _page_cache_bytes += size
+    _evict_pages()
+
+
+def _evict_pages():
+    global _page_cache_bytes
+    while _page_cache and _page_cache_bytes > _page_cache_limit:
+        _, (_, size) = _page_cache.popitem(last=False)
+        _page_cache_bytes -= size
+        page_cache_stats['evicted'] += 1
+
+
+def _forget_pages(handle):
+    """Drop any decoded pages of the book with `handle`."""
+    global _page_cache_bytes
+    for key in [key for key in _page_cache if key[0] == handle]:
+        _, size = _page_cache.pop(key)
+        _page_cache_bytes -= size
+
+
+def page_cache_hit_rate():
+    """Returns the fraction of page lookups so far found in the cache."""
+    lookups = page_cache_stats['hits'] + page_cache_stats['misses']
+    return page_cache_stats['hits'] / max(1, lookups)
+
+
+def _note_index_used(book, state):
+    """Mark `book`'s index as most recently used and enforce the limit."""
+    _indexed[book.handle] = book
+    _indexed.move_to_end(book.handle)
+    if _index_limit is None:
+        return
+    # never pull the book being read out from under the reader
+    current = state.app.user.book.handle
+    for handle in list(_indexed):
+        if len(_indexed) <= _index_limit:
+            break
+        if handle == current:
+            continue
+        book = _indexed.pop(handle)
+        _unload_index(book)
+        latest = state.app.library.current_version(book)
+        if latest.load_state == book_file.LoadState.DONE and latest.height == book.height:
+            state.app.library.add_or_replace(latest.unloaded())
+        log.debug(f'unloaded index of {book.filename}')
+
+
+def _note_reading(state):
+    """Tell the extension which book is being read, if that's changed."""
+    global _reading
+    handle = state.app.user.book.handle
+    if handle != _reading:
+        indexer.set_current_book(handle)
+        _reading = handle
+
+
+def _unload_index(book):
+    _forget_pages(book.handle)
+    status = indexer.unload_book(book.handle)
+    if status != 0:
+        log.warning(f'unloading index of {book.filename} failed: {os.strerror(-status)}')
+
+
+def discard_index(book):
+    """
+    Free `book`'s index, as when the display changes size and it's to be
+    loaded again for the new one.  If it's still loading, the load is
+    cancelled instead, and whatever it loads regardless is discarded by
+    load_book().
+    """
+    if book.handle is None:
+        return
+    if book.load_state == book_file.LoadState.LOADING:
+        indexer.cancel_load(book.handle)
+    elif book.load_state == book_file.LoadState.DONE and book.indexed:
+        _indexed.pop(book.handle, None)
+        _unload_index(book)
+
+
+async def _read_pages2(book, background=False, loading=None):
     """Index `book`.
-    If `background` is True, yield during long operations.
+    If `background` is True, queue it behind books the user is waiting for.
+    Once its load has started, `loading`, if given, is called with `book`,
+    which by then has its handle.
     If `book` is already loaded, does nothing.
-    Upon return `book` will be in state DONE or FAILED."""
+    Upon return `book` will be in state DONE or FAILED, or INITIAL again
+    if its load was cancelled."""
     if book.filename == manual_filename:
         return book
     if book.load_state == book_file.LoadState.DONE:
         return book
     try:
-        try:
-            (r, w) = os.pipe2(os.O_CLOEXEC)
-        except AttributeError:
-            # macOS workaround as pipe2 not supported
-            import fcntl
-            (r, w) = os.pipe()
-            fcntl.fcntl(r, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
-            fcntl.fcntl(w, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
-        indexer.trigger_load(book.filename, w)
-        buf = None
-        if background:
-            os.set_blocking(r, False)
-            while not buf:
-                try:
-                    buf = os.read(r, 10)
-                except BlockingIOError:
-                    await asyncio.sleep(0)
-        else:
-            os.set_blocking(r, True)
-            buf = os.read(r, 10)
-        os.close(r)
-        os.close(w)
-        if buf != b'ok':
+        handle, loaded = completions.load(book.filename, book.height, background=background)
+        book = book._replace(handle=handle)
+        if loading is not None:
+            loading(book)
+        status = await loaded
+        _note_load_stats(book)
+        if status == -errno.ECANCELED:
+            log.info('loading cancelled for {}'.format(book.filename))
+            return book
+        if status != 0:
             raise BookFileError(
-                'loading failed: {}'.format(book.filename))
+                'loading failed: {}: {}'.format(book.filename, os.strerror(-status)))
         log.info('loading complete for {}'.format(book.filename))
+        # the book may have changed since any of its pages were read
+        _forget_pages(handle)
+        num_pages = indexer.get_page_count(handle)
         bookmarks = book.bookmarks
-        if indexer.get_page_count(book.filename) > 1:
+        if num_pages > 1:
             # add an end-of-book bookmark
-            bookmarks += (indexer.get_page_count(book.filename) - 1,)
+            bookmarks += (num_pages - 1,)
         return book._replace(load_state=book_file.LoadState.DONE,
                              bookmarks=bookmarks,
-                             num_pages=indexer.get_page_count(book.filename),
+                             num_pages=num_pages,
                              indexed=True)
     except Exception:
         log.warning(
@@ -69,57 +226,331 @@ async def _read_pages2(book, background=False):
         return book._replace(load_state=book_file.LoadState.FAILED)
 
 
+def _note_load_stats(book):
+    """Log what loading `book` took, and add it to load_totals."""
+    stats = indexer.get_load_stats(book.handle)
+    if stats is None:
+        return
+    log.debug(f'load stats for {book.filename}: {stats}')
+    load_totals['loads'] += 1
+    if stats.status == -errno.ECANCELED:
+        load_totals['cancelled'] += 1
+    elif stats.status != 0:
+        load_totals['failed'] += 1
+    for name in ('cached', 'queued_us', 'wall_us', 'bytes_read', 'pages', 'parse_errors'):
+        load_totals[name] += getattr(stats, name)
+
+
+def _note_progress(book, state):
+    """
+    While `book` is loading, record how many of its pages are indexed so
+    far, so that those can be read (and counted) before the rest.
+    """
+    available, complete = indexer.get_load_progress(book.handle)
+    if available > book.num_pages:
+        book = book._replace(num_pages=available, indexed=True)
+        state.app.library.add_or_replace(book)
+    return book
+
+
+def _loaded_future(book):
+    """Returns a future resolved when `book` next finishes loading."""
+    key = (book.filename, book.height)
+    loop = asyncio.get_running_loop()
+    future = _loaded.get(key)
+    if future is None or future.get_loop() is not loop:
+        future = _loaded[key] = loop.create_future()
+    return future
+
+
+def _note_loaded(book):
+    """Wake anything waiting for `book` to load."""
+    future = _loaded.pop((book.filename, book.height), None)
+    if future is not None and future.get_loop() is asyncio.get_running_loop():
+        future.set_result(book.load_state)
+
+
 async def get_page_data(book, state, page_number=None):
+    """
+    Returns the lines of a page of `book`, waiting for it to load if need
+    be.  Raises BookFileError if it fails to load, or asyncio.TimeoutError
+    if it takes longer than LOAD_TIMEOUT.
+    """
     if page_number is None:
         page_number = book.page_number
 
+    deadline = time.monotonic() + LOAD_TIMEOUT
     while book.load_state != book_file.LoadState.DONE:
-        await asyncio.sleep(0)
+        if book.load_state == book_file.LoadState.FAILED:
+            raise BookFileError(f'{book.filename} failed to load')
+        if book.load_state == book_file.LoadState.LOADING:
+            book = _note_progress(book, state)
+            if page_number < book.num_pages:
+                break
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            _overdue.add((book.filename, book.height))
+            raise asyncio.TimeoutError(f'{book.filename} took too long to load')
+        # sleep until it's loaded, waking now and then while it's loading
+        # to see if the page wanted is readable already
+        if book.load_state == book_file.LoadState.LOADING:
+            remaining = min(remaining, PROGRESS_INTERVAL)
+        try:
+            await asyncio.wait_for(asyncio.shield(_loaded_future(book)), remaining)
+        except asyncio.TimeoutError:
+            pass
         # accessing store.state will get a fresh state
-        book = state.app.user.books[book.filename]
+        book = state.app.library.current_version(book)
+
+    if state is not None:
+        # the book may have only just got its handle
+        _note_reading(state)
 
     if not book.indexed:
         if page_number >= book.get_num_pages():
             return book.pages[book.get_num_pages() - 1]
         return book.pages[page_number]
+
+    if state is not None and book.load_state == book_file.LoadState.DONE:
+        _note_index_used(book, state)
+
+    # FIXME FIXME: Explain how book's page number gets set to -1.
+    page_number = max(0, page_number)
+    key = _page_key(book, page_number)
+    cached = _page_cache.get(key)
+    if cached is not None:
+        page_cache_stats['hits'] += 1
+        _page_cache.move_to_end(key)
+        return cached[0]
+    page_cache_stats['misses'] += 1
+    lines = await _decode(book, page_number)
+    _cache_page(key, lines)
+    return lines
+
+
+async def prefetch_pages(book):
+    """
+    Decode the pages of `book` around the one being read, if it's loaded,
+    so that going to them needn't wait.
+    """
+    if book.load_state != book_file.LoadState.DONE or not book.indexed:
+        return
+    # which of the pages around it exist, in one call
+    radius = max(map(abs, PREFETCH_OFFSETS))
+    page_count, window = indexer.get_page_window(book.handle, book.page_number, radius)
+    if page_count < 0:
+        # unloaded since
+        return
+    for offset in PREFETCH_OFFSETS:
+        page_number = book.page_number + offset
+        if page_number not in window:
+            continue
+        key = _page_key(book, page_number)
+        if key in _page_cache:
+            continue
+        try:
+            lines = await _decode(book, page_number)
+        except Exception:
+            log.debug(f'prefetching page {page_number} of {book.filename} failed',
+                      exc_info=True)
+            return
+        _cache_page(key, lines)
+        page_cache_stats['prefetched'] += 1
+        # let anything more pressing go first
+        await asyncio.sleep(0)
+
+
+async def _decode(book, page_number):
+    try:
+        if indexer.get_page_view(book.handle, page_number) is not None:
+            # mapped, so there's nothing to wait for
+            return _decode_page_natively(book, page_number)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_page_reader, _decode_page_natively,
+                                          book, page_number)
+    except OSError:
+        log.warning(f'native page decoding failed for {book.filename}',
+                    exc_info=True)
+    return await _read_page(book, page_number)
+
+
+def _decode_page_natively(book, page_number):
+    """Have the extension read and decode a page in one go."""
+    width = book.width
+    cells = indexer.get_page_cells(book.handle, page_number, braille.mapping,
+                                   width, book.height)
+    return tuple(tuple(cells[i:i + width])
+                 for i in range(0, len(cells), width))
+
+
+async def _read_page(book, page_number):
+    """Read and decode a page in Python."""
+    page_count, extents = indexer.get_pages(book.handle, page_number, 1)
+    if not extents and page_count > 0:
+        # past the end, so show the last page
+        page_number = page_count - 1
+        page_count, extents = indexer.get_pages(book.handle, page_number, 1)
+    page_extent = extents[0] if extents else indexer.PageExtent(0, 0)
+    # Straight from the extension's map of the book if possible; the view
+    # is decoded before anything else can unload the book.
+    view = indexer.get_page_view(book.handle, page_number)
+    if view is not None:
+        return _decode_page(book, page_number, page_extent, view)
+    # Only reached if the extension couldn't decode the page itself.
+    async with aiofiles.open(book.filename, 'rb') as f:
+        await f.seek(page_extent.first)
+        page = await f.read(page_extent.length)
+    return _decode_page(book, page_number, page_extent, page)
+
+
+def _decode_page(book, page_number, page_extent, page):
+    """Decode the bytes (or a view of them) of a page in Python."""
+    lines = []
+    if book.ext == '.brf':
+        # BRFs aren't always clean ASCII; undecodable bytes show as blank cells.
+        page = str(page, 'utf8', errors='replace')
+        # The form feed ending a page, if any, is included in it.
+        if page.endswith('\f'):
+            page = page[:-1]
+        for line in page.splitlines():
+            lines.append(braille.from_ascii(line))
     else:
-        # FIXME FIXME: Explain how book's page number gets set to -1.
-        page_number = min(indexer.get_page_count(book.filename) - 1,
-                          page_number)
-        if page_number == -1:
-            page_number = max(0, page_number)
-        page_extent = indexer.get_page(book.filename, page_number)
-        # FIXME: 'with' is not the right idiom when fetching a page at a time.
-        # Cache at least the file object for the current book.
-        async with aiofiles.open(book.filename, 'rb') as f:
-            await f.seek(page_extent.first)
-            page = await f.read(page_extent.length)
-            page = str(page, 'utf8')
-            lines = []
-            if book.ext == '.brf':
-                for line in page.splitlines():
-                    lines.append(braille.from_ascii(line))
-            else:
-                # FIXME: is it OK to assert?  Must state extensions and check call sites.
-                assert book.ext == '.pef'
-                # Expand self-closing tags.
-                page = re.sub(r'<row */>', r'<row></row>', page)
-                # Get contents of all rows.
-                for line in re.findall(r'(?<=<row>)[^<]*(?=</row>)', page):
-                    lines.append(braille.from_unicode(line))
-            while len(lines) < book.height:
-                lines.append(tuple())
-            return tuple(lines)
+        # FIXME: is it OK to assert?  Must state extensions and check call sites.
+        assert book.ext == '.pef'
+        # The indexer knows where each row is, so no parsing is needed.
+        rows = []
+        for row in indexer.get_page_rows(book.handle, page_number, book.height):
+            first = row.first - page_extent.first
+            line = str(page[first:first + row.length], 'utf8', errors='replace')
+            rows.append(_row_text(line))
+        lines.extend(braille.from_unicode_lines(rows))
+    while len(lines) < book.height:
+        lines.append(tuple())
+    return tuple(lines)
+
+
+def _row_text(row):
+    """
+    Returns the text of a PEF row's content, which is that of any CDATA
+    sections within it but not any other markup.
+    """
+    text = []
+    while '<' in row:
+        start = row.index('<')
+        text.append(row[:start])
+        row = row[start:]
+        if row.startswith('<![CDATA['):
+            row = row[len('<![CDATA['):]
+            terminator = ']]>'
+        elif row.startswith('<!--'):
+            terminator = '-->'
+        else:
+            terminator = '>'
+        end = row.find(terminator)
+        if end < 0:
+            end = len(row)
+        if terminator == ']]>':
+            text.append(row[:end])
+        row = row[end + len(terminator):]
+    text.append(row)
+    return ''.join(text)
+
+
+def strip_query(query):
+    """Returns `query`, pin numbers, without blank cells at either end."""
+    query = tuple(query)
+    while query and query[0] == 0:
+        query = query[1:]
+    while query and query[-1] == 0:
+        query = query[:-1]
+    return query
+
+
+def search_book(book, query):
+    """
+    Returns the numbers of the pages of `book` on which `query`, a
+    sequence of pin numbers, appears within a line as shown, ignoring
+    blank cells at either end of it; or None if `book` can't be searched (as while
+    it's still loading).
+    """
+    query = strip_query(query)
+    if not query:
+        return []
+    if book.load_state != book_file.LoadState.DONE:
+        return None
+    if not book.indexed:
+        return [n for n, page in enumerate(book.pages)
+                if any(line_contains(line, query) for line in page)]
+    try:
+        _count, pages = indexer.search(book.handle, braille.mapping, query, book.width)
+    except OSError:
+        log.warning(f'searching {book.filename} failed', exc_info=True)
+        return None
+    return pages
+
+
+def line_contains(line, query):
+    """Whether `line` holds `query`, both sequences of pin numbers."""
+    line, query = tuple(line), tuple(query)
+    return any(line[i:i + len(query)] == query
+               for i in range(len(line) - len(query) + 1))
+
+
+def cancel_background_loads(wanted):
+    """Cancel loading any books in the background that aren't in `wanted`."""
+    wanted = {(book.filename, book.height) for book in wanted}
+    for handle, book in list(_background.items()):
+        if (book.filename, book.height) not in wanted:
+            log.info('cancelling background loading of {}'.format(book.filename))
+            indexer.cancel_load(handle)
 
 
 async def load_book(book, state, background=False):
-    state.app.library.set_book_loading(book)
+    handle = None
+
+    def loading(book):
+        nonlocal handle
+        handle = book.handle
+        if background:
+            _background[handle] = book
+        state.app.library.set_book_loading(book)
+
     if background:
         log.info('background loading {}'.format(book.filename))
     else:
         log.info('priority loading {}'.format(book.filename))
-    book = await _read_pages2(book, background=background)
-    state.app.library.add_or_replace(book)
+    log.debug('index queue depths (foreground, background): {}'.format(
+        indexer.get_queue_depths()))
+    try:
+        loaded = await _read_pages2(book, background=background, loading=loading)
+    finally:
+        if background:
+            _background.pop(handle, None)
+    latest = state.app.library.current_version(book)
+    if (latest.width, latest.height) != (book.width, book.height):
+        # the display changed size meanwhile, so this is no longer needed
+        if loaded.load_state == book_file.LoadState.DONE:
+            discard_index(loaded)
+        _note_loaded(loaded)
+        return
+    # The start of the book may have been read while the rest was still
+    # loading, so keep the reader's place.
+    if latest.page_number != book.page_number or latest.bookmarks != book.bookmarks:
+        # keep any end-of-book bookmark loading added
+        added = loaded.bookmarks[len(book.bookmarks):]
+        loaded = loaded._replace(page_number=latest.page_number,
+                                 bookmarks=latest.bookmarks + added)
+    state.app.library.add_or_replace(loaded)
+    _note_loaded(loaded)
+    if loaded.load_state == book_file.LoadState.DONE:
+        _note_index_used(loaded, state)
+        search_index.update(loaded.filename,
+                            os.path.relpath(loaded.filename, start=state.app.library.media_dir))
+    overdue = (loaded.filename, loaded.height) in _overdue
+    _overdue.discard((loaded.filename, loaded.height))
+    if (latest.indexed or overdue) and state.app.user.book is loaded:
+        # it was shown before its page count was known, or not at all
+        state.refresh_display()
 
 
 async def load_book_worker(state, queue):
@@ -132,6 +563,14 @@ async def load_book_worker(state, queue):
             await load_book(book, state, background=True)
             log.debug('file indexing complete')
         queue.task_done()
+        if queue.empty():
+            log.info(f'index cache stats: {indexer.get_cache_stats()}')
+            log.info(f'index memory: {indexer.get_index_memory()} bytes')
+            # bytes per microsecond is MB/s
+            rate = load_totals['bytes_read'] / max(1, load_totals['wall_us'])
+            log.info(f'load totals: {dict(load_totals)}, {rate:.1f} MB/s')
+            log.info(f'page cache: {dict(page_cache_stats)}, '
+                     f'{page_cache_hit_rate():.0%} hit rate')
 
 
 def books_loaded(state, books=None):
@@ -3,7 +3,9 @@
 import sys
 import os
 import ctypes
-from ctypes import c_uint8, c_uint16, c_uint32, c_int32, c_char_p, Structure
+import errno
+from ctypes import (c_uint8, c_uint32, c_uint64, c_int32, c_int64, c_char_p, c_void_p,
+                    POINTER, Structure)
 
 LIBNAME = 'bookindex'
 
@@ -13,46 +15,297 @@ extension = {'darwin': '.dylib', 'win32': '.dll'}.get(sys.platform, '.so')
 lib = ctypes.cdll.LoadLibrary(prefix + LIBNAME + extension)
 
 
+class PageExtent(Structure):
+    _fields_ = [('first', c_uint64),
+                ('length', c_uint64)]
+
+    def __str__(self):
+        return '(first:{},length:{})'.format(self.first, self.length)
+
+
 class PageExtentResult(Structure):
     _fields_ = [('status', c_int32),
-                ('first', c_uint32),
-                ('length', c_uint16)]
+                ('first', c_uint64),
+                ('length', c_uint64)]
 
     def __str__(self):
         return '(status:{},first:{},length:{})'.format(self.status, self.first, self.length)
 
 
-lib.init.argtypes = (c_uint8,)
-lib.init.restype = c_int32
+class PageView(Structure):
+    _fields_ = [('status', c_int32),
+                ('data', c_void_p),
+                ('length', c_uint64)]
+
+    def __str__(self):
+        return '(status:{},data:{},length:{})'.format(self.status, self.data, self.length)
+
+
+class LoadProgress(Structure):
+    _fields_ = [('page_count', c_int32),
+                ('complete', c_uint8)]
+
+    def __str__(self):
+        return '(page_count:{},complete:{})'.format(self.page_count, self.complete)
+
+
+class LoadStats(Structure):
+    _fields_ = [('status', c_int32),
+                ('cached', c_uint8),
+                ('queued_us', c_uint64),
+                ('wall_us', c_uint64),
+                ('bytes_read', c_uint64),
+                ('pages', c_uint32),
+                ('parse_errors', c_uint32)]
+
+    def __str__(self):
+        return ('(status:{},cached:{},queued_us:{},wall_us:{},bytes_read:{},pages:{},'
+                'parse_errors:{})').format(self.status, self.cached, self.queued_us,
+                                           self.wall_us, self.bytes_read, self.pages,
+                                           self.parse_errors)
+
+
+class CacheStats(Structure):
+    _fields_ = [('hits', c_uint32),
+                ('misses', c_uint32),
+                ('invalid', c_uint32)]
 
-lib.trigger_load.argtypes = (c_char_p, c_int32)
-lib.trigger_load.restype = None
+    def __str__(self):
+        return '(hits:{},misses:{},invalid:{})'.format(self.hits, self.misses, self.invalid)
+
+
+lib.set_completion_fd.argtypes = (c_int32,)
+lib.set_completion_fd.restype = c_int32
+
+lib.trigger_load.argtypes = (c_char_p, c_uint8, c_uint32, c_uint8)
+lib.trigger_load.restype = c_int32
+
+lib.cancel_load.argtypes = (c_uint32,)
+lib.cancel_load.restype = c_int32
+
+lib.set_pool_size.argtypes = (c_uint32,)
+lib.set_pool_size.restype = c_int32
+
+lib.get_pool_size.argtypes = ()
+lib.get_pool_size.restype = c_int32
+
+lib.get_queue_depth.argtypes = (c_uint8,)
+lib.get_queue_depth.restype = c_int32
+
+lib.set_cache_dir.argtypes = (c_char_p,)
+lib.set_cache_dir.restype = c_int32
 
-lib.get_page_count.argtypes = (c_char_p,)
+lib.get_cache_stats.argtypes = ()
+lib.get_cache_stats.restype = CacheStats
+
+lib.get_page_count.argtypes = (c_uint32,)
 lib.get_page_count.restype = c_int32
 
-lib.get_page.argtypes = (c_char_p, c_uint16)
+lib.get_page.argtypes = (c_uint32, c_uint32)
 lib.get_page.restype = PageExtentResult
 
+lib.get_pages.argtypes = (c_uint32, c_uint32, c_uint32, POINTER(PageExtent))
+lib.get_pages.restype = c_int32
+
+lib.get_page_cells.argtypes = (c_uint32, c_uint32, c_char_p, c_uint32, c_uint32,
+                               POINTER(c_uint8))
+lib.get_page_cells.restype = c_int32
+
+lib.get_page_rows.argtypes = (c_uint32, c_uint32, c_uint32, POINTER(PageExtent))
+lib.get_page_rows.restype = c_int32
+
+lib.set_current_book.argtypes = (c_uint32,)
+lib.set_current_book.restype = c_int32
+
+lib.get_page_view.argtypes = (c_uint32, c_uint32)
+lib.get_page_view.restype = PageView
+
+lib.set_search_indexing.argtypes = (c_uint8,)
+lib.set_search_indexing.restype = c_int32
+
+lib.search.argtypes = (c_uint32, c_char_p, POINTER(c_uint8), c_uint32, c_uint32,
+                       POINTER(c_uint32), c_uint32)
+lib.search.restype = c_int32
+
+lib.get_load_stats.argtypes = (c_uint32,)
+lib.get_load_stats.restype = LoadStats
+
+lib.get_load_progress.argtypes = (c_uint32,)
+lib.get_load_progress.restype = LoadProgress
+
+lib.unload_book.argtypes = (c_uint32,)
+lib.unload_book.restype = c_int32
+
+lib.get_index_memory.argtypes = (c_uint32,)
+lib.get_index_memory.restype = c_int64
+
+# Load priorities, as understood by trigger_load().
+FOREGROUND = 0
+BACKGROUND = 1
+
 # Syntactic sugar to hide the FFI-ness.
-# Calls to os.path.exists(bookpath) are a cheap way to outsource
-# embedded NUL detection (it'll throw ValueError).
-init = lib.init
+# Books are indexed per number of display lines, so trigger_load() takes
+# `lines` as well as `bookpath` and returns a handle for the pair, which
+# every other call about the book takes instead.  The same pair always
+# gets the same handle, so it can be kept for as long as the book is
+# open; it's only checked for embedded NULs the once, here.
+
+
+set_completion_fd = lib.set_completion_fd
+
+
+def trigger_load(bookpath, lines, token, background=False):
+    """
+    Start loading `bookpath` for `lines` lines per page, reporting `token`
+    to the completion fd when done, and return the book's handle.
+    """
+    if '\0' in bookpath:
+        raise ValueError('embedded null byte')
+    priority = BACKGROUND if background else FOREGROUND
+    handle = lib.trigger_load(bookpath.encode(), lines, token, priority)
+    if handle < 0:
+        raise OSError(-handle, os.strerror(-handle), bookpath)
+    return handle
+
+
+cancel_load = lib.cancel_load
+set_pool_size = lib.set_pool_size
+get_pool_size = lib.get_pool_size
+
+
+def get_queue_depths():
+    return lib.get_queue_depth(FOREGROUND), lib.get_queue_depth(BACKGROUND)
+
+
+def set_cache_dir(cachedir):
+    if '\0' in cachedir:
+        raise ValueError('embedded null byte')
+    return lib.set_cache_dir(cachedir.encode())
+
+
+def get_cache_stats():
+    return lib.get_cache_stats()
+
+
+get_page_count = lib.get_page_count
+get_page = lib.get_page
+
+
+def get_pages(handle, first, count):
+    """
+    Returns a tuple of the page count of book `handle` and a list of the
+    extents of up to `count` pages from `first`; the list is cut short
+    at the end of the book.  Upon failure the page count is a negated
+    errno and the list is empty.
+    """
+    extents = (PageExtent * count)()
+    page_count = lib.get_pages(handle, first, count, extents)
+    filled = max(0, min(count, page_count - first))
+    return page_count, extents[:filled]
+
+
+def get_page_window(handle, page, radius=5):
+    """
+    Returns a tuple of the page count of book `handle` and a dict of the
+    extents of pages within `radius` of `page`, for reading ahead.
+    """
+    first = max(0, page - radius)
+    page_count, extents = get_pages(handle, first, page + radius + 1 - first)
+    return page_count, dict(enumerate(extents, start=first))
+
+
+def get_page_cells(handle, page, encoding, width, height):
+    """
+    Returns page `page` of book `handle` decoded to pin numbers, as bytes
+    of `width` * `height` cells in row order.  `encoding` is the Braille
+    ASCII mapping to decode BRF with.  Raises OSError upon failure.
+    """
+    cells = (c_uint8 * (width * height))()
+    status = lib.get_page_cells(handle, page, encoding.encode('ascii'), width, height, cells)
+    if status < 0:
+        raise OSError(-status, os.strerror(-status))
+    return bytes(cells)
+
+
+def get_page_rows(handle, page, max_rows):
+    """
+    Returns a list of the extents of the content of each row, up to
+    `max_rows`, of page `page` of PEF book `handle`, or an empty list
+    upon failure.
+    """
+    rows = (PageExtent * max_rows)()
+    row_count = lib.get_page_rows(handle, page, max_rows, rows)
+    return rows[:max(0, min(max_rows, row_count))]
+
+
+def set_current_book(handle):
+    """
+    Have the extension keep book `handle`, the one being read, mapped,
+    and no other; None means no book.
+    """
+    return lib.set_current_book(handle or 0)
+
+
+def get_page_view(handle, page):
+    """
+    Returns a memoryview of the bytes of page `page` of book `handle` in
+    the extension's map of the book, without copying them, or None if it
+    can't (it isn't the current book, say).  The view is only valid until
+    the next call to get_page_view(), so must be used straight away.
+    """
+    view = lib.get_page_view(handle, page)
+    if view.status != 0:
+        return None
+    if view.length == 0:
+        return memoryview(b'')
+    return memoryview((c_uint8 * view.length).from_address(view.data)).cast('B')
+
+
+def set_search_indexing(enabled):
+    """Whether books loaded from now on are also indexed for search()."""
+    return lib.set_search_indexing(1 if enabled else 0)
+
+
+def search(handle, encoding, query, width, max_pages=1000):
+    """
+    Returns a tuple of how many pages of book `handle` hold `query`, a
+    sequence of pin numbers, within the first `width` cells of a line,
+    and a list of the first `max_pages` of them in order.  `encoding` is
+    the Braille ASCII mapping to decode BRF with.  Raises OSError upon
+    failure.
+    """
+    cells = (c_uint8 * len(query))(*query)
+    pages = (c_uint32 * max_pages)()
+    status = lib.search(handle, encoding.encode('ascii'), cells, len(query), width, pages,
+                        max_pages)
+    if status < 0:
+        raise OSError(-status, os.strerror(-status))
+    return status, pages[:min(status, max_pages)]
+
 
-# FIXME get this from serial greeting or constant
-init(9)
+def get_load_progress(handle):
+    """
+    Returns how many pages of book `handle` can be read so far (or a
+    negated errno if none) and whether that's all of them.
+    """
+    progress = lib.get_load_progress(handle)
+    return progress.page_count, bool(progress.complete)
 
 
-def trigger_load(bookpath, bookfd):
-    os.path.exists(bookpath)
-    lib.trigger_load(bookpath.encode(), bookfd)
+def get_load_stats(handle):
+    """
+    Returns how the last finished load of book `handle` went, as
+    LoadStats, or None if none has finished.
+    """
+    stats = lib.get_load_stats(handle)
+    if stats.status == -errno.ENOENT:
+        return None
+    return stats
 
 
-def get_page_count(bookpath):
-    os.path.exists(bookpath)
-    return lib.get_page_count(bookpath.encode())
+unload_book = lib.unload_book
 
 
-def get_page(bookpath, page):
-    os.path.exists(bookpath)
-    return lib.get_page(bookpath.encode(), page)
+def get_index_memory(handle=0):
+    """Bytes used by book `handle`'s index, or by all indices if 0."""
+    return lib.get_index_memory(handle)
@@ -64,6 +64,15 @@ class UserState:
         self.root.app.location = 'go_to_page'
         self.root.refresh_display()
 
+    def enter_search(self):
+        search = self.root.app.search_menu
+        if search.scope != 'book':
+            search.reset()
+            search.scope = 'book'
+        self.root.app.home_menu_visible = False
+        self.root.app.location = 'search'
+        self.root.refresh_display()
+
     def toggle_home_menu(self):
         self.root.app.home_menu_visible = not self.root.app.home_menu_visible
         self.root.refresh_display()
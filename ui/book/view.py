@@ -1,14 +1,19 @@
+import asyncio
+import logging
+
 from ..braille import from_unicode, format_title
-from .handlers import get_page_data
+from .handlers import BookFileError, get_page_data
 from .help import render_book_help, render_home_menu_help
 
+log = logging.getLogger(__name__)
+
 
 def render_home_menu(width, height, book, locale):
     data = []
     data.append(format_title(book.title, width,
                              book.page_number, book.get_num_pages()))
     data.append(from_unicode(_('go to page')))
-    data.append(tuple())
+    data.append(from_unicode(_('search in book')))
     data.append(tuple())
     data.append(from_unicode(_('insert bookmark at current page')))
     data.append(from_unicode(_('choose from existing bookmarks')))
@@ -18,6 +23,13 @@ def render_home_menu(width, height, book, locale):
     return tuple(data)
 
 
+def render_error(width, height, book, message):
+    data = [from_unicode(message), from_unicode(book.title)[:width]]
+    while len(data) < height:
+        data.append(tuple())
+    return tuple(data)
+
+
 async def render(width, height, state):
     help_menu = state.app.help_menu.visible
     home_menu = state.app.home_menu_visible
@@ -36,5 +48,11 @@ async def render(width, height, state):
     book = state.app.user.book
     if home_menu:
         return render_home_menu(width, height, book, locale)
-    else:
+    try:
         return await get_page_data(book, state)
+    except BookFileError:
+        log.warning(f'could not show {book.filename}')
+        return render_error(width, height, book, _('this book could not be loaded'))
+    except asyncio.TimeoutError:
+        log.warning(f'gave up waiting for {book.filename} to load')
+        return render_error(width, height, book, _('this book is still loading'))
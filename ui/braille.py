@@ -1,4 +1,6 @@
 import os
+import re
+import codecs
 import logging
 from collections import namedtuple, OrderedDict
 import curses.ascii as ASCII
@@ -7,6 +9,15 @@ log = logging.getLogger(__name__)
 
 UNICODE_BRAILLE_BASE = 0x2800
 
+# Characters below and above the Unicode Braille block, which decode to
+# blank and full cells respectively.
+BELOW_BRAILLE = re.compile('[\x00-\u27ff]+')
+ABOVE_BRAILLE = re.compile('[\u2900-\U0010ffff]+')
+NOT_BRAILLE = re.compile('[^\u2800-\u28ff]')
+# A table for bytes.translate() saturating the low bytes of Unicode
+# Braille characters to six dots, as unicode_to_pin_num() does.
+SIX_DOTS = bytes(min(code, 0x3f) for code in range(256))
+
 
 def format_title(title, width, page_number, total_pages, capitalize=True):
     """
@@ -153,11 +164,32 @@ BUILTIN_ENCODINGS = OrderedDict([
 ])
 DEFAULT_ENCODING = 'braille-ascii'
 
+
+def _ascii_table(mapping):
+    """
+    Returns a table for bytes.translate() of each Latin-1 character's pin
+    number, as alpha_to_pin_num() would give it.
+    """
+    table = bytearray(256)
+    for byte in range(256):
+        alpha = byte - 0x20 if byte >= 0x60 else byte
+        table[byte] = max(0, mapping.find(chr(alpha)))
+    return bytes(table)
+
+
+ASCII_TABLES = {name: _ascii_table(enc.mapping) for name, enc in BUILTIN_ENCODINGS.items()}
+
+# Characters beyond Latin-1 are encoded as this, which is no character in
+# any encoding, so that they decode to blank cells.
+codecs.register_error('braille-unknown', lambda e: (b'\x80' * (e.end - e.start), e.end))
+
 mapping = BUILTIN_ENCODINGS[DEFAULT_ENCODING].mapping
+ascii_table = ASCII_TABLES[DEFAULT_ENCODING]
 
 def set_encoding(encoding):
-    global mapping
+    global mapping, ascii_table
     mapping = BUILTIN_ENCODINGS[encoding].mapping
+    ascii_table = ASCII_TABLES[encoding]
 
 
 def pin_num_to_alpha(numeric):
@@ -194,18 +226,59 @@ def alpha_to_pin_num(alpha):
 
 def from_ascii(alphas):
     """
-    convert a list or string of alphas to pin numbers using
-    :meth:`alpha_to_pin_num` form feed and line feed characters are supressed
+    convert a list or string of alphas to pin numbers as
+    :meth:`alpha_to_pin_num` would, a line (or page) at a time
+    """
+    return tuple(ascii_to_pin_bytes(alphas))
+
+
+def ascii_to_pin_bytes(alphas):
+    """
+    convert a list or string of alphas to a bytes of pin numbers, as
+    :meth:`from_ascii` does
     """
-    return tuple(alpha_to_pin_num(a) for a in alphas)
+    if not isinstance(alphas, str):
+        alphas = ''.join(alphas)
+    return alphas.encode('latin-1', 'braille-unknown').translate(ascii_table)
 
 
 def from_unicode(alphas):
     """
-    convert a list or string of unicode chars to pin numbers using
-    :meth:`unicode_to_pin_num` form feed and line feed characters are supressed
+    convert a list or string of unicode chars to pin numbers as
+    :meth:`unicode_to_pin_num` would, a string at a time
+    """
+    return tuple(unicode_to_pin_bytes(alphas))
+
+
+def from_unicode_lines(lines):
+    """
+    convert a sequence of strings of unicode chars (such as the rows of a
+    page) to a tuple of tuples of pin numbers, all in one go
+    """
+    pins = unicode_to_pin_bytes(''.join(lines))
+    converted = []
+    start = 0
+    for line in lines:
+        end = start + len(line)
+        converted.append(tuple(pins[start:end]))
+        start = end
+    return tuple(converted)
+
+
+def unicode_to_pin_bytes(alphas):
+    """
+    convert a list or string of unicode chars to a bytes of pin numbers,
+    as :meth:`from_unicode` does
     """
-    return tuple(unicode_to_pin_num(a) for a in alphas)
+    if not isinstance(alphas, str):
+        alphas = ''.join(alphas)
+    # with every character in the Braille block, each one's low byte is
+    # its pattern of dots
+    if NOT_BRAILLE.search(alphas):
+        alphas = BELOW_BRAILLE.sub(lambda m: chr(UNICODE_BRAILLE_BASE) * len(m.group()), alphas)
+        alphas = ABOVE_BRAILLE.sub(lambda m: chr(UNICODE_BRAILLE_BASE + 0x3f) * len(m.group()),
+                                   alphas)
+    return alphas.encode('utf-16-be')[1::2].translate(SIX_DOTS)
 
 
 def alpha_to_unicode(alpha):
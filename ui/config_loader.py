@@ -28,6 +28,7 @@ def import_pages(module):
         'library',
         'book',
         'go_to_page',
+        'search',
         'bookmarks_menu',
         'system_menu',
         'language',
@@ -1,5 +1,7 @@
+import asyncio
 import logging
 from .config_loader import import_pages
+from .book.handlers import prefetch_pages
 
 
 log = logging.getLogger(__name__)
@@ -13,6 +15,7 @@ class Display():
         self.hardware_state = []
         self.buffer = []
         self.up_to_date = True
+        self.prefetching = None
 
     async def render_to_buffer(self, state):
         width, height = state.app.dimensions
@@ -22,6 +25,15 @@ class Display():
             self._set_buffer(page_data)
         except:
             log.warn('unknown page location')
+            return
+        if location == 'book':
+            self._prefetch(state.app.user.book)
+
+    def _prefetch(self, book):
+        """Decode pages around the one being read in the background."""
+        if self.prefetching is not None:
+            self.prefetching.cancel()
+        self.prefetching = asyncio.create_task(prefetch_pages(book))
 
     async def send_line(self, driver):
         row = self.row
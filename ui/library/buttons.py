@@ -9,6 +9,7 @@ def library_action(number):
 
 buttons = {
     'single': {
+        '1': state.app.library.enter_search,
         '2': library_action(2),
         '3': library_action(3),
         '4': library_action(4),
@@ -23,6 +24,7 @@ buttons = {
         'R': state.app.help_menu.toggle,
     },
     'long': {
+        '1': state.app.library.enter_search,
         '2': library_action(2),
         '3': library_action(3),
         '4': library_action(4),
@@ -0,0 +1,226 @@
+# A persistent index of the words in every book in the library, so that
+# the library can be searched by content without reading any books.
+#
+# Each book's words are indexed once, when it's first loaded after it
+# changes on disk, by a thread of their own; nothing is indexed unless
+# open_index() has been called.  Words are stored independent of the
+# Braille encoding: for BRF, runs of printable Braille ASCII folded to
+# upper case (as it's decoded), and for PEF runs of non-blank Unicode
+# Braille cells.  Either way, capital and grade 1 indicators before a
+# word and punctuation after it are left out, in the index and in
+# queries alike, so that 'cat' finds ',CAT' and 'CAT,'.
+import concurrent.futures
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+from .. import braille
+
+log = logging.getLogger(__name__)
+
+UNICODE_BRAILLE_BASE = braille.UNICODE_BRAILLE_BASE
+
+# Longer words are more likely to be junk than worth searching for.
+MAX_WORD_LEN = 64
+# how much of a book is read at a time while indexing it
+CHUNK_SIZE = 64 * 1024
+
+BRF_WORD = re.compile(rb'[\x21-\x7f]+')
+# anything above the blank cell; 8-dot patterns and beyond saturate to
+# the full cell, as they do when decoded
+PEF_WORD = re.compile('[^\x00-\u2800]+')
+NOT_SIX_DOT = re.compile('[^\u2801-\u283f]')
+FULL_CELL = chr(UNICODE_BRAILLE_BASE + 0x3f)
+FOLD = bytes.maketrans(bytes(range(0x60, 0x80)), bytes(range(0x40, 0x60)))
+
+# pin numbers of the capital, grade 1 and opening quote indicators...
+LEADING_CELLS = frozenset((0x20, 0x30, 0x26))
+# ...and of the punctuation (comma, semicolon, colon, full stop,
+# exclamation and question marks, closing quote, apostrophe, hyphen, and
+# the capital sign that some closing quotes begin with)
+TRAILING_CELLS = frozenset((0x02, 0x06, 0x12, 0x32, 0x16, 0x26, 0x34, 0x04, 0x24, 0x20))
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS books (
+    id INTEGER PRIMARY KEY,
+    relpath TEXT UNIQUE NOT NULL,
+    stamp TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS words (
+    word TEXT NOT NULL,
+    book INTEGER NOT NULL REFERENCES books(id)
+);
+CREATE INDEX IF NOT EXISTS words_by_word ON words (word);
+CREATE INDEX IF NOT EXISTS words_by_book ON words (book);
+'''
+
+_index = None
+
+
+class SearchIndex:
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # so that lookups can read while a book's words are written
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        # lookups have a connection of their own, so they never wait for
+        # the lock held while a book's words are written
+        self._reader = sqlite3.connect(path, check_same_thread=False)
+        self._reader_lock = threading.Lock()
+        # updates are written one at a time, away from the event loop
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def update(self, filename, relpath):
+        self._executor.submit(self._update, filename, relpath)
+
+    def _update(self, filename, relpath):
+        try:
+            stamp = _stamp(filename)
+            with self._lock:
+                row = self._db.execute('SELECT stamp FROM books WHERE relpath = ?',
+                                       (relpath,)).fetchone()
+            if row is not None and row[0] == stamp:
+                return
+            words = book_words(filename)
+            with self._lock, self._db:
+                self._db.execute('DELETE FROM words WHERE book IN '
+                                 '(SELECT id FROM books WHERE relpath = ?)', (relpath,))
+                self._db.execute('INSERT OR REPLACE INTO books (relpath, stamp) VALUES (?, ?)',
+                                 (relpath, stamp))
+                book, = self._db.execute('SELECT id FROM books WHERE relpath = ?',
+                                         (relpath,)).fetchone()
+                self._db.executemany('INSERT INTO words (word, book) VALUES (?, ?)',
+                                     ((word, book) for word in words))
+            log.debug(f'indexed {len(words)} words of {relpath}')
+        except Exception:
+            log.warning(f'indexing words of {filename} failed', exc_info=True)
+
+    def lookup(self, query):
+        """
+        Returns the set of relpaths of books holding every word of
+        `query`, pin numbers with blank cells between words.
+        """
+        found = None
+        for word in _query_words(query):
+            with self._reader_lock:
+                rows = self._reader.execute(
+                    'SELECT DISTINCT relpath FROM words JOIN books ON books.id = words.book '
+                    'WHERE word IN (?, ?)', word).fetchall()
+            books = {relpath for relpath, in rows}
+            found = books if found is None else found & books
+            if not found:
+                break
+        return found or set()
+
+    def close(self):
+        self._executor.shutdown()
+        self._reader.close()
+        self._db.close()
+
+
+def _stamp(filename):
+    st = os.stat(filename)
+    return f'{st.st_size}:{st.st_mtime_ns}'
+
+
+def book_words(filename, chunk_size=CHUNK_SIZE):
+    """Returns the set of words in the book at `filename`."""
+    if os.path.splitext(filename)[-1].lower() == '.brf':
+        with open(filename, 'rb') as f:
+            chunks = iter(lambda: f.read(chunk_size), b'')
+            words = (_brf_word(word) for word in _split_words(chunks, BRF_WORD))
+            return {word for word in words if len(word) <= MAX_WORD_LEN}
+    # markup is all below the Unicode Braille block, so separates words
+    with open(filename, encoding='utf8', errors='replace') as f:
+        chunks = iter(lambda: f.read(chunk_size), '')
+        words = (_pef_word(word) for word in _split_words(chunks, PEF_WORD))
+        return {word for word in words if len(word) <= MAX_WORD_LEN}
+
+
+def _split_words(chunks, word_re):
+    """
+    Yields each match of `word_re` in the concatenation of `chunks`,
+    keeping no more than a word's worth of them at once.
+    """
+    partial = None
+    for chunk in chunks:
+        if partial is not None:
+            # anything longer won't be indexed anyway
+            chunk = partial[:MAX_WORD_LEN + 1] + chunk
+            partial = None
+        for match in word_re.finditer(chunk):
+            if match.end() == len(chunk):
+                # may carry on into the next chunk
+                partial = match.group()
+            else:
+                yield match.group()
+    if partial is not None:
+        yield partial
+
+
+def _strip(cells):
+    """
+    Returns the slice of `cells`, pin numbers, within any indicators
+    before them and punctuation after, or all of them if that's all
+    there is (as for a lower wordsign standing alone).
+    """
+    start, end = 0, len(cells)
+    while start < end and cells[start] in LEADING_CELLS:
+        start += 1
+    while end > start and cells[end - 1] in TRAILING_CELLS:
+        end -= 1
+    return slice(start, end) if start < end else slice(0, len(cells))
+
+
+def _brf_word(word):
+    # the current encoding decides which characters are which cells
+    return word[_strip(word.translate(braille.ascii_table))].translate(FOLD).decode('ascii')
+
+
+def _pef_word(word):
+    word = NOT_SIX_DOT.sub(FULL_CELL, word)
+    return word[_strip([ord(c) - UNICODE_BRAILLE_BASE for c in word])]
+
+
+def _query_words(query):
+    """
+    Returns each word of `query` as a pair of how it would be indexed in
+    a BRF and in a PEF.
+    """
+    word = []
+    for cell in tuple(query) + (0,):
+        if cell != 0:
+            word.append(cell)
+        elif word:
+            word = word[_strip(word)]
+            # the current encoding decides what's in a BRF
+            alphas = ''.join(braille.pin_nums_to_alphas(word))
+            brf = str(alphas.encode('ascii').translate(FOLD), 'ascii')
+            pef = ''.join(chr(UNICODE_BRAILLE_BASE + cell) for cell in word)
+            yield brf, pef
+            word = []
+
+
+def open_index(path):
+    """Index the words of books as they're loaded, keeping them at `path`."""
+    global _index
+    _index = SearchIndex(path)
+
+
+def update(filename, relpath):
+    """Index the words of `filename` in the background, if they've changed."""
+    if _index is not None:
+        _index.update(filename, relpath)
+
+
+def lookup(query):
+    """
+    Returns the set of relpaths of books holding every word of `query`,
+    or None if words aren't being indexed.
+    """
+    if _index is None:
+        return None
+    return _index.lookup(query)
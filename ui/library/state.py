@@ -3,6 +3,10 @@ import math
 import logging
 
 from ..book import book_file
+from ..book.handlers import line_contains, strip_query
+from ..braille import from_ascii, pin_nums_to_alphas
+from .explorer import Directory, LocalFile
+from . import search_index
 from .. import state
 
 
@@ -19,6 +23,10 @@ class LibraryState:
         # index of directory that is currently expanded, if any
         self.files_dir_index = None
         self.files_count = 0
+        # books found by a library search, listed in place of the
+        # directories until closed, and the page to go back to then
+        self.results = None
+        self.results_return_page = 0
 
     @property
     def DIRS_PAGE_SIZE(self):
@@ -36,15 +44,19 @@ class LibraryState:
 
     @property
     def open_dir(self):
+        if self.results is not None:
+            return self.results
         return self.dirs[self.files_dir_index] if self.files_page_open else None
 
     @property
     def files_page_open(self):
-        return self.files_dir_index is not None
+        return self.results is not None or self.files_dir_index is not None
 
     @property
     def _files_page_start(self):
         """only valid if files_dir_index is open"""
+        if self.results is not None:
+            return 0
         return math.ceil((self.files_dir_index + 1) / self.DIRS_PAGE_SIZE)
 
     @property
@@ -57,6 +69,8 @@ class LibraryState:
 
     @property
     def pages(self):
+        if self.results is not None:
+            return max(1, self._files_pages)
         pages = self._dirs_pages
         if self.files_page_open:
             # + 1 for the extra dir page before/after
@@ -83,7 +97,7 @@ class LibraryState:
     def page_begin_end(self, page_num):
         begin = 0
         end = self.DIRS_PAGE_SIZE
-        if self.files_page_open:
+        if self.files_dir_index is not None and self.results is None:
             if page_num == self._files_page_start - 1:
                 end = self.files_dir_index % self.DIRS_PAGE_SIZE + 1
             if page_num == self._files_page_start + self._files_pages:
@@ -103,7 +117,10 @@ class LibraryState:
             if button == 0:
                 return  # title
             elif button == 1:
-                self.set_files_dir_index(None)  # back
+                if self.results is not None:
+                    self.close_search_results()
+                else:
+                    self.set_files_dir_index(None)  # back
             else:
                 i = button - 2
                 if i >= begin and i < end and offset + i < len(dir.files):
@@ -160,6 +177,49 @@ class LibraryState:
                         break
                 break
 
+    def enter_search(self):
+        self.root.app.search_menu.reset()
+        self.root.app.search_menu.scope = 'library'
+        self.root.app.location = 'search'
+        self.root.refresh_display()
+
+    def search(self, query):
+        """
+        Returns the relpaths of the books whose titles hold `query`, pin
+        numbers, then of those whose contents hold each of its words, if
+        contents are indexed.
+        """
+        query = strip_query(query)
+        if not query:
+            return []
+        books = self.root.app.user.books
+        found = [relpath for relpath, book in books.items()
+                 if line_contains(from_ascii(book.title), query)]
+        contents = search_index.lookup(query) or set()
+        found += [relpath for relpath in books
+                  if relpath in contents and relpath not in found]
+        return found
+
+    def show_search_results(self, query, relpaths):
+        """List the books at `relpaths` in place of the directories."""
+        title = ''.join(pin_nums_to_alphas(strip_query(query)))
+        results = Directory(title, display=title)
+        results.files = [LocalFile(relpath) for relpath in relpaths]
+        if self.results is None:
+            self.results_return_page = self.page
+        self.results = results
+        self.files_count = results.files_count
+        self.page = 0
+        self.root.app.location = 'library'
+        self.root.refresh_display()
+
+    def close_search_results(self):
+        self.results = None
+        self.files_count = self.dirs[self.files_dir_index].files_count \
+            if self.files_dir_index is not None else 0
+        self.page = self.results_return_page
+        self.root.refresh_display()
+
     def open_book(self, book):
         self.root.app.user.current_book = book.relpath(self.media_dir)
         self.root.app.location = 'book'
@@ -171,6 +231,11 @@ class LibraryState:
         relpath = os.path.relpath(book.filename, start=self.media_dir)
         self.root.app.user.books[relpath] = book
 
+    def current_version(self, book):
+        """the book as it is now, since books are replaced when changed"""
+        relpath = os.path.relpath(book.filename, start=self.media_dir)
+        return self.root.app.user.books[relpath]
+
     def set_book_loading(self, book):
         book = book._replace(load_state=book_file.LoadState.LOADING)
         self.add_or_replace(book)
@@ -189,6 +254,13 @@ class LibraryState:
                     yield book
 
     def books_to_index(self):
+        now, later = self.reachable_books()
+        now = [b for b in now if b.load_state == book_file.LoadState.INITIAL]
+        later = [b for b in later if b.load_state == book_file.LoadState.INITIAL]
+        return now, later
+
+    def reachable_books(self):
+        """books shown now and those reachable from here, loaded or not"""
         now = [self.root.app.user.book]
 
         if self.root.app.location == 'library':
@@ -218,7 +290,4 @@ class LibraryState:
             # not looking at a library page, so only need to cache current page
             later = list(self._books_on(self.page))
 
-        now = [b for b in now if b.load_state == book_file.LoadState.INITIAL]
-        later = [b for b in later if b.load_state == book_file.LoadState.INITIAL]
-
         return now, later
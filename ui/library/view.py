@@ -33,6 +33,14 @@ For best results you should format your files with forty cells per \
 line and nine lines of Braille per page. The latest version of Duxbury \
 DBT and the free online robo-braille service both have a Canute 360 \
 preset built in for formatting.\
+''')
+    para += '\n\n' + _('''\
+You can search the library by pressing line select button 1, next to \
+the library menu title. Enter a word or phrase in Braille as you would \
+to search a book, then press the large forward button. The books with \
+your search in their titles, or with every word of it in their text, \
+are then listed in place of the directories. Press line select button \
+2 to go back to the directories.\
 ''')
 
     for line in para.split('\n'):
@@ -72,7 +80,10 @@ def dir_display_text(dir, width, show_count=True):
 def page_display_text(dir, page, of_pages, width):
     # (other menu titles are capitalised by braille.format_title)
     title = unicodes_to_alphas(_('LIBRARY menu'))
-    progress = f'{to_ueb_number(page)}/{to_ueb_number(of_pages)}'
+    # TRANSLATORS: Library menu title suffix; line select button 1, by
+    # the title, opens the library search
+    search = unicodes_to_alphas(_('search'))
+    progress = f'{search} {to_ueb_number(page)}/{to_ueb_number(of_pages)}'
     if dir is not None:
         title += ' - ' + truncate_location(dir.display_relpath,
                                            width - len(title) - 3 - len(progress) - 3)
@@ -270,18 +270,43 @@ def handle_save_events(config, state):
 
 
 def handle_display_events(config, state):
-    from .book.handlers import load_book, load_book_worker
+    from .book.handlers import (cancel_background_loads, load_book, load_book_worker,
+                                set_index_limit)
+    from .book import indexer
+    from .library import search_index
 
     media_dir = config.get('files', {}).get('media_dir')
+    index_cache = config.get('files', {}).get('index_cache')
+    if index_cache is not None:
+        index_cache = os.path.expanduser(index_cache)
+        if indexer.set_cache_dir(index_cache) != 0:
+            log.warning(f'index cache disabled, cannot use {index_cache}')
+    set_index_limit(config.get('files', {}).get('index_limit'))
+    indexer.set_search_indexing(config.get('files', {}).get('search_index', False))
+    library_index = config.get('files', {}).get('library_index')
+    if library_index is not None:
+        library_index = os.path.expanduser(library_index)
+        try:
+            search_index.open_index(library_index)
+        except Exception:
+            log.warning(f'library index disabled, cannot use {library_index}', exc_info=True)
+    log.info(f'indexing with {indexer.get_pool_size()} thread(s)')
     queue = asyncio.Queue()
     worker = asyncio.create_task(load_book_worker(state, queue))
 
     async def load_render_cache():
         now, later = state.app.library.books_to_index()
 
-        # make sure we have all the info we need and then display
+        # make sure we have all the info we need and then display; except
+        # that a book being read can be shown page by page as it indexes
+        reading = (state.app.location == 'book' and not state.app.home_menu_visible
+                   and not state.app.help_menu.visible)
+        loading = []
         for book in now:
-            await load_book(book, state)
+            if reading and book is state.app.user.book:
+                loading.append(asyncio.create_task(load_book(book, state)))
+            else:
+                await load_book(book, state)
 
         # drain any outstanding book indexing tasks
         while not queue.empty():
@@ -291,12 +316,19 @@ def handle_display_events(config, state):
                 continue
             queue.task_done()
 
+        # and stop any already under way that can no longer be reached
+        reachable_now, reachable_later = state.app.library.reachable_books()
+        cancel_background_loads(reachable_now + reachable_later)
+
         # now queue up indexing tasks to cache
         for book in later:
             queue.put_nowait(book.relpath(media_dir))
 
         await display.render_to_buffer(state)
 
+        for task in loading:
+            await task
+
     def on_refresh_display():
         asyncio.create_task(load_render_cache())
 
@@ -0,0 +1,73 @@
+from ..state import state
+
+
+# While entering a query, buttons 1 to 6 toggle the dots of the cell
+# being entered, as on a Braille keyboard; once searched, the line select
+# buttons go to the results shown beside them.
+def line_select(number):
+    def thunk():
+        search = state.app.search_menu
+        if not search.searched:
+            if number <= 6:
+                search.toggle_dot(number)
+            elif number == 7:
+                search.add_cell()
+            elif number == 8:
+                search.delete_cell()
+        elif number == 1:
+            search.new_search()
+        else:
+            search.go_to_result(number - 2)
+
+    return thunk
+
+
+def forward():
+    search = state.app.search_menu
+    if search.searched:
+        state.app.next_page()
+    else:
+        search.search()
+
+
+def back():
+    search = state.app.search_menu
+    if search.searched:
+        state.app.previous_page()
+    else:
+        search.delete_cell()
+
+
+buttons = {
+    'single': {
+        'L': state.app.close_menu,
+        '1': line_select(1),
+        '2': line_select(2),
+        '3': line_select(3),
+        '4': line_select(4),
+        '5': line_select(5),
+        '6': line_select(6),
+        '7': line_select(7),
+        '8': line_select(8),
+        '9': line_select(9),
+        '<': back,
+        '>': forward,
+        'R': state.app.help_menu.toggle,
+    },
+    'long': {
+        'L': state.app.close_menu,
+        '1': line_select(1),
+        '2': line_select(2),
+        '3': line_select(3),
+        '4': line_select(4),
+        '5': line_select(5),
+        '6': line_select(6),
+        '7': line_select(7),
+        '8': line_select(8),
+        '9': line_select(9),
+        '<': back,
+        '>': forward,
+        'X': state.hardware.reset_display,
+        'R': state.app.help_menu.toggle,
+    },
+}
@@ -0,0 +1,76 @@
+import logging
+
+from ..book.handlers import search_book, strip_query
+from .. import state
+
+log = logging.getLogger(__name__)
+
+
+class SearchState:
+    def __init__(self, root: 'state.RootState'):
+        self.root = root
+        # 'book' to search the current book, or 'library' for all of them
+        self.scope = 'book'
+        self.reset()
+
+    def reset(self):
+        # dots of the cell being entered, as a pin number
+        self.dots = 0
+        self.query = ()
+        # pages of the current book holding the query, once searched, or
+        # None if it couldn't be searched
+        self.results = ()
+        self.searched = False
+        self.page = 0
+
+    def toggle_dot(self, dot):
+        self.dots ^= 1 << (dot - 1)
+        self.root.refresh_display()
+
+    def add_cell(self):
+        self.query += (self.dots,)
+        self.dots = 0
+        self.root.refresh_display()
+
+    def delete_cell(self):
+        if self.dots:
+            self.dots = 0
+        else:
+            self.query = self.query[:-1]
+        self.root.refresh_display()
+
+    def search(self):
+        query = strip_query(self.query + (self.dots,))
+        if not query:
+            return
+        self.query = query
+        self.dots = 0
+        if self.scope == 'library':
+            found = self.root.app.library.search(query)
+            log.debug(f'library search found {found}')
+            if found:
+                self.reset()
+                self.root.app.library.show_search_results(query, found)
+                return
+            self.results = ()
+        else:
+            book = self.root.app.user.book
+            self.results = search_book(book, query)
+            log.debug(f'search found {self.results}')
+        self.searched = True
+        self.page = 0
+        self.root.refresh_display()
+
+    def new_search(self):
+        self.reset()
+        self.root.refresh_display()
+
+    def go_to_result(self, n):
+        width, height = self.root.app.dimensions
+        # adjust for title
+        height -= 1
+        results = self.results or ()
+        results = results[self.page * height:(self.page * height) + height]
+        if n >= len(results):
+            return
+        self.root.app.user.set_book_page(results[n])
@@ -0,0 +1,92 @@
+from ..braille import format_title, from_ascii, from_unicode, pin_nums_to_alphas, \
+    pin_num_to_unicode, to_ueb_number
+from ..book.handlers import get_page_data, line_contains
+
+
+def render_help(width, height):
+    data = []
+    para = _('''\
+You can search the book you are reading for a word or phrase by \
+entering it in Braille using the line select buttons on the left hand \
+side of the display. Buttons 1 to 6 raise and lower dots 1 to 6 of the \
+cell you are entering, which is shown on the bottom line. Press button \
+7 to add it and start on the next cell, leaving it blank for a space, \
+or button 8 to delete a cell. Press the large forward button on the \
+front surface to search.
+
+The pages where your search is found are then listed, with the line \
+where it is found on each. Press the line select button to the left of \
+a page to go to it. Press the large forward and back buttons to see \
+more pages, and line select button 1 to start a new search.\
+''')
+
+    for line in para.split('\n'):
+        data.append(from_unicode(line))
+
+    while len(data) % height:
+        data.append(tuple())
+
+    return tuple(data)
+
+
+def render_query(width, height, search):
+    data = []
+    for dot in range(1, 7):
+        number = ''.join(map(pin_num_to_unicode, from_ascii(to_ueb_number(dot))))
+        # TRANSLATORS: Search menu item; raises or lowers a dot of the
+        # cell being entered
+        data.append(from_unicode(_('dot {}').format(number)))
+    data.append(from_unicode(_('add cell')))
+    data.append(from_unicode(_('delete cell')))
+    # the query so far, then the cell being entered
+    data.append(search.query + (search.dots,))
+    data = data[:height]
+
+    while len(data) < height:
+        data.append(tuple())
+
+    return tuple(data)
+
+
+async def render(width, height, state):
+    if state.app.help_menu.visible:
+        all_lines = render_help(width, height)
+        num_pages = len(all_lines) // height
+        page_num = min(state.app.help_menu.page, num_pages - 1)
+        first_line = page_num * height
+        off_end = first_line + height
+        page = all_lines[first_line:off_end]
+        return page
+
+    search = state.app.search_menu
+    if not search.searched:
+        return render_query(width, height, search)
+
+    book = state.app.user.book
+    results = search.results or ()
+    # Account for title at the top in maths.
+    result_lines = height - 1
+    num_pages = max(1, (len(results) + (result_lines - 1)) // result_lines)
+    line_n = search.page * result_lines
+    # TRANSLATORS: Search results title; gets followed by what was searched for
+    title = _('search:') + ' {}'
+    data = [format_title(title.format(''.join(pin_nums_to_alphas(search.query))),
+                         width, search.page, num_pages, capitalize=False)]
+
+    if search.results is None:
+        data.append(from_unicode(_('this book cannot be searched yet')))
+    elif not results:
+        data.append(from_unicode(_('not found')))
+
+    for page_number in results[line_n:line_n + result_lines]:
+        lines = await get_page_data(book, state, page_number=page_number)
+        line = next((line for line in lines if line_contains(line, search.query)),
+                    lines[0])
+        n = from_ascii(to_ueb_number(page_number + 1) + ' ')
+        data.append(n + tuple(line))
+
+    # pad page with empty rows
+    while len(data) < height:
+        data.append(tuple())
+
+    return tuple(data)
@@ -1,6 +1,8 @@
 from .book.state import UserState
+from .book.handlers import discard_index
 from .library.state import LibraryState
 from .go_to_page.state import GoToPageState
+from .search.state import SearchState
 from .bookmarks_menu.state import BookmarksState
 from .language.state import LanguageState
 from .encoding.state import EncodingState
@@ -11,6 +13,7 @@ from .system_menu.help import render_help as render_system_help
 from .language.view import render_help as render_language_help
 from .encoding.view import render_help as render_encoding_help
 from .go_to_page.view import render_help as render_gtp_help
+from .search.view import render_help as render_search_help
 from .bookmarks_menu.help import render_help as render_bookmarks_help
 
 
@@ -66,6 +69,7 @@ class AppState:
         self.languages = LanguageState(root)
         self.encoding = EncodingState(root)
         self.go_to_page_menu = GoToPageState(root)
+        self.search_menu = SearchState(root)
 
         self.loading_books = False
         self.replacing_library = False
@@ -81,8 +85,18 @@ class AppState:
         return 'help_menu' if self.help_menu.visible else self.location
 
     def set_dimensions(self, value):
+        if value == self.dimensions:
+            return
         self._width = value[0]
         self._height = value[1]
+        # books will be loaded again for the new size when next needed
+        books = self.user.books
+        for relpath, book in books.items():
+            resized = book.with_dimensions(*value)
+            if resized is not book:
+                discard_index(book)
+            books[relpath] = resized
+        self.root.refresh_display()
 
     def go_to_library(self):
         self.location = 'library'
@@ -117,6 +131,7 @@ class AppState:
         self.bookmarks_menu.page = 0
         self.home_menu_visible = False
         self.go_to_page_menu.selection = ''
+        self.search_menu.reset()
         self.help_menu.visible = False
         self.help_menu.page = 0
         self.root.refresh_display()
@@ -154,6 +169,15 @@ class AppState:
             if page >= num_pages - 1:
                 page = num_pages - 1
             self.bookmarks_menu.page = page
+        elif location == 'search':
+            results = self.search_menu.results or ()
+            # Account for title line.
+            effective_height = height - 1
+            num_pages = (len(results) +
+                         (effective_height-1)) // effective_height
+            if page >= num_pages - 1:
+                page = max(0, num_pages - 1)
+            self.search_menu.page = page
         elif location == 'help_menu':
 
             # To calculate help page bounds and ensure we stay within
@@ -167,6 +191,7 @@ class AppState:
                 'encoding': render_encoding_help,
                 'bookmarks_menu': render_bookmarks_help,
                 'go_to_page': render_gtp_help,
+                'search': render_search_help,
             }
             if state.app.home_menu_visible:
                 mapping['book'] = render_home_menu_help
@@ -193,6 +218,8 @@ class AppState:
             self.go_to_page(page)
         elif location == 'bookmarks_menu':
             self.go_to_page(self.bookmarks_menu.page + value)
+        elif location == 'search':
+            self.go_to_page(self.search_menu.page + value)
         elif location == 'help_menu':
             self.go_to_page(self.help_menu.page + value)
 